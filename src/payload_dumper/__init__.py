@@ -1,11 +1,23 @@
 #!/usr/bin/env python3
 import argparse
 import os
+import sys
 from multiprocessing import cpu_count
 
 from . import http_file
+from .async_fetch import AsyncFetchEngine
 from .dumper import Dumper
 from . import mtio
+from .range_cache import RangeCache
+
+
+def parse_size(s: str) -> int:
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    s = s.strip().upper().rstrip("B")
+    if s[-1:] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
 
 def main():
     parser = argparse.ArgumentParser(description="OTA payload dumper")
@@ -23,6 +35,20 @@ def main():
         default="old",
         help="directory with original images for differential OTA (default: 'old')",
     )
+    parser.add_argument(
+        "--source",
+        action="append",
+        default=[],
+        metavar="PAYLOAD",
+        help="payload file or url producing the old images instead of --old, implies --diff; "
+             "repeat it for a chain of incremental payloads, oldest first",
+    )
+    parser.add_argument(
+        "--source-cache",
+        default="512M",
+        type=parse_size,
+        help="memory for operations decoded from --source payloads (default: 512M)",
+    )
     parser.add_argument(
         "--partitions",
         default="",
@@ -34,6 +60,92 @@ def main():
         type=int,
         help="number of workers (default: CPU count - %d)" % cpu_count(),
     )
+    parser.add_argument(
+        "--processes",
+        action="store_true",
+        help="decompress in worker processes instead of threads, for many cores",
+    )
+    parser.add_argument(
+        "--max-op-memory",
+        default="64M",
+        type=parse_size,
+        help="memory used by a worker for one operation, larger ones are decompressed in chunks (default: 64M)",
+    )
+    parser.add_argument(
+        "--max-memory",
+        default=None,
+        type=parse_size,
+        help="memory used by all operations being applied, more wait for earlier ones to finish (default: workers * --max-op-memory)",
+    )
+    parser.add_argument(
+        "--preallocate",
+        action="store_true",
+        help="allocate the disk space of each image up front to reduce fragmentation",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="check each image against the hash in the payload while it is written",
+    )
+    parser.add_argument(
+        "--hash-workers",
+        default=0,
+        type=int,
+        help="threads checking the hash of operation data alongside decompression (default: 0, checked inline)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="record finished operations in the output directory, and skip them when run again after an interruption",
+    )
+    parser.add_argument(
+        "--skip-existing",
+        action="store_true",
+        help="skip partitions whose image in the output directory matches the payload",
+    )
+    parser.add_argument(
+        "--stream",
+        choices=["tar", "raw"],
+        default=None,
+        help="write the images to --stream-out as a tar archive, or one after another with an "
+             "index.json in the output directory, instead of files in the output directory",
+    )
+    parser.add_argument(
+        "--stream-out",
+        default="-",
+        help="file or pipe written by --stream, - for stdout (default: -)",
+    )
+    parser.add_argument(
+        "--stream-window",
+        default="256M",
+        type=parse_size,
+        help="output of --stream, --compress or --simg kept in memory while earlier output is not ready "
+             "(default: 256M)",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=["zst", "xz"],
+        default=None,
+        help="write each image compressed, as <partition>.img.zst in the zstd seekable format or "
+             "<partition>.img.xz",
+    )
+    parser.add_argument(
+        "--compress-level",
+        default=None,
+        type=int,
+        help="compression level of --compress (default: 3 for zst, 6 for xz)",
+    )
+    parser.add_argument(
+        "--compress-workers",
+        default=None,
+        type=int,
+        help="threads compressing the images of --compress (default: --workers)",
+    )
+    parser.add_argument(
+        "--simg",
+        action="store_true",
+        help="write the images as android sparse images, for fastboot and other flashing tools",
+    )
     parser.add_argument(
         "--list",
         action="store_true",
@@ -45,22 +157,152 @@ def main():
         help="extract and display metadata file from the payload",
     )
     parser.add_argument("--header", action="append", nargs=2)
+    parser.add_argument(
+        "--mirror",
+        action="append",
+        default=[],
+        metavar="URL",
+        help="another url of the same payload, requests are spread over all urls (can be repeated)",
+    )
+    parser.add_argument(
+        "--pool-size",
+        default=None,
+        type=int,
+        help="number of connections to keep for a url (default: number of workers)",
+    )
+    parser.add_argument(
+        "--keepalive",
+        default=30.0,
+        type=float,
+        help="seconds to keep idle connections open (default: 30)",
+    )
+    parser.add_argument(
+        "--http2",
+        action="store_true",
+        help="multiplex requests over HTTP/2 connections (requires h2)",
+    )
+    parser.add_argument(
+        "--connection-stats",
+        action="store_true",
+        help="print the number of requests served by each connection",
+    )
+    parser.add_argument(
+        "--retries",
+        default=10,
+        type=int,
+        help="retries of a request without progress on network errors (default: 10)",
+    )
+    parser.add_argument(
+        "--retry-budget",
+        default=1000,
+        type=int,
+        help="total retries allowed for the whole run (default: 1000)",
+    )
+    parser.add_argument(
+        "--async-fetch",
+        action="store_true",
+        help="download from a url with an asyncio engine, independent of the number of workers",
+    )
+    parser.add_argument(
+        "--max-requests",
+        default=256,
+        type=int,
+        help="maximum concurrent requests of --async-fetch (default: 256)",
+    )
+    parser.add_argument(
+        "--max-inflight",
+        default="256M",
+        type=parse_size,
+        help="maximum bytes downloaded by --async-fetch but not yet written (default: 256M)",
+    )
+    parser.add_argument(
+        "--readahead",
+        default="0",
+        type=parse_size,
+        help="read this many bytes ahead of sequential reads, e.g. 64M (default: disabled)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="cache ranges downloaded from a url in this directory (default: disabled)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        default="4G",
+        type=parse_size,
+        help="maximum size of the download cache (default: 4G)",
+    )
+    parser.add_argument(
+        "--index-dir",
+        default=None,
+        help="save the index of a deflated payload.bin in this directory (default: --cache-dir)",
+    )
     args = parser.parse_args()
+    outputs = [name for name, value in (("stream", args.stream), ("compress", args.compress), ("simg", args.simg))
+               if value]
+    if len(outputs) > 1:
+        parser.error("--%s can't be used with --%s" % (outputs[0], outputs[1]))
+    if len(outputs) > 0 and (args.resume or args.skip_existing or args.processes):
+        parser.error("--%s can't be used with --resume, --skip-existing or --processes" % outputs[0])
 
     # Check for --out directory exists
     if not os.path.exists(args.out):
         os.makedirs(args.out)
 
-    payload_file = args.payloadfile
-    if payload_file.startswith("http://") or payload_file.startswith("https://"):
+    stream_out = None
+    if args.stream is not None:
+        if args.stream_out == "-":
+            # the stream takes stdout, what is printed goes to stderr
+            sys.stdout.flush()
+            fd = os.dup(sys.stdout.fileno())
+            os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+            if sys.platform == 'win32':
+                import msvcrt
+                msvcrt.setmode(fd, os.O_BINARY)
+            stream_out = os.fdopen(fd, "wb")
+        else:
+            stream_out = open(args.stream_out, "wb")
+
+    def is_url(path):
+        return path.startswith("http://") or path.startswith("https://")
+
+    remote = None
+    fetch_engine = None
+    pool = None
+    if is_url(args.payloadfile) or any(is_url(source) for source in args.source):
         headers = None
         if args.header is not None:
             headers = {}
             for k, v in args.header:
                 headers[k] = v
-        payload_file = http_file.HttpRangeFileMTIO(payload_file, headers=headers)
+        cache = None
+        if args.cache_dir is not None:
+            cache = RangeCache(args.cache_dir, args.cache_size)
+        pool_size = args.pool_size if args.pool_size is not None else args.workers
+        pool = http_file.ConnectionPool(pool_size, args.keepalive, args.http2, headers=headers)
+        retry = http_file.RetryPolicy(args.retries, args.retry_budget)
+
+    # urls share the connection pool and the download cache
+    def open_file(path):
+        if is_url(path):
+            return http_file.HttpRangeFileMTIO(path, cache=cache, pool=pool, retry=retry)
+        return mtio.MTFile(path, "r")
+
+    payload_file = args.payloadfile
+    if is_url(payload_file):
+        if len(args.mirror) > 0:
+            payload_file = remote = http_file.MultiHttpRangeFileMTIO(
+                [payload_file] + args.mirror, cache=cache, pool=pool, retry=retry
+            )
+        else:
+            payload_file = remote = open_file(payload_file)
+        if args.async_fetch:
+            fetch_engine = AsyncFetchEngine(payload_file, args.max_requests, args.max_inflight, args.http2)
     else:
-        payload_file = mtio.MTFile(payload_file, "r")
+        payload_file = open_file(payload_file)
+    if args.readahead > 0:
+        payload_file = mtio.ReadaheadMTIO(payload_file, args.readahead)
+    sources = [open_file(source) for source in args.source]
     dumper = Dumper(
         payload_file,
         args.out,
@@ -70,9 +312,46 @@ def main():
         workers=args.workers,
         list_partitions=args.list,
         extract_metadata=args.metadata,
+        fetch_engine=fetch_engine,
+        index_dir=args.index_dir if args.index_dir is not None else args.cache_dir,
+        processes=args.processes,
+        max_op_memory=args.max_op_memory,
+        max_memory=args.max_memory,
+        preallocate=args.preallocate,
+        verify=args.verify,
+        hash_workers=args.hash_workers,
+        resume=args.resume,
+        skip_existing=args.skip_existing,
+        sources=sources,
+        source_cache=args.source_cache,
+        stream=args.stream,
+        stream_out=stream_out,
+        stream_window=args.stream_window,
+        compress=args.compress,
+        compress_level=args.compress_level,
+        compress_workers=args.compress_workers,
+        simg=args.simg,
     )
 
     dumper.run()
+    if stream_out is not None:
+        stream_out.close()
+    if fetch_engine is not None:
+        fetch_engine.close()
+
+    if remote is not None:
+        print("\ntotal bytes read from network:", remote.transferred_bytes)
+        print("total requests:", remote.request_count)
+        print("retries:", remote.retry.summary())
+        if isinstance(remote, http_file.MultiHttpRangeFileMTIO):
+            for line in remote.mirror_details():
+                print("mirror", line)
+        print("connections:", pool.stats.summary())
+        if args.connection_stats:
+            for line in pool.stats.details():
+                print(line)
+    if pool is not None:
+        pool.close()
 
-    if isinstance(payload_file, http_file.HttpRangeFileMTIO):
-        print("\ntotal bytes read from network:", payload_file.transferred_bytes)
+    if len(dumper.mismatched) > 0:
+        sys.exit(1)
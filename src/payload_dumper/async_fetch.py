@@ -0,0 +1,186 @@
+import asyncio
+import time
+from threading import Thread
+
+import httpx
+
+from .http_file import TRANSIENT_ERRORS, HttpRangeFileMTIO, MultiHttpRangeFileMTIO, check_status
+
+
+class _ByteBudget:
+    # created on the event loop, a request larger than the limit is admitted alone
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.cond = asyncio.Condition()
+
+    async def acquire(self, n: int):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.used == 0 or self.used + n <= self.limit)
+            self.used += n
+
+    async def release(self, n: int):
+        async with self.cond:
+            self.used -= n
+            self.cond.notify_all()
+
+
+class AsyncFetchEngine:
+    """
+    Fetch ranges of a remote file with httpx.AsyncClient on a background event loop.
+    Up to `max_requests` requests are in flight, as long as the fetched buffers which
+    have not been released by their consumers stay below `max_inflight_bytes`.
+    Network concurrency is therefore independent of the number of CPU workers.
+    """
+
+    def __init__(self, remote: HttpRangeFileMTIO, max_requests: int = 256,
+                 max_inflight_bytes: int = 256 * 1024 * 1024, http2: bool = False):
+        self.remote = remote
+        self.max_requests = max_requests
+        self.max_inflight_bytes = max_inflight_bytes
+        self.http2 = http2
+        self.client = None
+        self.budget = None
+        self.slots = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, name='async-fetch', daemon=True)
+        self.thread.start()
+
+    async def _setup(self):
+        if self.client is not None:
+            return
+        limits = httpx.Limits(max_connections=self.max_requests, max_keepalive_connections=self.max_requests)
+        self.client = httpx.AsyncClient(
+            limits=limits,
+            timeout=httpx.Timeout(5.0, pool=None),
+            http2=self.http2,
+            headers=self.remote.client.headers,
+            event_hooks={"response": [self._record]},
+        )
+        self.budget = _ByteBudget(self.max_inflight_bytes)
+        self.slots = asyncio.Semaphore(self.max_requests)
+
+    async def _record(self, response: httpx.Response):
+        self.remote.pool.stats.record(response)
+
+    async def _download_range(self, off: int, end: int, buf):
+        received = 0
+        attempt = 0
+        retry = self.remote.retry
+        mirrors = isinstance(self.remote, MultiHttpRangeFileMTIO)
+        while off + received < end:
+            attempt_start = received
+            size = end - off - received
+            remote = self.remote
+            if mirrors:
+                mirror = self.remote.acquire_mirror(size)
+                remote = mirror.file
+            start = time.monotonic()
+            failed = True
+            try:
+                async with self.slots:
+                    start = time.monotonic()
+                    remote._count_request()
+                    headers = {"Range": f"bytes={off + received}-{end - 1}"}
+                    async with self.client.stream("GET", remote.url, headers=headers) as r:
+                        check_status(r, remote.url)
+                        async for chunk in r.aiter_bytes(65536):
+                            buf[received:received + len(chunk)] = chunk
+                            received += len(chunk)
+                failed = False
+            except TRANSIENT_ERRORS as e:
+                if mirrors:
+                    self.remote.release_mirror(mirror, size, received - attempt_start,
+                                               time.monotonic() - start, True)
+                    mirror = None
+                if received > attempt_start:
+                    attempt = 0
+                attempt += 1
+                d = retry.delay(attempt, e)
+                # another mirror can take over right away
+                if not mirrors or not self.remote._mirror_available():
+                    await asyncio.sleep(d)
+                retry.resume(received)
+            finally:
+                with remote.lock:
+                    remote.transferred_bytes += received - attempt_start
+                if mirrors and mirror is not None:
+                    self.remote.release_mirror(mirror, size, received - attempt_start,
+                                               time.monotonic() - start, failed)
+
+    async def _fetch_one(self, key, off: int, size: int, on_fetched, buffers):
+        # allocating buffers and the cache's disk I/O run off the event loop
+        loop = asyncio.get_running_loop()
+        if buffers is None:
+            block = buf = await loop.run_in_executor(None, bytearray, size)
+        else:
+            block = await loop.run_in_executor(None, buffers.acquire, size)
+            buf = memoryview(block)[:size]
+        try:
+            cache = self.remote.cache
+            if cache is None:
+                await self._download_range(off, off + size, buf)
+            else:
+                mem = memoryview(buf)
+                for start, end in await loop.run_in_executor(None, cache.lookup, off, off + size, mem):
+                    await self._download_range(start, end, mem[start - off:end - off])
+                    await loop.run_in_executor(None, cache.store, start, mem[start - off:end - off])
+        except BaseException:
+            if buffers is not None:
+                buffers.release(block)
+            await self.budget.release(size)
+            raise
+
+        def release():
+            if buffers is not None:
+                buffers.release(block)
+            asyncio.run_coroutine_threadsafe(self.budget.release(size), self.loop)
+
+        on_fetched(key, buf, release)
+
+    async def _fetch_all(self, items, on_fetched, buffers):
+        await self._setup()
+        pending = set()
+        errors = []
+
+        def done(t):
+            pending.discard(t)
+            if not t.cancelled() and t.exception() is not None:
+                errors.append(t.exception())
+
+        try:
+            for key, off, size in items:
+                await self.budget.acquire(size)
+                if len(errors) > 0:
+                    await self.budget.release(size)
+                    raise errors[0]
+                t = asyncio.create_task(self._fetch_one(key, off, size, on_fetched, buffers))
+                pending.add(t)
+                t.add_done_callback(done)
+            while len(pending) > 0:
+                await asyncio.wait(set(pending), return_when=asyncio.FIRST_EXCEPTION)
+                if len(errors) > 0:
+                    raise errors[0]
+        finally:
+            for t in list(pending):
+                t.cancel()
+
+    def fetch_all(self, items, on_fetched, buffers=None):
+        """
+        Fetch every (key, off, size) of items, roughly in order. on_fetched(key, data, release)
+        runs on the event loop thread, it should hand data to another thread and call
+        release() once data is no longer used. Buffers are taken from the BufferPool
+        `buffers` if given.
+        """
+        future = asyncio.run_coroutine_threadsafe(self._fetch_all(items, on_fetched, buffers), self.loop)
+        return future.result()
+
+    async def _close(self):
+        if self.client is not None:
+            await self.client.aclose()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
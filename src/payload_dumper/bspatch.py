@@ -0,0 +1,177 @@
+import bz2
+
+import brotli
+import bsdiff4.core
+
+BSDIFF_MAGIC = b'BSDIFF40'
+BSDF2_MAGIC = b'BSDF2'
+HEADER_SIZE = 32
+
+# compressed bytes fed to a decompressor at once
+INPUT_SIZE = 64 * 1024
+
+# brotli before 1.2 can't limit its output, it gets smaller inputs instead
+_BROTLI_LIMIT = hasattr(brotli.Decompressor, 'can_accept_more_data')
+_BROTLI_INPUT_SIZE = 4 * 1024
+
+
+class _Stream:
+    """
+    One of the control, diff and extra streams of a patch, decompressed as it is read,
+    about `chunk_size` bytes at a time.
+    """
+
+    def __init__(self, alg: int, data: memoryview, chunk_size: int):
+        if alg not in (0, 1, 2):
+            raise ValueError(f'unknown algorithm {alg}')
+        self.alg = alg
+        self.data = data
+        self.chunk_size = chunk_size
+        self.in_pos = 0
+        self.buf = b''
+        self.pos = 0
+        if alg == 1:
+            self.dec = bz2.BZ2Decompressor()
+        elif alg == 2:
+            self.dec = brotli.Decompressor()
+
+    def _input(self, size: int):
+        data = self.data[self.in_pos:self.in_pos + size]
+        self.in_pos += len(data)
+        return data
+
+    # the next decompressed piece, empty at the end of the stream
+    def _more(self) -> bytes:
+        while True:
+            if self.alg == 0:
+                return bytes(self._input(self.chunk_size))
+            if self.alg == 1:
+                if self.dec.eof:
+                    return b''
+                data = self._input(INPUT_SIZE) if self.dec.needs_input else b''
+                if self.dec.needs_input and len(data) == 0:
+                    raise ValueError('truncated bzip2 stream in patch')
+                out = self.dec.decompress(data, self.chunk_size)
+            else:
+                if self.dec.is_finished():
+                    return b''
+                if _BROTLI_LIMIT:
+                    data = self._input(INPUT_SIZE) if self.dec.can_accept_more_data() else b''
+                    out = self.dec.process(data, output_buffer_limit=self.chunk_size)
+                else:
+                    data = self._input(_BROTLI_INPUT_SIZE)
+                    out = self.dec.process(data)
+                if len(out) == 0 and len(data) == 0 and not self.dec.is_finished():
+                    raise ValueError('truncated brotli stream in patch')
+            if len(out) > 0:
+                return out
+
+    def read(self, n: int) -> bytes:
+        if self.pos + n <= len(self.buf):
+            self.pos += n
+            return self.buf[self.pos - n:self.pos]
+        parts = [self.buf[self.pos:]]
+        got = len(parts[0])
+        while got < n:
+            self.buf = self._more()
+            if len(self.buf) == 0:
+                raise ValueError(f'patch stream ends {n - got} bytes early')
+            self.pos = min(n - got, len(self.buf))
+            parts.append(self.buf[:self.pos])
+            got += self.pos
+        return b''.join(parts)
+
+
+def patch_size(data) -> int:
+    return bsdiff4.core.decode_int64(bytes(data[24:HEADER_SIZE]))
+
+
+def apply_patch(data, src, write, chunk_size: int):
+    """
+    Apply a bsdiff or BSDF2 patch to the buffer `src`, passing the output to `write`
+    in pieces of up to `chunk_size` bytes. The streams of the patch are decompressed
+    as the output is produced, so only the patch, the source and a few pieces are
+    held at once.
+    """
+    data = memoryview(data)
+    src = memoryview(src)
+    magic = bytes(data[:8])
+    if magic == BSDIFF_MAGIC:
+        algs = (1, 1, 1)
+    elif magic[:5] == BSDF2_MAGIC:
+        algs = (magic[5], magic[6], magic[7])
+    else:
+        raise ValueError("incorrect magic bsdiff/BSDF2 header")
+    len_control = bsdiff4.core.decode_int64(bytes(data[8:16]))
+    len_diff = bsdiff4.core.decode_int64(bytes(data[16:24]))
+    len_dst = patch_size(data)
+    pos = HEADER_SIZE
+    control = _Stream(algs[0], data[pos:pos + len_control], chunk_size)
+    pos += len_control
+    diff = _Stream(algs[1], data[pos:pos + len_diff], chunk_size)
+    extra = _Stream(algs[2], data[pos + len_diff:], chunk_size)
+
+    # triples are gathered until they produce chunk_size bytes, then patched at once
+    # against the parts of src they read, laid end to end
+    olds = []
+    triples = []
+    diffs = []
+    extras = []
+    size = 0
+
+    def flush():
+        nonlocal size
+        if size == 0:
+            return
+        old = b''.join(olds)
+        olds.clear()
+        out = bsdiff4.core.patch(old, size, triples, b''.join(diffs), b''.join(extras))
+        del old
+        triples.clear()
+        diffs.clear()
+        extras.clear()
+        size = 0
+        write(out)
+
+    old_pos = 0
+    new_pos = 0
+    while new_pos < len_dst:
+        triple = control.read(24)
+        x = bsdiff4.core.decode_int64(triple[0:8])
+        y = bsdiff4.core.decode_int64(triple[8:16])
+        z = bsdiff4.core.decode_int64(triple[16:24])
+        if x < 0 or y < 0 or new_pos + x + y > len_dst:
+            raise ValueError('corrupt patch control')
+        new_pos += x + y
+
+        # x bytes of diff added to src from old_pos
+        while x > 0:
+            n = min(x, chunk_size - size)
+            lo = max(old_pos, 0)
+            hi = min(old_pos + n, len(src))
+            if lo < hi:
+                # bytes outside of src are taken from the diff as is
+                olds.append(bytes(lo - old_pos))
+                olds.append(src[lo:hi])
+                olds.append(bytes(old_pos + n - hi))
+            else:
+                olds.append(bytes(n))
+            triples.append((n, 0, 0))
+            diffs.append(diff.read(n))
+            size += n
+            old_pos += n
+            x -= n
+            if size >= chunk_size:
+                flush()
+
+        # then y bytes of extra
+        while y > 0:
+            n = min(y, chunk_size - size)
+            triples.append((0, n, 0))
+            extras.append(extra.read(n))
+            size += n
+            y -= n
+            if size >= chunk_size:
+                flush()
+        old_pos += z
+    flush()
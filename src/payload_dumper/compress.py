@@ -0,0 +1,230 @@
+import lzma
+import os
+import struct
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock, Semaphore, local
+
+from zstd import ZSTD_compress
+
+from .stream import OrderedStream, StreamImage, add_whole_image
+
+try:
+    import zstandard
+except ImportError:
+    # frames are compressed with the zstd module
+    zstandard = None
+
+# uncompressed bytes of a frame by default
+FRAME_SIZE = 4 * 1024 * 1024
+
+# seek table of the zstd seekable format, in a skippable frame
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A5E
+ZSTD_SEEKABLE_MAGIC = 0x8F92EAB1
+
+_zstd_local = local()
+
+
+def compress_zstd(data, level: int) -> bytes:
+    if zstandard is None:
+        # one thread, frames are compressed in parallel already
+        return ZSTD_compress(bytes(data), level, 1)
+    # compressors can't be shared by threads
+    cctx = getattr(_zstd_local, "cctx", None)
+    if cctx is None or _zstd_local.level != level:
+        cctx = _zstd_local.cctx = zstandard.ZstdCompressor(level=level, write_content_size=True)
+        _zstd_local.level = level
+    return cctx.compress(data)
+
+
+def compress_xz(data, level: int) -> bytes:
+    return lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64, preset=level)
+
+
+# extension -> (compress function, default level)
+COMPRESSORS = {
+    "zst": (compress_zstd, 3),
+    "xz": (compress_xz, 6),
+}
+
+
+class FrameWriter:
+    """
+    Compress an image given in order as independent frames, on the threads of `output`,
+    and append them to `path` in order. A zst file is in the zstd seekable
+    format, an xz file is a series of xz streams of one block each. Frames of zeros
+    are compressed once per size. The file is complete once `size` bytes are written.
+    Data is given under the stream lock, so frames are only queued there; they are
+    written as they are compressed, and the file is closed by `output`.
+    """
+
+    def __init__(self, output: 'CompressedStream', path: str, size: int):
+        self.output = output
+        self.path = path
+        self.size = size
+        self.written = 0
+        self.f = open(path, "wb")
+        self.lock = Lock()
+        self.buf = bytearray()
+        # (future of the compressed frame, uncompressed size), in order
+        self.frames = deque()
+        # (compressed size, uncompressed size) of the frames written
+        self.table = []
+        self.finished = False
+        self.error = None
+
+    # the image is laid out whole, so off follows the previous write
+    def write(self, off: int, data):
+        mem = memoryview(data)
+        while len(mem) > 0:
+            n = min(len(mem), self.output.frame_size - len(self.buf))
+            self.buf += mem[:n]
+            mem = mem[n:]
+            self.written += n
+            if len(self.buf) == self.output.frame_size:
+                self._submit()
+        if self.written == self.size:
+            self.finish()
+            self.output.close_later(self)
+
+    def _submit(self):
+        data, self.buf = self.buf, bytearray()
+        self.frames.append((self.output.compress_frame(self, data), len(data)))
+
+    # queue the last frame, an empty image has one empty frame
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        if len(self.buf) > 0 or self.written == 0:
+            self._submit()
+
+    # write the frames compressed so far, in order
+    def drain(self):
+        with self.lock:
+            while len(self.frames) > 0 and self.frames[0][0].done():
+                future, size = self.frames.popleft()
+                frame = future.result()
+                self.f.write(frame)
+                self.table.append((len(frame), size))
+
+    # the frames must be submitted already
+    def close(self):
+        with self.lock:
+            if self.f.closed:
+                return
+            frames = list(self.frames)
+        for future, _ in frames:
+            future.result()
+        self.drain()
+        with self.lock:
+            if self.f.closed:
+                return
+            if self.error is not None:
+                self.f.close()
+                raise self.error
+            if self.output.ext == "zst":
+                entries = b"".join(struct.pack("<II", c, d) for c, d in self.table)
+                footer = struct.pack("<IBI", len(self.table), 0, ZSTD_SEEKABLE_MAGIC)
+                self.f.write(struct.pack("<II", ZSTD_SKIPPABLE_MAGIC, len(entries) + len(footer)) + entries + footer)
+            self.f.close()
+
+
+class CompressedStream(OrderedStream):
+    """
+    Images compressed to a file each, `<name>.<ext>` in `out_dir`, while they are
+    extracted. The images are laid out whole and given their data in order, and frames
+    are compressed by `workers` threads. Frames are submitted, and files closed, once
+    the stream lock is released, so waiting for a compression slot doesn't hold up
+    the stream.
+    """
+
+    def __init__(self, out_dir: str, ext: str, level, workers: int, window: int, frame_size: int = FRAME_SIZE):
+        super().__init__(None, window)
+        self.out_dir = out_dir
+        self.ext = ext
+        self.compress, default_level = COMPRESSORS[ext]
+        self.level = default_level if level is None else level
+        self.frame_size = frame_size
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="compress")
+        # frames held for compression, writers wait for a slot
+        self.slots = Semaphore(2 * max(workers, 1))
+        self.zero_frames = {}
+        self.zero_lock = Lock()
+        self.writers = []
+        # (writer, data, zeros, future) of frames to submit, writers to close
+        self.queue = deque()
+        self.to_close = []
+        self.queue_lock = Lock()
+
+    def add_image(self, name: str, size: int, data, hash: bool) -> StreamImage:
+        writer = FrameWriter(self, os.path.join(self.out_dir, "%s.%s" % (name, self.ext)), size)
+        self.writers.append(writer)
+        image = StreamImage(self, size, hash, writer)
+        add_whole_image(image, data)
+        return image
+
+    def finish_layout(self):
+        pass
+
+    # future of the compressed frame of data, queued until the stream lock is released
+    def compress_frame(self, writer: FrameWriter, data) -> Future:
+        future = Future()
+        zeros = data.count(0) == len(data)
+        frame = self.zero_frames.get(len(data)) if zeros else None
+        if frame is not None:
+            future.set_result(frame)
+            return future
+        with self.queue_lock:
+            self.queue.append((writer, data, zeros, future))
+        return future
+
+    def close_later(self, writer: FrameWriter):
+        with self.queue_lock:
+            self.to_close.append(writer)
+
+    def _compress(self, writer: FrameWriter, data, zeros: bool, future: Future):
+        try:
+            future.set_result(self._zero_frame(len(data)) if zeros else self.compress(data, self.level))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            self.slots.release()
+        try:
+            writer.drain()
+        except BaseException as e:
+            writer.error = e
+
+    def _zero_frame(self, size: int) -> bytes:
+        with self.zero_lock:
+            frame = self.zero_frames.get(size)
+            if frame is None:
+                frame = self.zero_frames[size] = self.compress(bytes(size), self.level)
+            return frame
+
+    def _after_emit(self):
+        while True:
+            with self.queue_lock:
+                if len(self.queue) == 0:
+                    break
+                item = self.queue.popleft()
+            self.slots.acquire()
+            self.executor.submit(self._compress, *item)
+        while True:
+            with self.queue_lock:
+                if len(self.to_close) == 0:
+                    break
+                writer = self.to_close.pop()
+            writer.close()
+
+    def close(self):
+        try:
+            super().close()
+            # images without data
+            for writer in self.writers:
+                writer.finish()
+            self._after_emit()
+            for writer in self.writers:
+                writer.close()
+        finally:
+            self.executor.shutdown()
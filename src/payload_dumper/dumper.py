@@ -1,89 +1,53 @@
 #!/usr/bin/env python
-import bz2
-import io
 import json
-import lzma
 import os
-import struct
 import sys
-from zstd import ZSTD_uncompress
 from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from concurrent import futures
 from multiprocessing import cpu_count
 from functools import partial
 import signal
 
-import bsdiff4.core
 from enlighten import get_manager
 
-import hashlib
-import brotli
-
 from . import mtio
-from . import update_metadata_pb2 as um
+from .journal import Journal, reset_journal
+from .payload import Payload
+from .process_engine import ProcessOpEngine
+from .source import DecodedCache, source_image
+from .compress import CompressedStream
+from .simg import SparseImageStream
+from .scheduler import ByteBudget, op_cost, op_memory, schedule_ops
+from .stream import STREAM_FORMATS, RawStream, data_ranges
+from .ops import (
+    DEFAULT_CHUNK_SIZE, STREAMING_TYPES, apply_op, apply_op_chunks,
+    ZERO_TYPES, read_chunks, verify_data_hash,
+)
 from .update_metadata_pb2 import InstallOperation
 from .ziputil import get_zip_stored_entry_offset
+from .verify import ImageVerifier, VerifyingMTIO, file_sha256, image_matches, remove_sidecar, uncovered_ranges, write_sidecar
 from .future_util import CombinedFuture, wait_interruptible
 
 
-def u32(x):
-    return struct.unpack(">I", x)[0]
-
-
-def u64(x):
-    return struct.unpack(">Q", x)[0]
-
-BSDF2_MAGIC = b'BSDF2'
-
-def bsdf2_decompress(alg, data):
-    if alg == 0:
-        return data
-    elif alg == 1:
-        return bz2.decompress(data)
-    elif alg == 2:
-        return brotli.decompress(data)
-    else:
-        raise ValueError(f'unknown algorithm {alg}')
-
-
-# Adapted from bsdiff4.read_patch
-def bsdf2_read_patch(fi):
-    """read a bsdiff/BSDF2-format patch from stream 'fi'
-    """
-    magic = fi.read(8)
-    if magic == bsdiff4.format.MAGIC:
-        # bsdiff4 uses bzip2 (algorithm 1)
-        alg_control = alg_diff = alg_extra = 1
-    elif magic[:5] == BSDF2_MAGIC:
-        alg_control = magic[5]
-        alg_diff = magic[6]
-        alg_extra = magic[7]
-    else:
-        raise ValueError("incorrect magic bsdiff/BSDF2 header")
-
-    # length headers
-    len_control = bsdiff4.core.decode_int64(fi.read(8))
-    len_diff = bsdiff4.core.decode_int64(fi.read(8))
-    len_dst = bsdiff4.core.decode_int64(fi.read(8))
-
-    # read the control header
-    bcontrol = bsdf2_decompress(alg_control, fi.read(len_control))
-    tcontrol = [(bsdiff4.core.decode_int64(bcontrol[i:i + 8]),
-                 bsdiff4.core.decode_int64(bcontrol[i + 8:i + 16]),
-                 bsdiff4.core.decode_int64(bcontrol[i + 16:i + 24]))
-                for i in range(0, len(bcontrol), 24)]
-
-    # read the diff and extra blocks
-    bdiff = bsdf2_decompress(alg_diff, fi.read(len_diff))
-    bextra = bsdf2_decompress(alg_extra, fi.read())
-    return len_dst, tcontrol, bdiff, bextra
-
-
-class Dumper:
+# free op data buffers kept for each worker
+OP_BUFFERS_PER_WORKER = 8 * 1024 * 1024
+
+# out of order writes kept by the verifier of an image
+VERIFY_BUFFER_SIZE = 32 * 1024 * 1024
+
+# out of order writes kept for the output stream by default
+STREAM_WINDOW = 256 * 1024 * 1024
+
+class Dumper(Payload):
     def __init__(
-        self, payloadfile, out, diff=None, old=None, images="", workers=cpu_count(), list_partitions=False, extract_metadata=False
+        self, payloadfile, out, diff=None, old=None, images="", workers=cpu_count(), list_partitions=False, extract_metadata=False,
+        fetch_engine=None, index_dir=None, processes=False, max_op_memory=4 * DEFAULT_CHUNK_SIZE, max_memory=None,
+        preallocate=False, verify=False, hash_workers=0, resume=False, skip_existing=False, sources=(),
+        source_cache=512 * 1024 * 1024, stream=None, stream_out=None, stream_window=STREAM_WINDOW,
+        compress=None, compress_level=None, compress_workers=None, simg=False,
     ):
-        self.payloadfile: mtio.MTIOBase = payloadfile
+        super().__init__(payloadfile, index_dir)
         self.manager = get_manager()
         self.out = out
         self.diff = diff
@@ -92,27 +56,62 @@ class Dumper:
         self.workers = workers
         self.list_partitions = list_partitions
         self.extract_metadata = extract_metadata
+        self.fetch_engine = fetch_engine
+        self.processes = processes
+        self.preallocate = preallocate
+        self.verify = verify
+        self.hash_workers = hash_workers
+        self.hash_executor = None
+        # partitions whose image hash did not match
+        self.mismatched = []
+        self.resume = resume
+        self.journal = None
+        self.skip_existing = skip_existing
+        self.op_engine = None
+        # images are written in this format to stream_out instead of files in out
+        self.stream = stream
+        self.stream_out = stream_out
+        self.stream_window = stream_window
+        # images are compressed to files with this extension instead
+        self.compress = compress
+        self.compress_level = compress_level
+        self.compress_workers = compress_workers if compress_workers is not None else workers
+        # or written as android sparse images
+        self.simg = simg
+        self.output = None
+        # ops with more data than this are read and decompressed in chunks
+        self.stream_threshold = max_op_memory // 2
+        self.chunk_size = max(max_op_memory // 4, 1)
+        # memory of the ops being applied, new ops wait for earlier ones to finish
+        if max_memory is None:
+            max_memory = max(self.workers, 1) * max_op_memory
+        self.budget = ByteBudget(max_memory)
+        # guards the count of remaining ops of partitions
+        self.partition_lock = Lock()
+        # op data buffers, reused across ops
+        self.buffers = mtio.BufferPool(max(self.workers, 1) * OP_BUFFERS_PER_WORKER)
+
+        # payloads producing the old images, oldest first
+        self.sources = []
+        self.source_cache = DecodedCache(source_cache)
 
         if self.extract_metadata:
             self.extract_and_display_metadata()
         else:
-            try:
-                off, size = get_zip_stored_entry_offset(self.payloadfile, 'payload.bin')
-                #print(f'payload.bin in zip {off=} {size=}')
-                self.base_off = off
-            except:
-                #from traceback import print_exc
-                #print_exc()
-                #print('not a zip')
-                self.base_off = 0
-
-            self.parse_metadata()
+            self.open()
+            for file in sources:
+                source = Payload(file, index_dir)
+                source.open()
+                self.sources.append(source)
+            if len(self.sources) > 0:
+                self.diff = True
 
             if self.list_partitions:
                 self.list_partitions_info()
 
     def run(self):
         if self.list_partitions or self.extract_metadata:
+            self.payloadfile.close()
             return
 
         if self.images == "":
@@ -134,12 +133,20 @@ class Dumper:
             print("Not operating on any partitions")
             return 0
 
+        if self.skip_existing:
+            partitions = self.skip_existing_partitions(partitions)
+            if len(partitions) == 0:
+                print("All partitions are up to date")
+                self.payloadfile.close()
+                return 0
+
         partitions_with_ops = []
         for partition in partitions:
             operations = []
-            for operation in partition.operations:
+            for index, operation in enumerate(partition.operations):
                 operations.append(
                     {
+                        "index": index,
                         "operation": operation,
                         "offset": self.data_offset + operation.data_offset,
                         "length": operation.data_length,
@@ -152,93 +159,354 @@ class Dumper:
                 }
             )
 
-        self.multiprocess_partitions(partitions_with_ops)
+        threads = self.workers
+        if self.simg:
+            self.output = SparseImageStream(self.out, self.block_size, self.stream_window)
+        elif self.compress is not None:
+            self.output = CompressedStream(
+                self.out, self.compress, self.compress_level, self.compress_workers, self.stream_window,
+            )
+        elif self.stream is not None:
+            self.output = STREAM_FORMATS[self.stream](self.stream_out, self.stream_window)
+        if self.resume:
+            self.journal = Journal(self.out, self.manifest_hash)
+        if self.hash_workers > 0:
+            self.hash_executor = ThreadPoolExecutor(max_workers=self.hash_workers, thread_name_prefix='hash')
+        if self.processes:
+            self.op_engine = ProcessOpEngine(
+                self.workers, self.block_size, self.diff, max(self.workers, 1) * OP_BUFFERS_PER_WORKER,
+                self.chunk_size, self.hash_executor,
+            )
+            # threads only read, twice as many keep the processes busy
+            threads = self.workers * 2
+        try:
+            self.multiprocess_partitions(partitions_with_ops, threads)
+        finally:
+            if self.op_engine is not None:
+                self.op_engine.close()
+            if self.hash_executor is not None:
+                self.hash_executor.shutdown()
+            if self.journal is not None:
+                self.journal.close()
         self.manager.stop()
         self.payloadfile.close()
+        for source in self.sources:
+            source.payloadfile.close()
         # make progressbar not overlaid by shell prompt
         print()
+        for part in partitions_with_ops:
+            if self.output is not None and part["image"].sha is not None:
+                part["verified"] = part["image"].digest() == part["partition"].new_partition_info.hash
+            if "verified" not in part:
+                continue
+            partition_name = part["partition"].partition_name
+            if part["verified"]:
+                print("%s: hash ok" % partition_name)
+            else:
+                print("%s: hash mismatch" % partition_name)
+                self.mismatched.append(partition_name)
+
+    # drop the partitions whose image is extracted already
+    def skip_existing_partitions(self, partitions):
+        def matches(partition):
+            info = partition.new_partition_info
+            if not info.hash:
+                return False
+            return image_matches("%s/%s.img" % (self.out, partition.partition_name), info.size, info.hash)
+
+        # images without a sidecar are hashed, in parallel
+        with ThreadPoolExecutor(max_workers=max(self.workers, 1)) as executor:
+            results = list(executor.map(matches, partitions))
+        remaining = []
+        for partition, ok in zip(partitions, results):
+            if ok:
+                print("%s: up to date, skipped" % partition.partition_name)
+            else:
+                remaining.append(partition)
+        return remaining
 
-    def multiprocess_partitions(self, partitions):
-        with ThreadPoolExecutor(max_workers=self.workers) as executor:
-            for part in partitions:
-                try:
-                    partition_name = part["partition"].partition_name
-                    bar = self.manager.counter(
-                        total=len(part["operations"]),
-                        desc=f"{partition_name}",
-                        unit="ops",
+    # ops of all partitions share the executor, each partition is closed after its last op
+    def multiprocess_partitions(self, partitions, threads):
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            try:
+                for part in partitions:
+                    self.open_partition(part)
+                if self.output is not None:
+                    self.output.finish_layout()
+                    if isinstance(self.output, RawStream):
+                        self.output.write_index(os.path.join(self.out, "index.json"))
+                ops = self.schedule_ops(partitions)
+
+                if self.fetch_engine is not None:
+                    tasks = self.fetch_and_submit_ops(executor, ops)
+                else:
+                    self.payloadfile.plan_reads(
+                        (self.base_off + op["offset"], op["length"]) for op in ops if not self.is_streamed(op)
                     )
-
-                    out_file = mtio.MTFile("%s/%s.img" % (self.out, partition_name), "w")
-
-                    if self.diff:
-                        old_file = mtio.MTFile("%s/%s.img" % (self.old, partition_name), "rb")
-                    else:
-                        old_file = None
-
-                    ops = part['operations']
                     tasks = []
+                    failed = []
                     for op in ops:
-                        tasks.append(
-                            executor.submit(
-                                self.do_op,
-                                partition_name,
-                                op,
-                                out_file, old_file, bar
-                            )
-                        )
-
-                    dones, _ = wait_interruptible(tasks, return_when=futures.FIRST_EXCEPTION)
-                    for t in dones:
-                        e = t.exception(0)
-                        if e is not None:
-                            raise e
-
-                    out_file.close()
-                    if old_file is not None:
-                        old_file.close()
-                    bar.close()
-                except KeyboardInterrupt:
-                    try:
-                        bar.close()
-                        self.manager.stop()
-                    except:
-                        pass
-                    print('Stopping ...')
-                    if sys.platform == 'win32':
-                        os.kill(os.getpid(), signal.CTRL_BREAK_EVENT)
-                    else:
-                        os.kill(os.getpid(), signal.SIGKILL)
-                    sys.exit(1)
-
-
-    def parse_metadata(self):
-        head_len = 4 + 8 + 8 + 4
-        fp = self.base_off
-        buffer = self.payloadfile.read(fp, head_len)
-        fp += head_len
-        assert len(buffer) == head_len
-        magic = buffer[:4]
-        assert magic == b"CrAU"
-
-        file_format_version = u64(buffer[4:12])
-        assert file_format_version == 2
-
-        manifest_size = u64(buffer[12:20])
-
-        metadata_signature_size = 0
+                        if len(failed) > 0:
+                            break
+                        t = self.submit_op(executor, op)
+                        t.add_done_callback(lambda t: t.exception() is not None and failed.append(t))
+                        tasks.append(t)
+
+                dones, _ = wait_interruptible(tasks, return_when=futures.FIRST_EXCEPTION)
+                for t in dones:
+                    e = t.exception(0)
+                    if e is not None:
+                        raise e
+                if self.output is not None:
+                    self.output.close()
+            except KeyboardInterrupt:
+                try:
+                    # keep the ops finished so far for the next run
+                    if self.journal is not None:
+                        self.journal.flush()
+                    for part in partitions:
+                        if part.get("remaining", 0) > 0:
+                            part["bar"].close()
+                    self.manager.stop()
+                except:
+                    pass
+                print('Stopping ...')
+                if sys.platform == 'win32':
+                    os.kill(os.getpid(), signal.CTRL_BREAK_EVENT)
+                else:
+                    os.kill(os.getpid(), signal.SIGKILL)
+                sys.exit(1)
+
+    def open_partition(self, part):
+        partition_name = part["partition"].partition_name
+        path = part["path"] = "%s/%s.img" % (self.out, partition_name)
+        if self.skip_existing:
+            remove_sidecar(path)
+        finished = set()
+        if self.journal is not None:
+            finished = self.journal.finished_ops(partition_name, path)
+        if len(finished) == 0:
+            # the image is written over, earlier records of it don't hold
+            if self.journal is not None:
+                self.journal.reset(partition_name)
+            else:
+                reset_journal(self.out, partition_name)
+        part["todo"] = [op for op in part["operations"] if op["index"] not in finished]
+        part["bar"] = self.manager.counter(
+            total=len(part["operations"]),
+            count=len(part["operations"]) - len(part["todo"]),
+            desc=f"{partition_name}",
+            unit="ops",
+        )
+        if self.output is not None:
+            self.open_stream_image(part)
+        else:
+            self.open_image(part, finished)
+        if len(self.sources) > 0:
+            part["old_file"] = source_image(self.sources, partition_name, self.source_cache)
+            if part["old_file"] is None and any(len(op.src_extents) > 0 for op in part["partition"].operations):
+                raise ValueError("Partition %s is not in every source payload" % partition_name)
+        elif self.diff:
+            part["old_file"] = mtio.MTFile("%s/%s.img" % (self.old, partition_name), "rb")
+        else:
+            part["old_file"] = None
+        part["remaining"] = len(part["todo"])
+        for op in part["operations"]:
+            op["part"] = part
+            if op["index"] in finished:
+                self.mark_written(op)
+        if part["remaining"] == 0:
+            self.close_partition(part)
+
+    def open_image(self, part, finished):
+        path = part["path"]
+        # continue an interrupted extraction in place
+        out_file = part["out_file"] = mtio.MTFile(path, "r+" if len(finished) > 0 else "w")
+        size = part["partition"].new_partition_info.size
+        if size > 0:
+            if not self.preallocate or not out_file.preallocate(size):
+                out_file.set_sparse(True)
+                out_file.set_size(size)
+        if self.journal is not None:
+            self.journal.opened(part["partition"].partition_name, path)
+        # nothing written yet, so the image reads as zeros
+        part["fresh"] = len(finished) == 0
+        part["image"] = out_file
+        part["verifier"] = None
+        expected = part["partition"].new_partition_info.hash
+        if self.verify and size > 0 and expected:
+            # out_file is write only, ranges are read back through another handle
+            reader = mtio.MTFile(path, "r")
+            verifier = part["verifier"] = ImageVerifier(reader, size, expected, VERIFY_BUFFER_SIZE)
+            part["out_file"] = VerifyingMTIO(out_file, verifier)
+            extents = (e for op in part["operations"] for e in op["operation"].dst_extents)
+            for off, n in uncovered_ranges(extents, self.block_size, size):
+                verifier.done(off, n)
+
+    # lay the image out in the output stream, where it is hashed
+    def open_stream_image(self, part):
+        partition = part["partition"]
+        size = partition.new_partition_info.size
+        if size == 0:
+            size = max((e.start_block + e.num_blocks for op in partition.operations for e in op.dst_extents),
+                       default=0) * self.block_size
+        # zeroed extents are holes
+        extents = (e for op in partition.operations if op.type not in ZERO_TYPES for e in op.dst_extents)
+        image = self.output.add_image(
+            partition.partition_name + ".img", size, data_ranges(extents, self.block_size, size),
+            self.verify and bool(partition.new_partition_info.hash),
+        )
+        part["out_file"] = part["image"] = image
+        part["fresh"] = True
+        part["verifier"] = None
+        for op in part["operations"]:
+            if op["operation"].type not in ZERO_TYPES:
+                start, end = image.stream_range(op["operation"].dst_extents, self.block_size)
+                if start is not None:
+                    op["stream_range"] = (start, end)
+
+    def close_partition(self, part):
+        # planned reads the ops didn't make, their data was cached, no longer hold buffers
+        self.payloadfile.unplan_reads((self.base_off + op["offset"], op["length"]) for op in part["todo"])
+        if self.journal is not None:
+            # records of the partition are written before its image is closed
+            self.journal.flush()
+        if part["verifier"] is not None:
+            part["verified"] = part["verifier"].finish()
+            part["verifier"].file.close()
+        part["out_file"].close()
+        if part["old_file"] is not None:
+            part["old_file"].close()
+        part["bar"].close()
+        expected = part["partition"].new_partition_info.hash
+        if self.skip_existing and expected:
+            if "verified" not in part:
+                # ops without data, or reading the old image, are not checked by their op hashes
+                part["verified"] = file_sha256(part["path"]) == expected
+            if part["verified"]:
+                write_sidecar(part["path"], expected)
+
+    def op_done(self, op):
+        part = op["part"]
+        if self.journal is not None:
+            self.journal.record(part["partition"].partition_name, op["index"], part["image"])
+        if "stream_range" in op:
+            # what the op did not write is zeros
+            for ext in op["operation"].dst_extents:
+                part["image"].done(ext.start_block * self.block_size, ext.num_blocks * self.block_size)
+        part["bar"].update(1)
+        with self.partition_lock:
+            part["remaining"] -= 1
+            last = part["remaining"] == 0
+        if last:
+            self.close_partition(part)
+
+    # the ops of all partitions, in the order they are submitted
+    def schedule_ops(self, partitions):
+        if self.output is not None:
+            # the stream is written in order, so are the ops
+            return sorted(
+                (op for part in partitions for op in part["todo"]),
+                key=lambda op: op.get("stream_range", (-1, -1))[0],
+            )
+        return schedule_ops(
+            (
+                (op_cost(op["operation"], op["length"], self.block_size), op["offset"], op)
+                for part in partitions for op in part["todo"]
+            ),
+            self.workers,
+        )
+
+    # the fetch engine downloads op data concurrently and the executor only decompresses and writes
+    def fetch_and_submit_ops(self, executor, ops):
+        tasks = []
+        failed = []
+
+        def track(t):
+            t.add_done_callback(lambda t: t.exception() is not None and failed.append(t))
+            tasks.append(t)
+
+        def on_fetched(op, data, release):
+            if len(failed) > 0:
+                # stops the fetch engine, the rest is not downloaded
+                release()
+                raise failed[0].exception()
+            t = executor.submit(self.do_op, op, data)
+            t.add_done_callback(lambda _: release())
+            track(t)
+
+        batches = [(ops, None)]
+        if self.output is not None:
+            batches = self.stream_batches(ops)
+        for batch, stream_range in batches:
+            if len(failed) > 0:
+                raise failed[0].exception()
+            if stream_range is not None:
+                self.output.admit(*stream_range)
+            items = []
+            for op in batch:
+                if op["length"] == 0 or self.is_streamed(op):
+                    track(self.submit_op(executor, op, admit=False))
+                else:
+                    items.append((op, self.base_off + op["offset"], op["length"]))
+
+            self.fetch_engine.fetch_all(items, on_fetched, self.buffers)
+        return tasks
+
+    # ops in batches spanning half of the stream window, with the stream range of each
+    def stream_batches(self, ops):
+        batch = []
+        start = end = None
+        for op in ops:
+            r = op.get("stream_range")
+            if r is not None and start is not None and max(end, r[1]) - start > self.output.window // 2:
+                yield batch, (start, end)
+                batch = []
+                start = end = None
+            batch.append(op)
+            if r is not None:
+                start = r[0] if start is None else start
+                end = r[1] if end is None else max(end, r[1])
+        if len(batch) > 0:
+            yield batch, None if start is None else (start, end)
+
+    # blocks until the memory of op fits in the budget, and its output in the stream window
+    def submit_op(self, executor, op, admit=True):
+        if admit and "stream_range" in op:
+            self.output.admit(*op["stream_range"])
+        n = self.op_memory(op)
+        self.budget.acquire(n)
+        t = executor.submit(self.do_op, op)
+        t.add_done_callback(lambda _: self.budget.release(n))
+        return t
+
+    # extents of a new image are zeros already, preallocated ones are given back as holes
+    def zero_fresh(self, op, out_file: mtio.MTIOBase):
+        if not self.preallocate:
+            return
+        for ext in op["operation"].dst_extents:
+            out_file.punch_hole(ext.start_block * self.block_size, ext.num_blocks * self.block_size)
+
+    # ops reading a source payload stay in this process
+    def use_op_engine(self, op, old_file) -> bool:
+        if self.op_engine is None or self.is_streamed(op):
+            return False
+        return len(op["operation"].src_extents) == 0 or old_file.path is not None
+
+    # tell the verifier about extents whose writes it did not see
+    def mark_written(self, op):
+        verifier = op["part"]["verifier"]
+        if verifier is None:
+            return
+        for ext in op["operation"].dst_extents:
+            verifier.done(ext.start_block * self.block_size, ext.num_blocks * self.block_size)
 
-        if file_format_version > 1:
-            metadata_signature_size = u32(buffer[20:24])
+    def op_memory(self, op) -> int:
+        return op_memory(op["operation"], op["length"], self.block_size, self.chunk_size, self.is_streamed(op))
 
-        manifest = self.payloadfile.read(fp, manifest_size)
-        fp += manifest_size
-        self.metadata_signature = self.payloadfile.read(fp, metadata_signature_size)
-        fp += metadata_signature_size
-        self.data_offset = fp - self.base_off
-        self.dam = um.DeltaArchiveManifest()
-        self.dam.ParseFromString(manifest)
-        self.block_size = self.dam.block_size
+    # too large to be read at once
+    def is_streamed(self, operation) -> bool:
+        return operation["length"] > self.stream_threshold and operation["operation"].type in STREAMING_TYPES
 
     def data_for_op(self, operation, out_file: mtio.MTIOBase, old_file: mtio.MTIOBase):
         offset = operation["offset"]
@@ -246,64 +514,53 @@ class Dumper:
         op = operation["operation"]
         op: InstallOperation
 
-        data = self.payloadfile.read(self.base_off + offset, length)
-
-        if op.data_sha256_hash:
-            assert hashlib.sha256(data).digest() == op.data_sha256_hash, 'operation data hash mismatch'
-
-        if op.type == InstallOperation.REPLACE_XZ:
-            dec = lzma.LZMADecompressor()
-            data = dec.decompress(data)
-            assert op.dst_extents[0].num_blocks * self.block_size == len(data)
-            out_file.write(op.dst_extents[0].start_block * self.block_size, data)
-        elif op.type == InstallOperation.REPLACE_BZ:
-            dec = bz2.BZ2Decompressor()
-            data = dec.decompress(data)
-            assert op.dst_extents[0].num_blocks * self.block_size == len(data)
-            out_file.write(op.dst_extents[0].start_block * self.block_size, data)
-        elif op.type == InstallOperation.REPLACE:
-            out_file.write(op.dst_extents[0].start_block * self.block_size, data)
-        elif op.type == InstallOperation.SOURCE_COPY:
-            if not self.diff:
-                print("SOURCE_COPY supported only for differential OTA")
-                sys.exit(-2)
-            for ext in op.src_extents:
-                data = old_file.read(ext.start_block * self.block_size, ext.num_blocks * self.block_size)
-                out_file.write(op.dst_extents[0].start_block * self.block_size, data)
-        elif op.type in (InstallOperation.SOURCE_BSDIFF, InstallOperation.BROTLI_BSDIFF):
-            if not self.diff:
-                print("SOURCE_BSDIFF supported only for differential OTA")
-                sys.exit(-3)
-            tmp_buff = io.BytesIO()
-            for ext in op.src_extents:
-                old_data = old_file.read(ext.start_block * self.block_size, ext.num_blocks * self.block_size)
-                tmp_buff.write(old_data)
-            tmp_buff.seek(0)
-            old_data = tmp_buff.read()
-            tmp_buff.seek(0)
-            tmp_buff.write(bsdiff4.core.patch(old_data, *bsdf2_read_patch(io.BytesIO(data))))
-            n = 0
-            tmp_buff.seek(0)
-            for ext in InstallOperation.dst_extents:
-                tmp_buff.seek(n * self.block_size)
-                n += ext.num_blocks
-                data = tmp_buff.read(ext.num_blocks * self.block_size)
-                out_file.write(ext.start_block * self.block_size, data)
-        elif op.type == InstallOperation.ZERO:
-            for ext in op.dst_extents:
-                out_file.write(ext.start_block * self.block_size, b"\x00" * ext.num_blocks * self.block_size)
-        elif op.type == InstallOperation.ZSTD:
-            data = ZSTD_uncompress(data)
-            assert op.dst_extents[0].num_blocks * self.block_size == len(data)
-            out_file.write(op.dst_extents[0].start_block * self.block_size, data)
-        else:
-            raise ValueError("Unsupported type = %d" % op.type)
+        if self.is_streamed(operation):
+            with self.buffers.lease(self.chunk_size) as buf:
+                chunks = read_chunks(self.payloadfile, self.base_off + offset, length, buf)
+                apply_op_chunks(op, chunks, out_file, self.block_size, self.chunk_size)
+            return
+
+        with self.buffers.lease(length) as data:
+            n = self.payloadfile.readinto(self.base_off + offset, length, data)
+            self.apply_op(op, data[:n], out_file, old_file)
 
-    def do_op(self, partition_name, op, out_file, old_file, bar):
-        #print('do op', partition_name, op)
+    def apply_op(self, op: InstallOperation, data, out_file: mtio.MTIOBase, old_file: mtio.MTIOBase):
+        # the data hash is checked on the hash pool while the op is applied
+        check = None
+        if self.hash_executor is not None and op.data_sha256_hash:
+            check = self.hash_executor.submit(verify_data_hash, op, data)
         try:
-            self.data_for_op(op, out_file, old_file)
-            bar.update(1)
+            apply_op(op, data, out_file, old_file, self.block_size, self.diff, self.chunk_size, check is None)
+        finally:
+            if check is not None:
+                check.result()
+
+    def do_op(self, op, data=None):
+        #print('do op', op)
+        out_file = op["part"]["out_file"]
+        old_file = op["part"]["old_file"]
+        # fetched data is accounted by the fetch engine, the rest of the op memory here
+        held = 0 if data is None else max(self.op_memory(op) - len(data), 0)
+        try:
+            if op["operation"].type in ZERO_TYPES and op["part"]["fresh"]:
+                self.zero_fresh(op, op["part"]["image"])
+                self.mark_written(op)
+                self.op_done(op)
+                return
+            with self.budget.held(held):
+                if self.use_op_engine(op, old_file):
+                    if data is None:
+                        self.op_engine.apply(op["operation"], self.payloadfile, self.base_off + op["offset"],
+                                             op["length"], out_file, old_file)
+                    else:
+                        self.op_engine.apply_data(op["operation"], data, out_file, old_file)
+                    # written by the worker process
+                    self.mark_written(op)
+                elif data is None:
+                    self.data_for_op(op, out_file, old_file)
+                else:
+                    self.apply_op(op["operation"], data, out_file, old_file)
+            self.op_done(op)
         except futures.CancelledError:
             pass
 
@@ -1,8 +1,321 @@
+import importlib.util
 import io
+import random
+import time
 import httpx
-from threading import Lock
+from bisect import bisect_right, insort
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Lock
 
 from . import mtio
+from .range_cache import RangeCache
+
+
+class _ReadGroup:
+    # runs of coalesced reads which are fetched by a single request
+    def __init__(self):
+        self.runs = []
+        self.size = 0
+        self.pending = 0
+        self.future = None
+        self.data = None
+
+
+class ReadPlanner:
+    """
+    Merge planned reads which are adjacent or close to each other into larger requests.
+    The first reader of a group fetches it with `fetch_runs`, the others wait for
+    the result, and the buffers are dropped once every planned read has been served
+    or unplanned.
+    """
+
+    def __init__(self, fetch_runs, max_gap: int, max_request_size: int, max_ranges: int):
+        self.fetch_runs = fetch_runs
+        self.max_gap = max_gap
+        self.max_request_size = max_request_size
+        self.max_ranges = max_ranges
+        self.spans = {}
+        self.lock = Lock()
+
+    def plan(self, ranges):
+        ranges = sorted((off, sz) for off, sz in ranges if 0 < sz <= self.max_request_size)
+
+        # [start, end, spans]
+        runs = []
+        for off, sz in ranges:
+            if len(runs) > 0:
+                run = runs[-1]
+                end = max(run[1], off + sz)
+                if off - run[1] <= self.max_gap and end - run[0] <= self.max_request_size:
+                    run[1] = end
+                    run[2].append((off, sz))
+                    continue
+            runs.append([off, off + sz, [(off, sz)]])
+
+        group = None
+        with self.lock:
+            for start, end, spans in runs:
+                if (group is None or len(group.runs) >= self.max_ranges or
+                        group.size + end - start > self.max_request_size):
+                    group = _ReadGroup()
+                group.runs.append((start, end))
+                group.size += end - start
+                group.pending += len(spans)
+                for span in spans:
+                    self.spans.setdefault(span, []).append(group)
+
+    # return None if the read was not planned
+    def readinto(self, off: int, size: int, buf):
+        key = (off, size)
+        owner = False
+        with self.lock:
+            groups = self.spans.get(key)
+            if groups is None:
+                return None
+            group = groups.pop(0)
+            if len(groups) == 0:
+                del self.spans[key]
+            if group.future is None:
+                group.future = Future()
+                owner = True
+
+        if owner:
+            try:
+                group.data = self.fetch_runs(group.runs)
+            except BaseException as e:
+                group.future.set_exception(e)
+                raise
+            group.future.set_result(None)
+        else:
+            group.future.result()
+
+        idx = bisect_right(group.runs, (off, float('inf'))) - 1
+        start, _ = group.runs[idx]
+        buf[:size] = memoryview(group.data[idx])[off - start:off - start + size]
+
+        with self.lock:
+            self._served(group)
+        return size
+
+    def _served(self, group: _ReadGroup):
+        group.pending -= 1
+        if group.pending == 0:
+            group.data = None
+
+    # planned reads which are not going to happen no longer hold their groups
+    def unplan(self, ranges):
+        with self.lock:
+            for key in ranges:
+                for group in self.spans.pop(tuple(key), ()):
+                    self._served(group)
+
+    def clear(self):
+        with self.lock:
+            self.spans.clear()
+
+
+def _parse_content_range(value: str):
+    # bytes a-b/total
+    unit, _, spec = value.strip().partition(' ')
+    if unit != 'bytes':
+        raise ValueError(f'unexpected Content-Range: {value}')
+    rng, _, _ = spec.partition('/')
+    a, _, b = rng.partition('-')
+    return int(a), int(b) + 1
+
+
+def _parse_multipart_byteranges(body: bytes, boundary: bytes):
+    parts = []
+    delimiter = b'--' + boundary
+    p = body.find(delimiter)
+    while p >= 0:
+        p += len(delimiter)
+        if body[p:p + 2] == b'--':
+            break
+        header_end = body.find(b'\r\n\r\n', p)
+        if header_end < 0:
+            raise ValueError('truncated multipart response')
+        content_range = None
+        for line in body[p:header_end].split(b'\r\n'):
+            k, _, v = line.partition(b':')
+            if k.strip().lower() == b'content-range':
+                content_range = _parse_content_range(v.decode('latin-1'))
+        if content_range is None:
+            raise ValueError('multipart part without Content-Range')
+        start, end = content_range
+        data_start = header_end + 4
+        parts.append((start, end, memoryview(body)[data_start:data_start + end - start]))
+        p = body.find(delimiter, data_start + end - start)
+    return parts
+
+
+def _covered(segments, off: int, end: int) -> bool:
+    i = bisect_right(segments, (off, float('inf'))) - 1
+    return i >= 0 and end <= segments[i][1]
+
+
+class ConnectionStats:
+    # count the requests served by every connection of a client
+    def __init__(self):
+        self.lock = Lock()
+        # id(network stream) -> [network stream, http version, requests]
+        self.connections = {}
+
+    def record(self, response: httpx.Response):
+        stream = response.extensions.get("network_stream")
+        http_version = response.http_version
+        with self.lock:
+            conn = self.connections.get(id(stream))
+            if conn is None:
+                # keep the stream referenced so its id is not reused
+                conn = [stream, http_version, 0]
+                self.connections[id(stream)] = conn
+            conn[2] += 1
+
+    def summary(self) -> str:
+        with self.lock:
+            conns = list(self.connections.values())
+        requests = sum(c[2] for c in conns)
+        versions = ', '.join(sorted(set(c[1] for c in conns)))
+        avg = requests / len(conns) if len(conns) > 0 else 0
+        return f'{len(conns)} connections ({versions}), {requests} requests, {avg:.1f} requests per connection'
+
+    def details(self):
+        with self.lock:
+            conns = list(self.connections.values())
+        for i, (stream, http_version, requests) in enumerate(conns):
+            addr = None
+            if stream is not None:
+                addr = stream.get_extra_info("server_addr")
+            yield f'connection {i}: {addr} {http_version} {requests} requests'
+
+
+# concurrent requests allowed per connection with HTTP/2
+HTTP2_STREAMS_PER_CONNECTION = 64
+
+
+class ConnectionPool:
+    """
+    A httpx client with `pool_size` keep-alive connections, which can be shared by
+    several remote files. With `http2`, concurrent requests to the same host are
+    multiplexed over a few connections (requires the h2 package).
+    """
+
+    def __init__(self, pool_size: int = 10, keepalive: float = 30.0, http2: bool = False, headers=None):
+        if http2 and importlib.util.find_spec("h2") is None:
+            print('HTTP/2 requires the h2 package (pip install httpx[http2]), fallback to HTTP/1.1')
+            http2 = False
+        self.stats = ConnectionStats()
+        limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive,
+        )
+        # workers beyond the pool size wait for a free connection instead of failing
+        timeout = httpx.Timeout(5.0, pool=None)
+        self.client = httpx.Client(
+            limits=limits,
+            timeout=timeout,
+            http2=http2,
+            event_hooks={"response": [self.stats.record]},
+        )
+        if headers is not None:
+            self.client.headers = headers
+        # httpx breaks connections when more threads than max_connections wait in its pool,
+        # so requests beyond the limit wait here
+        if http2:
+            self.slots = BoundedSemaphore(pool_size * HTTP2_STREAMS_PER_CONNECTION)
+        else:
+            self.slots = BoundedSemaphore(pool_size)
+
+    @contextmanager
+    def stream(self, method: str, url: str, **kwargs):
+        with self.slots:
+            with self.client.stream(method, url, **kwargs) as r:
+                yield r
+
+    def head(self, url: str, **kwargs) -> httpx.Response:
+        with self.slots:
+            return self.client.head(url, **kwargs)
+
+    def close(self):
+        self.client.close()
+
+    def closed(self) -> bool:
+        return self.client.is_closed
+
+
+# statuses returned by overloaded servers and CDNs
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class TransientStatusError(Exception):
+    pass
+
+
+TRANSIENT_ERRORS = (
+    httpx.TimeoutException,
+    httpx.NetworkError,
+    httpx.RemoteProtocolError,
+    TransientStatusError,
+)
+
+
+class RetryPolicy:
+    """
+    Retry transient network errors with exponential backoff and full jitter.
+    A request gives up after `max_retry` attempts in a row without progress,
+    and all requests of a run share a budget of `budget` retries.
+    """
+
+    def __init__(self, max_retry: int = 10, budget: int = 1000, backoff: float = 0.5, max_backoff: float = 30.0):
+        self.max_retry = max_retry
+        self.budget = budget
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = Lock()
+        self.retries = 0
+        self.resumed = 0
+        self.resumed_bytes = 0
+
+    # return the seconds to wait before the next attempt, or raise e when out of retries
+    def delay(self, attempt: int, e: Exception) -> float:
+        with self.lock:
+            if attempt > self.max_retry or self.retries >= self.budget:
+                raise e
+            self.retries += 1
+        d = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        print(f'{type(e).__name__}: {e}, retry {attempt}/{self.max_retry} in {d:.1f}s')
+        return d
+
+    # a retry continued from already received bytes
+    def resume(self, received: int):
+        if received == 0:
+            return
+        with self.lock:
+            self.resumed += 1
+            self.resumed_bytes += received
+
+    def summary(self) -> str:
+        return f'{self.retries} retries, {self.resumed} resumed requests, {self.resumed_bytes} bytes not downloaded again'
+
+
+def check_status(r: httpx.Response, url: str):
+    if r.status_code in RETRY_STATUS:
+        raise TransientStatusError(f"{url} {r.status_code}")
+    if r.status_code != 206:
+        raise io.UnsupportedOperation(f"Remote did not return partial content: {url} {r.status_code} {r.request.headers}")
+
+
+# bytes fetched from the end of the file instead of a HEAD request,
+# the zip central directory of an OTA is usually inside
+BOOTSTRAP_TAIL_SIZE = 128 * 1024
+# small reads before the first plan_reads are expanded to this size, doubled on every miss
+SPECULATIVE_READ_SIZE = 256 * 1024
+MAX_SPECULATIVE_READ_SIZE = 4 * 1024 * 1024
+# total bytes the speculative reads may fetch
+SPECULATIVE_READ_BUDGET = 16 * 1024 * 1024
 
 
 class HttpRangeFileMTIO(mtio.MTIOBase):
@@ -12,34 +325,181 @@ class HttpRangeFileMTIO(mtio.MTIOBase):
     def writable(self) -> bool:
         return False
 
-    def readinto1(self, off: int, sz: int, buf) -> int:
-        if sz == 0:
-            return 0
+    def _count_request(self):
+        with self.lock:
+            self.request_count += 1
 
-        end_pos = min(off + sz - 1, self.size - 1)
+    def _download_range(self, off: int, end_pos: int, buf) -> int:
         expected_size = end_pos - off + 1
         received = 0
 
-        retry_count = 0
+        attempt = 0
 
         while received < expected_size:
             headers = {"Range": f"bytes={off+received}-{end_pos}"}
+            attempt_start = received
             try:
-                with self.client.stream("GET", self.url, headers=headers) as r:
-                    if r.status_code != 206:
-                        raise io.UnsupportedOperation(f"Remote did not return partial content: {self.url} {r.status_code} {r.request.headers}")
+                self._count_request()
+                with self.pool.stream("GET", self.url, headers=headers) as r:
+                    check_status(r, self.url)
                     for chunk in r.iter_bytes(8192):
                         buf[received : received + len(chunk)] = chunk
                         received += len(chunk)
                         with self.lock:
                             self.transferred_bytes += len(chunk)
-            except httpx.ConnectTimeout as e:
-                retry_count += 1
-                print(f'connection timeout, {retry_count=} {e}')
-                if retry_count >= self.max_retry:
-                    raise e
+            except TRANSIENT_ERRORS as e:
+                if received > attempt_start:
+                    attempt = 0
+                attempt += 1
+                time.sleep(self.retry.delay(attempt, e))
+                # continue from the received bytes instead of the whole range
+                self.retry.resume(received)
         return received
 
+    # fetch several [start, end) runs with one multipart/byteranges request
+    # return None if the remote can't serve multiple ranges
+    def _fetch_multipart(self, runs):
+        spec = ','.join(f'{start}-{end - 1}' for start, end in runs)
+        try:
+            self._count_request()
+            with self.pool.stream("GET", self.url, headers={"Range": f"bytes={spec}"}) as r:
+                if r.status_code in RETRY_STATUS:
+                    raise TransientStatusError(f"{self.url} {r.status_code}")
+                if r.status_code != 206:
+                    # the remote ignored the ranges and is sending the whole file
+                    return None
+                content_type = r.headers.get("Content-Type", "")
+                body = r.read()
+                with self.lock:
+                    self.transferred_bytes += len(body)
+        except TRANSIENT_ERRORS as e:
+            time.sleep(self.retry.delay(1, e))
+            # single range requests can resume where they are interrupted
+            return self._download_each(runs)
+
+        mime, _, params = content_type.partition(';')
+        if mime.strip().lower() == 'multipart/byteranges':
+            boundary = None
+            for param in params.split(';'):
+                k, _, v = param.strip().partition('=')
+                if k.lower() == 'boundary':
+                    boundary = v.strip('"').encode('latin-1')
+            if boundary is None:
+                raise ValueError(f'multipart response without boundary: {content_type}')
+            parts = _parse_multipart_byteranges(body, boundary)
+        else:
+            # the remote merged the ranges into a single one
+            start, end = _parse_content_range(r.headers.get("Content-Range", ""))
+            parts = [(start, end, memoryview(body))]
+
+        result = []
+        for start, end in runs:
+            for part_start, part_end, data in parts:
+                if part_start <= start and end <= part_end:
+                    result.append(data[start - part_start:end - part_start])
+                    break
+            else:
+                buf = bytearray(end - start)
+                self._download_range(start, end - 1, buf)
+                result.append(buf)
+        return result
+
+    def _download_each(self, runs):
+        result = []
+        for start, end in runs:
+            buf = bytearray(end - start)
+            self._download_range(start, end - 1, buf)
+            result.append(buf)
+        return result
+
+    def _download_runs(self, runs):
+        if len(runs) > 1 and self.multipart:
+            result = self._fetch_multipart(runs)
+            if result is not None:
+                return result
+            print('remote does not support multipart ranges, fallback to single range requests')
+            self.multipart = False
+
+        return self._download_each(runs)
+
+    def _fetch_range(self, off: int, end_pos: int, buf) -> int:
+        if self.cache is None:
+            return self._download_range(off, end_pos, buf)
+
+        mem = memoryview(buf)
+        for start, end in self.cache.lookup(off, end_pos + 1, mem):
+            self._download_range(start, end - 1, mem[start - off:end - off])
+            self.cache.store(start, mem[start - off:end - off])
+        return end_pos - off + 1
+
+    def _fetch_runs(self, runs):
+        if self.cache is None:
+            return self._download_runs(runs)
+
+        result = []
+        missing = []
+        for i, (start, end) in enumerate(runs):
+            buf = bytearray(end - start)
+            result.append(buf)
+            for gap_start, gap_end in self.cache.lookup(start, end, memoryview(buf)):
+                missing.append((i, gap_start, gap_end))
+
+        if len(missing) > 0:
+            datas = self._download_runs([(gap_start, gap_end) for _, gap_start, gap_end in missing])
+            for (i, gap_start, gap_end), data in zip(missing, datas):
+                start = runs[i][0]
+                result[i][gap_start - start:gap_end - start] = data
+                self.cache.store(gap_start, data)
+        return result
+
+    def _add_prefetched(self, off: int, data):
+        with self.lock:
+            insort(self.prefetched, (off, off + len(data), data))
+
+    # copy [off, end) into buf if a prefetched segment contains it
+    def _read_prefetched(self, off: int, end: int, buf) -> bool:
+        with self.lock:
+            i = bisect_right(self.prefetched, (off, float('inf'))) - 1
+            if i < 0:
+                return False
+            start, seg_end, data = self.prefetched[i]
+            if end > seg_end:
+                return False
+        buf[:end - off] = memoryview(data)[off - start:end - start]
+        return True
+
+    def _speculative_size(self, size: int) -> int:
+        with self.lock:
+            window = self.speculate
+            if window <= size or self.speculate_budget < window:
+                return 0
+            self.speculate_budget -= window
+            self.speculate = min(window * 2, MAX_SPECULATIVE_READ_SIZE)
+            return window
+
+    def readinto1(self, off: int, sz: int, buf) -> int:
+        if sz == 0 or off >= self.size:
+            return 0
+
+        end_pos = min(off + sz - 1, self.size - 1)
+        if self._read_prefetched(off, end_pos + 1, buf):
+            return end_pos - off + 1
+
+        n = self.planner.readinto(off, sz, buf)
+        if n is not None:
+            return n
+
+        # metadata is read with small dependent reads, fetch more than asked to save round trips
+        window = self._speculative_size(end_pos - off + 1)
+        if window > 0:
+            data = bytearray(min(window, self.size - off))
+            self._fetch_range(off, off + len(data) - 1, data)
+            self._add_prefetched(off, data)
+            buf[:end_pos - off + 1] = memoryview(data)[:end_pos - off + 1]
+            return end_pos - off + 1
+
+        return self._fetch_range(off, end_pos, buf)
+
     def readinto(self, off: int, size: int, ba) -> int:
         if self.closed():
             raise ValueError('closed!')
@@ -52,24 +512,84 @@ class HttpRangeFileMTIO(mtio.MTIOBase):
 
         ba = bytearray(size)
         n = self.readinto1(off, size, ba)
+        if n == size:
+            return ba
         return ba[:n]
 
-    def __init__(self, url: str, max_retry = 10, headers=None):
-        client = httpx.Client()
+    def plan_reads(self, ranges):
+        with self.lock:
+            # the data phase has begun
+            self.speculate = 0
+            prefetched = list(self.prefetched)
+        self.planner.plan((off, sz) for off, sz in ranges
+                          if off + sz <= self.size and not _covered(prefetched, off, off + sz))
+
+    def unplan_reads(self, ranges):
+        self.planner.unplan(ranges)
+
+    # fetch the end of the file, which also tells its size and validators
+    def _bootstrap(self, url: str, tail: int):
+        attempt = 0
+        while True:
+            try:
+                with self.pool.stream("GET", url, headers={"Range": f"bytes=-{tail}"}) as r:
+                    if r.status_code in RETRY_STATUS:
+                        raise TransientStatusError(f"{url} {r.status_code}")
+                    if r.status_code == 206:
+                        _, _, total = r.headers.get("Content-Range", "").rpartition('/')
+                        if not total.isdigit():
+                            raise ValueError(f"Remote has no length: {url}")
+                        size = int(total)
+                        data = r.read()
+                    elif r.status_code == 200 and int(r.headers.get("Content-Length", tail + 1)) <= tail:
+                        # small enough to be served whole
+                        data = r.read()
+                        size = len(data)
+                    elif r.status_code == 416:
+                        raise ValueError(f"Remote has no length: {url}")
+                    else:
+                        raise ValueError(f"Remote does not support ranges: {url} {r.status_code} {r.request.headers}")
+                return r, size, data
+            except TRANSIENT_ERRORS as e:
+                attempt += 1
+                time.sleep(self.retry.delay(attempt, e))
+
+    def __init__(self, url: str, max_retry = 10, headers=None,
+                 coalesce_gap=256 * 1024, max_request_size=8 * 1024 * 1024, max_ranges=32,
+                 cache: RangeCache = None, pool: ConnectionPool = None, retry: RetryPolicy = None,
+                 bootstrap_size=BOOTSTRAP_TAIL_SIZE):
+        if pool is None:
+            pool = ConnectionPool(headers=headers)
+            self.own_pool = True
+        else:
+            self.own_pool = False
         self.url = url
-        self.client = client
+        self.pool = pool
+        self.client = pool.client
         self.max_retry = max_retry
-        if headers is not None:
-            self.client.headers = headers
-        h = client.head(url)
-        if h.headers.get("Accept-Ranges", "none") != "bytes":
-            raise ValueError(f"Remote does not support ranges: {url} {h.status_code} {h.request.headers}")
-        size = int(h.headers.get("Content-Length", 0))
+        if retry is None:
+            retry = RetryPolicy(max_retry)
+        self.retry = retry
+        h, size, tail = self._bootstrap(url, bootstrap_size)
         if size == 0:
             raise ValueError(f"Remote has no length: {url}")
         self.size = size
-        self.transferred_bytes = 0
+        self.is_closed = False
+        self.transferred_bytes = len(tail)
+        self.request_count = 1
         self.lock = Lock()
+        # sorted (start, end, data) fetched ahead of the reads
+        self.prefetched = [(size - len(tail), size, tail)]
+        self.speculate = SPECULATIVE_READ_SIZE
+        self.speculate_budget = SPECULATIVE_READ_BUDGET
+        self.multipart = max_ranges > 1
+        self.planner = ReadPlanner(self._fetch_runs, coalesce_gap, max_request_size, max_ranges)
+        self.etag = h.headers.get("ETag")
+        self.last_modified = h.headers.get("Last-Modified")
+        self.cache = None
+        if cache is not None:
+            self.cache = cache.open(url, self.etag, self.last_modified, size)
+            self.cache.store(size - len(tail), tail)
 
     def get_size(self) -> int:
         return self.size
@@ -81,10 +601,17 @@ class HttpRangeFileMTIO(mtio.MTIOBase):
         raise NotImplementedError()
 
     def close(self):
-        self.client.close()
+        if self.is_closed:
+            return
+        self.is_closed = True
+        self.planner.clear()
+        if self.own_pool:
+            self.pool.close()
+        if self.cache is not None:
+            self.cache.close()
 
     def closed(self) -> bool:
-        return self.client.is_closed
+        return self.is_closed or self.pool.closed()
 
     def __enter__(self):
         return self
@@ -93,6 +620,236 @@ class HttpRangeFileMTIO(mtio.MTIOBase):
         self.close()
 
 
+# weight of the latest request in a mirror's throughput estimate
+MIRROR_RATE_ALPHA = 0.3
+# longest time a failing mirror is left unused
+MIRROR_MAX_COOLDOWN = 60.0
+
+
+class _Mirror:
+    def __init__(self, file: HttpRangeFileMTIO):
+        self.file = file
+        # bytes per second, None until the first request finishes
+        self.rate = None
+        self.inflight = 0
+        self.failures = 0
+        self.errors = 0
+        self.down_until = 0.0
+
+
+class MultiHttpRangeFileMTIO(HttpRangeFileMTIO):
+    """
+    A remote file served by several mirrors, which must agree on its size and ETag.
+    Every request goes to the mirror expected to finish it first according to its
+    measured throughput and the bytes already requested from it, and reads larger
+    than `stripe_size` are split across the mirrors. A failing mirror is left unused
+    for a while and interrupted requests continue on another one.
+    """
+
+    def __init__(self, urls, headers=None,
+                 coalesce_gap=256 * 1024, max_request_size=8 * 1024 * 1024, max_ranges=32,
+                 cache: RangeCache = None, pool: ConnectionPool = None, retry: RetryPolicy = None,
+                 stripe_size=4 * 1024 * 1024):
+        if pool is None:
+            pool = ConnectionPool(headers=headers)
+            self.own_pool = True
+        else:
+            self.own_pool = False
+        if retry is None:
+            retry = RetryPolicy()
+        self.pool = pool
+        self.client = pool.client
+        self.retry = retry
+        self.mirrors = []
+        for url in urls:
+            try:
+                # only the first mirror's tail is used
+                bootstrap_size = BOOTSTRAP_TAIL_SIZE if len(self.mirrors) == 0 else 1
+                f = HttpRangeFileMTIO(url, max_ranges=max_ranges, pool=pool, retry=retry,
+                                      bootstrap_size=bootstrap_size)
+            except (ValueError, *TRANSIENT_ERRORS) as e:
+                print(f'skip mirror {url}: {type(e).__name__}: {e}')
+                continue
+            # errors are retried here on another mirror
+            f.retry = RetryPolicy(0)
+            self.mirrors.append(_Mirror(f))
+        if len(self.mirrors) == 0:
+            raise ValueError('no usable mirror')
+
+        first = self.mirrors[0].file
+        for m in self.mirrors[1:]:
+            if m.file.size != first.size:
+                raise ValueError(f'mirrors disagree on size: {first.url} {first.size}, {m.file.url} {m.file.size}')
+            if first.etag is not None and m.file.etag is not None and m.file.etag != first.etag:
+                raise ValueError(f'mirrors disagree on ETag: {first.url} {first.etag}, {m.file.url} {m.file.etag}')
+
+        self.url = first.url
+        self.size = first.size
+        self.max_retry = retry.max_retry
+        self.stripe_size = stripe_size
+        self.is_closed = False
+        self.lock = Lock()
+        self.prefetched = list(first.prefetched)
+        self.speculate = SPECULATIVE_READ_SIZE
+        self.speculate_budget = SPECULATIVE_READ_BUDGET
+        self.mirror_lock = Lock()
+        self.multipart = max_ranges > 1
+        self.executor = ThreadPoolExecutor(max_workers=len(self.mirrors), thread_name_prefix='mirror')
+        self.planner = ReadPlanner(self._fetch_runs, coalesce_gap, max_request_size, max_ranges)
+        self.cache = None
+        if cache is not None:
+            self.cache = cache.open(self.url, first.etag, first.last_modified, self.size)
+            for start, _, data in first.prefetched:
+                self.cache.store(start, data)
+
+    @property
+    def transferred_bytes(self) -> int:
+        return sum(m.file.transferred_bytes for m in self.mirrors)
+
+    @property
+    def request_count(self) -> int:
+        return sum(m.file.request_count for m in self.mirrors)
+
+    # pick the mirror for a request of size bytes and account it as in flight
+    def acquire_mirror(self, size: int, multipart: bool = False):
+        now = time.monotonic()
+        with self.mirror_lock:
+            candidates = [m for m in self.mirrors if not multipart or m.file.multipart]
+            if len(candidates) == 0:
+                return None
+            up = [m for m in candidates if m.down_until <= now]
+            if len(up) == 0:
+                mirror = min(candidates, key=lambda m: m.down_until)
+            else:
+                rates = [m.rate for m in up if m.rate is not None]
+                best = max(rates) if len(rates) > 0 else 1.0
+                # untried mirrors are assumed as fast as the fastest one
+                mirror = min(up, key=lambda m: (m.inflight + size) / (m.rate or best))
+            mirror.inflight += size
+            return mirror
+
+    def release_mirror(self, mirror: _Mirror, size: int, received: int, elapsed: float, failed: bool):
+        with self.mirror_lock:
+            mirror.inflight -= size
+            if failed:
+                mirror.errors += 1
+                mirror.failures += 1
+                mirror.down_until = time.monotonic() + min(MIRROR_MAX_COOLDOWN, 2 ** mirror.failures)
+                return
+            mirror.failures = 0
+            if received > 0 and elapsed > 0:
+                rate = received / elapsed
+                if mirror.rate is None:
+                    mirror.rate = rate
+                else:
+                    mirror.rate += MIRROR_RATE_ALPHA * (rate - mirror.rate)
+
+    def _mirror_available(self) -> bool:
+        now = time.monotonic()
+        with self.mirror_lock:
+            return any(m.down_until <= now for m in self.mirrors)
+
+    def _download_stripe(self, off: int, end_pos: int, buf) -> int:
+        expected_size = end_pos - off + 1
+        received = 0
+        attempt = 0
+
+        while received < expected_size:
+            mirror = self.acquire_mirror(expected_size - received)
+            f = mirror.file
+            size = expected_size - received
+            attempt_start = received
+            start = time.monotonic()
+            try:
+                f._count_request()
+                headers = {"Range": f"bytes={off+received}-{end_pos}"}
+                with self.pool.stream("GET", f.url, headers=headers) as r:
+                    check_status(r, f.url)
+                    for chunk in r.iter_bytes(8192):
+                        buf[received : received + len(chunk)] = chunk
+                        received += len(chunk)
+                        with f.lock:
+                            f.transferred_bytes += len(chunk)
+            except TRANSIENT_ERRORS as e:
+                self.release_mirror(mirror, size, received - attempt_start, time.monotonic() - start, True)
+                if received > attempt_start:
+                    attempt = 0
+                attempt += 1
+                d = self.retry.delay(attempt, e)
+                # another mirror can take over right away
+                if not self._mirror_available():
+                    time.sleep(d)
+                self.retry.resume(received)
+                continue
+            except BaseException:
+                self.release_mirror(mirror, size, received - attempt_start, time.monotonic() - start, True)
+                raise
+            self.release_mirror(mirror, size, received - attempt_start, time.monotonic() - start, False)
+        return received
+
+    def _download_range(self, off: int, end_pos: int, buf) -> int:
+        expected_size = end_pos - off + 1
+        if expected_size <= self.stripe_size or len(self.mirrors) == 1:
+            return self._download_stripe(off, end_pos, buf)
+
+        mem = memoryview(buf)
+        stripes = [(start, min(start + self.stripe_size, end_pos + 1))
+                   for start in range(off, end_pos + 1, self.stripe_size)]
+        futures = [self.executor.submit(self._download_stripe, start, end - 1, mem[start - off:end - off])
+                   for start, end in stripes[1:]]
+        try:
+            start, end = stripes[0]
+            self._download_stripe(start, end - 1, mem[start - off:end - off])
+        finally:
+            wait(futures)
+        for future in futures:
+            future.result()
+        return expected_size
+
+    def _download_runs(self, runs):
+        if len(runs) > 1 and self.multipart:
+            size = sum(end - start for start, end in runs)
+            mirror = self.acquire_mirror(size, multipart=True)
+            if mirror is not None:
+                start = time.monotonic()
+                try:
+                    result = mirror.file._fetch_multipart(runs)
+                except TRANSIENT_ERRORS as e:
+                    self.release_mirror(mirror, size, 0, time.monotonic() - start, True)
+                    d = self.retry.delay(1, e)
+                    # another mirror can take over right away
+                    if not self._mirror_available():
+                        time.sleep(d)
+                    result = None
+                except BaseException:
+                    self.release_mirror(mirror, size, 0, time.monotonic() - start, True)
+                    raise
+                else:
+                    self.release_mirror(mirror, size, size, time.monotonic() - start, False)
+                    if result is None:
+                        print(f'{mirror.file.url} does not support multipart ranges, fallback to single range requests')
+                        mirror.file.multipart = False
+                if result is not None:
+                    return result
+
+        return self._download_each(runs)
+
+    def mirror_details(self):
+        with self.mirror_lock:
+            for m in self.mirrors:
+                rate = 'n/a' if m.rate is None else f'{m.rate / 1024 / 1024:.1f} MiB/s'
+                yield (f'{m.file.url}: {m.file.transferred_bytes} bytes, {m.file.request_count} requests, '
+                       f'{rate}, {m.errors} errors')
+
+    def close(self):
+        if self.is_closed:
+            return
+        self.executor.shutdown(wait=True)
+        for m in self.mirrors:
+            m.file.close()
+        super().close()
+
+
 if __name__ == "__main__":
     from ziputil import get_zip_stored_entry_offset
     hf = HttpRangeFileMTIO('OTA_LINK_TO_TEST')
@@ -103,4 +860,4 @@ if __name__ == "__main__":
     #data = mio.read(sz - 4096, 4096)
     #with open('out.bin', 'wb') as f:
         #f.write(data)
-    hf.close()
\ No newline at end of file
+    hf.close()
@@ -0,0 +1,154 @@
+import os
+import time
+from threading import Lock
+
+from . import mtio
+
+JOURNAL_NAME = ".payload_dumper.journal"
+JOURNAL_MAGIC = "payload_dumper journal 2"
+
+# finished ops are made durable after this many, or this many seconds
+JOURNAL_BATCH = 1024
+JOURNAL_INTERVAL = 5.0
+
+
+class Journal:
+    """
+    Finished ops of each partition, kept in the output directory so an interrupted
+    extraction of the same payload can continue where it stopped. A journal of another
+    manifest is started over. Records are written in batches, each after the images it
+    refers to are synced, so a recorded op is on disk.
+
+    Records are `<partition> <op index>`, `<partition> reset` when its image is written
+    over, and `<partition> image <size> <inode>` when its image is opened; ops of an
+    image that is not the one opened are not trusted.
+    """
+
+    def __init__(self, out_dir: str, manifest_hash: str, batch: int = JOURNAL_BATCH,
+                 interval: float = JOURNAL_INTERVAL):
+        self.path = os.path.join(out_dir, JOURNAL_NAME)
+        self.header = f"{JOURNAL_MAGIC} {manifest_hash}\n"
+        self.batch = batch
+        self.interval = interval
+        # partition name -> indexes of finished ops
+        self.finished = {}
+        # partition name -> (size, inode) of its image when it was opened
+        self.images = {}
+        # (partition name, op index, image) not written yet
+        self.pending = []
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.last_flush = time.monotonic()
+
+        valid = self._load()
+        if valid > 0:
+            self.f = open(self.path, "r+", encoding="utf-8", newline="")
+            # drop a record cut short by the interruption
+            self.f.truncate(valid)
+            self.f.seek(valid)
+        else:
+            self.f = open(self.path, "w", encoding="utf-8", newline="")
+            self.f.write(self.header)
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    # return the size of the usable part of the journal, 0 to start over
+    def _load(self) -> int:
+        try:
+            with open(self.path, "r", encoding="utf-8", newline="") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        if not data.startswith(self.header):
+            return 0
+        valid = data.rfind("\n") + 1
+        for line in data[len(self.header):valid].splitlines():
+            fields = line.split(" ")
+            name = fields[0]
+            if len(fields) == 2 and fields[1].isdigit():
+                self.finished.setdefault(name, set()).add(int(fields[1]))
+            elif fields[1:] == ["reset"]:
+                self.finished.pop(name, None)
+                self.images.pop(name, None)
+            elif len(fields) == 4 and fields[1] == "image" and fields[2].isdigit() and fields[3].isdigit():
+                self.images[name] = (int(fields[2]), int(fields[3]))
+        return len(data[:valid].encode())
+
+    # finished ops of a partition, if its image at path is the one they were written to
+    def finished_ops(self, partition_name: str, path: str) -> set:
+        finished = self.finished.get(partition_name)
+        if not finished:
+            return set()
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return set()
+        if self.images.get(partition_name) != (st.st_size, st.st_ino):
+            print("%s: image changed since the last run, starting over" % partition_name)
+            return set()
+        return finished
+
+    def _write_now(self, line: str):
+        with self.flush_lock:
+            self.f.write(line)
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    # forget the ops of a partition whose image is written over
+    def reset(self, partition_name: str):
+        self.finished.pop(partition_name, None)
+        self.images.pop(partition_name, None)
+        self._write_now(f"{partition_name} reset\n")
+
+    # remember which image the ops of a partition are written to
+    def opened(self, partition_name: str, path: str):
+        st = os.stat(path)
+        self.images[partition_name] = (st.st_size, st.st_ino)
+        self._write_now(f"{partition_name} image {st.st_size} {st.st_ino}\n")
+
+    def record(self, partition_name: str, index: int, image: mtio.MTIOBase):
+        with self.lock:
+            self.pending.append((partition_name, index, image))
+            due = len(self.pending) >= self.batch or time.monotonic() - self.last_flush >= self.interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, []
+                self.last_flush = time.monotonic()
+            if len(pending) == 0:
+                return
+            images = {id(image): image for _, _, image in pending}
+            for image in images.values():
+                image.sync()
+            self.f.write("".join(f"{name} {index}\n" for name, index, _ in pending))
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+# forget the ops of a partition in the journal in out_dir, if there is one, when its
+# image is written over by a run that doesn't keep a journal
+def reset_journal(out_dir: str, partition_name: str):
+    path = os.path.join(out_dir, JOURNAL_NAME)
+    try:
+        f = open(path, "r+b")
+    except FileNotFoundError:
+        return
+    with f:
+        data = f.read()
+        if not data.startswith(JOURNAL_MAGIC.encode() + b" "):
+            # started over by the next run anyway
+            return
+        # drop a record cut short by an interruption
+        valid = data.rfind(b"\n") + 1
+        f.truncate(valid)
+        f.seek(valid)
+        f.write(f"{partition_name} reset\n".encode())
+        f.flush()
+        os.fsync(f.fileno())
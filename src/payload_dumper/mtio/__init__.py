@@ -1,6 +1,9 @@
 import os
 import sys
 
+# buffer of copies between files which the kernel can't do
+COPY_BUFFER_SIZE = 1024 * 1024
+
 class MTIOBase:
     # read as much as size
     def read(self, off: int, size: int) -> bytes:
@@ -30,6 +33,40 @@ class MTIOBase:
     def closed(self) -> bool:
         pass
 
+    # hint: reads of these (off, size) ranges are going to happen soon
+    def plan_reads(self, ranges):
+        pass
+
+    # hint: planned reads of these (off, size) ranges are not going to happen
+    def unplan_reads(self, ranges):
+        pass
+
+    def sync(self):
+        pass
+
+    def set_sparse(self, is_sparse: bool):
+        pass
+
+    # deallocate the range so it reads as zeros, return False if not supported
+    def punch_hole(self, off: int, size: int) -> bool:
+        return False
+
+    # allocate disk space for the first size bytes, return False if not supported
+    def preallocate(self, size: int) -> bool:
+        return False
+
+    # copy size bytes at src_off of src to off
+    def copy_range(self, src: 'MTIOBase', src_off: int, off: int, size: int) -> int:
+        buf = bytearray(min(size, COPY_BUFFER_SIZE))
+        done = 0
+        while done < size:
+            n = src.readinto(src_off + done, min(len(buf), size - done), buf)
+            if n == 0:
+                raise ValueError(f'source ends at {src_off + done}')
+            self.write(off + done, memoryview(buf)[:n])
+            done += n
+        return done
+
 
 USE_MMAP = False
 if USE_MMAP:
@@ -54,9 +91,13 @@ if USE_MMAP:
             return self.mapped[off:end]
 
         def readinto(self, off: int, size: int, ba) -> int:
-            content = self.read(off, size)
-            ba[:len(content)] = content
-            return len(content)
+            sz = self.mapped.size()
+            if off < 0 or off >= sz:
+                raise ValueError(f'invalid offset {off}')
+            end = min(off + size, sz)
+            with memoryview(self.mapped) as mem:
+                ba[:end - off] = mem[off:end]
+            return end - off
 
         def write(self, off: int, content: bytes) -> int:
             sz = self.mapped.size()
@@ -103,6 +144,7 @@ if USE_IO:
     class FileMTFile(MTIOBase):
         def __init__(self, path, mode):
             self.f = open(path, mode + 'b')
+            self.path = path
             self.lock = Lock()
 
         def read(self, off: int, size: int) -> bytes:
@@ -113,7 +155,7 @@ if USE_IO:
         def readinto(self, off: int, size: int, ba) -> int:
             with self.lock:
                 self.f.seek(off, os.SEEK_SET)
-                return self.f.readinto(ba)
+                return self.f.readinto(memoryview(ba)[:size])
 
         def write(self, off: int, content: bytes) -> int:
             with self.lock:
@@ -126,6 +168,11 @@ if USE_IO:
         def set_size(self, size: int):
             os.ftruncate(self.f.fileno(), size)
 
+        def sync(self):
+            with self.lock:
+                self.f.flush()
+                os.fsync(self.f.fileno())
+
         def readable(self) -> bool:
             return self.f.readable()
 
@@ -146,3 +193,6 @@ else:
         from ._unix import UnixMTFile, set_file_sparse
         MTFile = UnixMTFile
 
+
+from .buffer_pool import BufferPool
+from .readahead import ReadaheadMTIO
@@ -1,5 +1,36 @@
 from . import MTIOBase
+import ctypes
+import errno
+import fcntl
 import os
+import struct
+import sys
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+try:
+    _fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (OSError, AttributeError):
+    # not linux
+    _fallocate = None
+
+# _IOW(0x94, 13, struct file_clone_range)
+FICLONERANGE = 0x4020940d
+
+# the copy has to be done another way
+_COPY_UNSUPPORTED = (errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.ENOSYS, errno.EBADF)
+
+if hasattr(os, 'preadv'):
+    # read straight into the buffer
+    def _preadinto(fd: int, mem, off: int) -> int:
+        return os.preadv(fd, [mem], off)
+else:
+    def _preadinto(fd: int, mem, off: int) -> int:
+        r = os.pread(fd, len(mem), off)
+        mem[:len(r)] = r
+        return len(r)
 
 # no-op
 def set_file_sparse(handle, is_sparse: bool):
@@ -23,16 +54,20 @@ class UnixMTFile(MTIOBase):
             raise ValueError('mode')
         flags |= os.O_CLOEXEC
         self.fd = os.open(path, flags)
+        self.path = path
         self.can_read = is_r
         self.can_write = is_w or is_o
-        self.closed = False
+        self.is_closed = False
+        # cleared once the filesystem refuses
+        self.can_clone = sys.platform.startswith('linux')
+        self.can_copy_file_range = hasattr(os, 'copy_file_range')
 
     def close(self):
         os.close(self.fd)
-        self.closed = True
+        self.is_closed = True
 
     def closed(self) -> bool:
-        return self.closed
+        return self.is_closed
 
     def writable(self) -> bool:
         return self.can_write
@@ -42,7 +77,7 @@ class UnixMTFile(MTIOBase):
 
     # return 0 when read at eof
     def read(self, off: int, size: int) -> bytes:
-        if self.closed:
+        if self.is_closed:
             raise ValueError('Closed!')
 
         if not self.can_read:
@@ -51,29 +86,39 @@ class UnixMTFile(MTIOBase):
         if size == 0:
             return b''
 
-        result = b''
+        chunks = []
         remain = size
-        pos = 0
 
         while remain > 0:
             r = os.pread(self.fd, remain, off)
             n = len(r)
             if n == 0:
                 break
-            pos += n
             remain -= n
             off += n
-            result += r
+            chunks.append(r)
 
-        return result
+        return b''.join(chunks)
 
     def readinto(self, off: int, size: int, ba) -> int:
-        r = self.read(off, size)
-        ba[:len(r)] = r
-        return len(r)
+        if self.is_closed:
+            raise ValueError('Closed!')
+
+        if not self.can_read:
+            raise ValueError('Can\'t read!')
+
+        mem = memoryview(ba)[:size]
+        pos = 0
+
+        while pos < size:
+            n = _preadinto(self.fd, mem[pos:], off + pos)
+            if n == 0:
+                break
+            pos += n
+        return pos
 
     def write(self, off: int, content: bytes) -> int:
-        if self.closed:
+        if self.is_closed:
             raise ValueError('Closed!')
 
         if not self.can_write:
@@ -84,23 +129,80 @@ class UnixMTFile(MTIOBase):
         pos = 0
 
         while remain > 0:
-            mem = mem[pos:]
-            d = os.pwrite(self.fd, mem, off)
+            d = os.pwrite(self.fd, mem[pos:], off)
             pos += d
             off += d
             remain -= d
         return pos
 
     def get_size(self) -> int:
-        if self.closed:
+        if self.is_closed:
             raise ValueError('Closed!')
         return os.fstat(self.fd).st_size
 
     def set_size(self, size: int):
-        if self.closed:
+        if self.is_closed:
             raise ValueError('Closed!')
         os.ftruncate(self.fd, size)
 
+    def sync(self):
+        if self.is_closed:
+            raise ValueError('Closed!')
+        os.fsync(self.fd)
+
+    def punch_hole(self, off: int, size: int) -> bool:
+        if self.is_closed:
+            raise ValueError('Closed!')
+        if _fallocate is None or size == 0:
+            return False
+        if _fallocate(self.fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, off, size) != 0:
+            # EOPNOTSUPP on filesystems without hole support
+            return False
+        return True
+
+    def preallocate(self, size: int) -> bool:
+        if self.is_closed:
+            raise ValueError('Closed!')
+        if not hasattr(os, 'posix_fallocate') or size == 0:
+            return False
+        try:
+            os.posix_fallocate(self.fd, 0, size)
+        except OSError:
+            # EINVAL or EOPNOTSUPP where the filesystem can't allocate
+            return False
+        return True
+
+    # share the blocks with reflink if possible, otherwise copy them in the kernel
+    def copy_range(self, src: MTIOBase, src_off: int, off: int, size: int) -> int:
+        if self.is_closed:
+            raise ValueError('Closed!')
+        if not isinstance(src, UnixMTFile):
+            return super().copy_range(src, src_off, off, size)
+
+        if self.can_clone:
+            try:
+                fcntl.ioctl(self.fd, FICLONERANGE, struct.pack('qQQQ', src.fd, src_off, size, off))
+                return size
+            except OSError as e:
+                if e.errno not in _COPY_UNSUPPORTED:
+                    raise
+                self.can_clone = False
+
+        done = 0
+        if self.can_copy_file_range:
+            try:
+                while done < size:
+                    n = os.copy_file_range(src.fd, self.fd, size - done, src_off + done, off + done)
+                    if n == 0:
+                        break
+                    done += n
+            except OSError as e:
+                if e.errno not in _COPY_UNSUPPORTED:
+                    raise
+                self.can_copy_file_range = False
+        if done < size:
+            done += super().copy_range(src, src_off + done, off + done, size - done)
+        return done
 
     def set_sparse(self, is_sparse: bool):
         pass
@@ -1,3 +1,5 @@
+import struct
+
 import win32file
 import win32con
 import winioctlcon
@@ -30,16 +32,17 @@ class WindowsMTFile(MTIOBase):
             access_flags |= win32file.GENERIC_WRITE
         share_mode = win32file.FILE_SHARE_READ | win32file.FILE_SHARE_WRITE | win32file.FILE_SHARE_DELETE
         self.handle = win32file.CreateFile(path, access_flags, share_mode, None, creation_disposition, 0, None)
+        self.path = path
         self.can_read = is_r
         self.can_write = is_w or is_o
-        self.closed = False
+        self.is_closed = False
 
     def close(self):
         self.handle.Close()
-        self.closed = True
+        self.is_closed = True
 
     def closed(self) -> bool:
-        return self.closed
+        return self.is_closed
 
     def writable(self) -> bool:
         return self.can_write
@@ -58,8 +61,6 @@ class WindowsMTFile(MTIOBase):
         overlapped = win32file.OVERLAPPED()
 
         while remain > 0:
-            mem = mem[pos:]
-
             overlapped.Offset = off & 0xffffffff
             overlapped.OffsetHigh = off >> 32
 
@@ -73,7 +74,7 @@ class WindowsMTFile(MTIOBase):
             # buffer = win32file.AllocateReadBuffer(size)
             # we can pass `size` directly
             try:
-                win32file.ReadFile(self.handle, mem, overlapped)
+                win32file.ReadFile(self.handle, mem[pos:], overlapped)
             except pywintypes.error as exc:
                 if exc.winerror == winerror.ERROR_HANDLE_EOF:
                     # EOF reached
@@ -89,7 +90,7 @@ class WindowsMTFile(MTIOBase):
         return pos
 
     def readinto(self, off: int, size: int, ba) -> int:
-        if self.closed:
+        if self.is_closed:
             raise ValueError('Closed!')
 
         if not self.can_read:
@@ -100,10 +101,12 @@ class WindowsMTFile(MTIOBase):
     def read(self, off: int, size: int) -> bytes:
         out = bytearray(size)
         sz = self.readinto1(off, size, out)
+        if sz == size:
+            return out
         return out[:sz]
 
     def write(self, off: int, content: bytes) -> int:
-        if self.closed:
+        if self.is_closed:
             raise ValueError('Closed!')
 
         if not self.can_write:
@@ -115,10 +118,9 @@ class WindowsMTFile(MTIOBase):
         overlapped = win32file.OVERLAPPED()
 
         while remain > 0:
-            mem = mem[pos:]
             overlapped.Offset = off & 0xffffffff
             overlapped.OffsetHigh = off >> 32
-            rc, d = win32file.WriteFile(self.handle, mem, overlapped)
+            rc, d = win32file.WriteFile(self.handle, mem[pos:], overlapped)
             pos += d
             off += d
             remain -= d
@@ -129,10 +131,26 @@ class WindowsMTFile(MTIOBase):
 
     # not thread safe
     def set_size(self, size: int):
-        win32file.SetFilePointer(self.handle, size, win32con.FILE_CURRENT)
+        win32file.SetFilePointer(self.handle, size, win32con.FILE_BEGIN)
         win32file.SetEndOfFile(self.handle)
 
+    def sync(self):
+        if self.is_closed:
+            raise ValueError('Closed!')
+        win32file.FlushFileBuffers(self.handle)
+
+    # the file must be set sparse first, otherwise zeros are written
+    def punch_hole(self, off: int, size: int) -> bool:
+        if self.is_closed:
+            raise ValueError('Closed!')
+        if size == 0:
+            return False
+        # FILE_ZERO_DATA_INFORMATION
+        buf = struct.pack('<qq', off, off + size)
+        win32file.DeviceIoControl(self.handle, winioctlcon.FSCTL_SET_ZERO_DATA, buf, None, None)
+        return True
+
     def set_sparse(self, is_sparse: bool):
-        if self.closed:
+        if self.is_closed:
             raise ValueError('Closed!')
         set_file_sparse(self.handle, is_sparse)
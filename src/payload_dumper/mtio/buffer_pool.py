@@ -0,0 +1,58 @@
+from contextlib import contextmanager
+from threading import Lock
+
+
+class BufferPool:
+    """
+    Reusable bytearrays for reads, so every op does not allocate and free its buffers.
+    Sizes are rounded up to a power of two of at least `min_size`. At most `max_bytes`
+    of free buffers are kept, and buffers larger than `max_buffer_size` are not pooled.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, min_size: int = 64 * 1024,
+                 max_buffer_size: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.min_size = min_size
+        self.max_buffer_size = max_buffer_size
+        self.lock = Lock()
+        # size -> free buffers
+        self.free = {}
+        self.free_bytes = 0
+        self.allocated = 0
+        self.reused = 0
+
+    def _bucket(self, size: int) -> int:
+        return max(self.min_size, 1 << (size - 1).bit_length())
+
+    # return a bytearray of at least size bytes
+    def acquire(self, size: int) -> bytearray:
+        bucket = self._bucket(size)
+        if bucket > self.max_buffer_size:
+            return bytearray(size)
+        with self.lock:
+            free = self.free.get(bucket)
+            if free:
+                self.free_bytes -= bucket
+                self.reused += 1
+                return free.pop()
+            self.allocated += 1
+        return bytearray(bucket)
+
+    def release(self, buf: bytearray):
+        bucket = len(buf)
+        if bucket > self.max_buffer_size or bucket != self._bucket(bucket):
+            return
+        with self.lock:
+            if self.free_bytes + bucket > self.max_bytes:
+                return
+            self.free.setdefault(bucket, []).append(buf)
+            self.free_bytes += bucket
+
+    # a memoryview of exactly size bytes, which must not be used after the block
+    @contextmanager
+    def lease(self, size: int):
+        buf = self.acquire(size)
+        try:
+            yield memoryview(buf)[:size]
+        finally:
+            self.release(buf)
@@ -0,0 +1,147 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from . import MTIOBase
+
+
+class _Chunk:
+    def __init__(self):
+        self.future = None
+        self.data = None
+        self.size = 0
+
+
+class ReadaheadMTIO(MTIOBase):
+    """
+    Wrap a readable MTIOBase and read ahead of forward-sequential access.
+    After `trigger` reads each starting near the end of the previous ones, the next
+    `window` bytes are read by background threads into a ring of `slots` chunks,
+    and reads which fall completely inside prefetched chunks are served from them.
+    Reads of a few workers running slightly out of order still count as sequential.
+    """
+
+    def __init__(self, inner: MTIOBase, window: int = 64 * 1024 * 1024, slots: int = 8,
+                 threads: int = 2, trigger: int = 2):
+        self.inner = inner
+        self.window = window
+        self.slots = slots
+        self.chunk_size = max(window // slots, 1)
+        self.trigger = trigger
+        self.size = inner.get_size()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.lock = Lock()
+        # chunk index -> _Chunk
+        self.chunks = {}
+        self.pos = None
+        self.hits = 0
+        self.prefetched_bytes = 0
+        self.is_closed = False
+
+    def _load(self, idx: int, chunk: _Chunk):
+        off = idx * self.chunk_size
+        size = min(self.chunk_size, self.size - off)
+        buf = bytearray(size)
+        chunk.size = self.inner.readinto(off, size, buf)
+        chunk.data = buf
+        with self.lock:
+            self.prefetched_bytes += chunk.size
+
+    # lock held
+    def _observe(self, off: int, end: int):
+        if self.pos is not None and self.pos - self.window <= off <= self.pos + self.chunk_size:
+            self.hits += 1
+            self.pos = max(self.pos, end)
+        else:
+            # random access, stop reading ahead
+            self.hits = 0
+            self.pos = end
+            self.chunks.clear()
+            return
+
+        if self.hits < self.trigger:
+            return
+
+        first = off // self.chunk_size
+        last = min(off + self.window, self.size - 1) // self.chunk_size
+        # chunks behind the current read are no longer needed
+        for idx in sorted(self.chunks):
+            if idx >= first or len(self.chunks) < self.slots:
+                break
+            del self.chunks[idx]
+        for idx in range(first, last + 1):
+            if len(self.chunks) >= self.slots:
+                break
+            if idx not in self.chunks:
+                chunk = _Chunk()
+                chunk.future = self.executor.submit(self._load, idx, chunk)
+                self.chunks[idx] = chunk
+
+    def readinto(self, off: int, size: int, ba) -> int:
+        if self.is_closed:
+            raise ValueError('closed!')
+
+        size = max(min(size, self.size - off), 0)
+        if size == 0:
+            return 0
+
+        end = off + size
+        first = off // self.chunk_size
+        last = (end - 1) // self.chunk_size
+        with self.lock:
+            self._observe(off, end)
+            chunks = [self.chunks.get(idx) for idx in range(first, last + 1)]
+
+        if size <= self.window and all(c is not None for c in chunks):
+            mem = memoryview(ba)
+            try:
+                for idx, chunk in zip(range(first, last + 1), chunks):
+                    chunk.future.result()
+                    chunk_off = idx * self.chunk_size
+                    a = max(off, chunk_off)
+                    b = min(end, chunk_off + chunk.size)
+                    mem[a - off:b - off] = memoryview(chunk.data)[a - chunk_off:b - chunk_off]
+                return size
+            except Exception:
+                # fallback to a direct read below
+                with self.lock:
+                    for idx in range(first, last + 1):
+                        self.chunks.pop(idx, None)
+
+        return self.inner.readinto(off, size, ba)
+
+    def read(self, off: int, size: int) -> bytes:
+        ba = bytearray(size)
+        n = self.readinto(off, size, ba)
+        if n == size:
+            return ba
+        return ba[:n]
+
+    def write(self, off: int, content: bytes) -> int:
+        raise NotImplementedError()
+
+    def get_size(self) -> int:
+        return self.size
+
+    def set_size(self, size: int):
+        raise NotImplementedError()
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return False
+
+    # not forwarded, the readahead already issues large sequential reads
+    def plan_reads(self, ranges):
+        pass
+
+    def close(self):
+        if self.is_closed:
+            return
+        self.is_closed = True
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.chunks.clear()
+        self.inner.close()
+
+    def closed(self) -> bool:
+        return self.is_closed
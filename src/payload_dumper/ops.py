@@ -0,0 +1,220 @@
+import bz2
+import hashlib
+import lzma
+import sys
+
+from zstd import ZSTD_uncompress
+
+from . import mtio
+from .bspatch import apply_patch
+from .update_metadata_pb2 import InstallOperation
+
+try:
+    import zstandard
+except ImportError:
+    # ZSTD ops are decompressed at once
+    zstandard = None
+
+# bytes decompressed at once by default
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+
+# ops which leave their extents zeroed
+ZERO_TYPES = (
+    InstallOperation.ZERO,
+    InstallOperation.DISCARD,
+)
+
+# written where a hole can't be punched
+_ZEROS = bytes(1024 * 1024)
+
+# ops whose data can be read and decompressed in chunks
+STREAMING_TYPES = (
+    InstallOperation.REPLACE,
+    InstallOperation.REPLACE_XZ,
+    InstallOperation.REPLACE_BZ,
+    InstallOperation.ZSTD,
+)
+
+
+class ExtentWriter:
+    """
+    Write a stream of data across extents of out_file, in order.
+    """
+
+    def __init__(self, out_file: mtio.MTIOBase, extents, block_size: int):
+        self.out_file = out_file
+        self.extents = [(e.start_block * block_size, e.num_blocks * block_size) for e in extents]
+        self.size = sum(size for _, size in self.extents)
+        self.written = 0
+        self.index = 0
+        self.pos = 0
+
+    def write(self, data):
+        mem = memoryview(data)
+        while len(mem) > 0:
+            if self.index >= len(self.extents):
+                raise ValueError(f'data exceeds the extents by {len(mem)} bytes')
+            start, size = self.extents[self.index]
+            n = min(len(mem), size - self.pos)
+            self.out_file.write(start + self.pos, mem[:n])
+            mem = mem[n:]
+            self.pos += n
+            self.written += n
+            if self.pos == size:
+                self.index += 1
+                self.pos = 0
+
+
+# (src block, dst block, blocks) runs which copy src extents to dst extents in order
+def extent_pairs(src_extents, dst_extents):
+    dst = [(e.start_block, e.num_blocks) for e in dst_extents]
+    i = 0
+    pos = 0
+    for e in src_extents:
+        start, num = e.start_block, e.num_blocks
+        while num > 0:
+            if i >= len(dst):
+                raise ValueError('source extents exceed the destination extents')
+            dst_start, dst_num = dst[i]
+            n = min(num, dst_num - pos)
+            yield start, dst_start + pos, n
+            start += n
+            num -= n
+            pos += n
+            if pos == dst_num:
+                i += 1
+                pos = 0
+
+
+# read length bytes at off in chunks, buf is reused for every chunk
+def read_chunks(file: mtio.MTIOBase, off: int, length: int, buf):
+    mem = memoryview(buf)
+    end = off + length
+    while off < end:
+        n = file.readinto(off, min(len(mem), end - off), mem)
+        if n == 0:
+            raise ValueError(f'unexpected end of payload at {off}')
+        yield mem[:n]
+        off += n
+
+
+class _ChunkReader:
+    # a file-like object over chunks, for zstandard.stream_reader
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+
+    def read(self, size: int = -1) -> bytes:
+        return bytes(next(self.chunks, b''))
+
+
+def _decompress_chunks(op_type, chunks, chunk_size: int):
+    if op_type == InstallOperation.REPLACE:
+        yield from chunks
+        return
+
+    if op_type == InstallOperation.ZSTD:
+        if zstandard is None:
+            # ZSTD_uncompress only accepts read-only buffers
+            yield ZSTD_uncompress(b''.join(bytes(c) for c in chunks))
+            return
+        reader = zstandard.ZstdDecompressor().stream_reader(_ChunkReader(chunks), read_size=chunk_size)
+        while True:
+            data = reader.read(chunk_size)
+            if len(data) == 0:
+                return
+            yield data
+
+    if op_type == InstallOperation.REPLACE_XZ:
+        dec = lzma.LZMADecompressor()
+    else:
+        dec = bz2.BZ2Decompressor()
+    for chunk in chunks:
+        data = dec.decompress(chunk, chunk_size)
+        yield data
+        # output beyond chunk_size stays in the decompressor
+        while not dec.eof and not dec.needs_input:
+            yield dec.decompress(b'', chunk_size)
+        if dec.eof:
+            return
+
+
+def _hashed(chunks, h):
+    for chunk in chunks:
+        h.update(chunk)
+        yield chunk
+
+
+def verify_data_hash(op: InstallOperation, data):
+    assert hashlib.sha256(data).digest() == op.data_sha256_hash, 'operation data hash mismatch'
+
+
+# apply a REPLACE, REPLACE_XZ, REPLACE_BZ or ZSTD op whose data comes in chunks,
+# at most chunk_size bytes of output are held at once
+def apply_op_chunks(op: InstallOperation, chunks, out_file: mtio.MTIOBase, block_size: int,
+                    chunk_size: int = DEFAULT_CHUNK_SIZE, check_hash: bool = True):
+    h = None
+    if check_hash and op.data_sha256_hash:
+        h = hashlib.sha256()
+        chunks = _hashed(chunks, h)
+
+    writer = ExtentWriter(out_file, op.dst_extents, block_size)
+    for data in _decompress_chunks(op.type, chunks, chunk_size):
+        writer.write(data)
+    # data after the end of the compressed stream still counts for the hash
+    for _ in chunks:
+        pass
+
+    if h is not None:
+        assert h.digest() == op.data_sha256_hash, 'operation data hash mismatch'
+    if op.type != InstallOperation.REPLACE:
+        assert writer.written == writer.size, f'decompressed {writer.written} bytes, expected {writer.size}'
+
+
+def zero_range(out_file: mtio.MTIOBase, off: int, size: int):
+    if out_file.punch_hole(off, size):
+        return
+    while size > 0:
+        n = min(size, len(_ZEROS))
+        out_file.write(off, memoryview(_ZEROS)[:n])
+        off += n
+        size -= n
+
+
+# apply an operation with its data to out_file, shared by worker threads and processes,
+# check_hash is False when the data hash is checked elsewhere
+def apply_op(op: InstallOperation, data, out_file: mtio.MTIOBase, old_file: mtio.MTIOBase,
+             block_size: int, diff: bool, chunk_size: int = DEFAULT_CHUNK_SIZE, check_hash: bool = True):
+    if op.type in STREAMING_TYPES:
+        apply_op_chunks(op, [data], out_file, block_size, chunk_size, check_hash)
+        return
+
+    if check_hash and op.data_sha256_hash:
+        verify_data_hash(op, data)
+
+    if op.type == InstallOperation.SOURCE_COPY:
+        if not diff:
+            print("SOURCE_COPY supported only for differential OTA")
+            sys.exit(-2)
+        for src, dst, n in extent_pairs(op.src_extents, op.dst_extents):
+            out_file.copy_range(old_file, src * block_size, dst * block_size, n * block_size)
+    elif op.type in (InstallOperation.SOURCE_BSDIFF, InstallOperation.BROTLI_BSDIFF):
+        if not diff:
+            print("SOURCE_BSDIFF supported only for differential OTA")
+            sys.exit(-3)
+        # the source extents gathered in one buffer, the output goes to the dst extents
+        # as it is patched
+        src = bytearray(sum(e.num_blocks for e in op.src_extents) * block_size)
+        mem = memoryview(src)
+        pos = 0
+        for ext in op.src_extents:
+            size = ext.num_blocks * block_size
+            if old_file.readinto(ext.start_block * block_size, size, mem[pos:pos + size]) != size:
+                raise ValueError(f'source image ends before block {ext.start_block + ext.num_blocks}')
+            pos += size
+        writer = ExtentWriter(out_file, op.dst_extents, block_size)
+        apply_patch(data, src, writer.write, chunk_size)
+    elif op.type in ZERO_TYPES:
+        for ext in op.dst_extents:
+            zero_range(out_file, ext.start_block * block_size, ext.num_blocks * block_size)
+    else:
+        raise ValueError("Unsupported type = %d" % op.type)
@@ -0,0 +1,96 @@
+import hashlib
+import struct
+
+from . import mtio
+from . import update_metadata_pb2 as um
+from .ziputil import ZIP_STORED, get_zip_index
+from .zip_entry import open_zip_entry
+
+
+def u32(x):
+    return struct.unpack(">I", x)[0]
+
+
+def u64(x):
+    return struct.unpack(">Q", x)[0]
+
+# zips searched for payload.bin inside a zip
+MAX_ZIP_NESTING = 3
+
+
+class Payload:
+    """
+    payload.bin of an OTA, or an OTA zip containing it: the manifest and where the
+    op data starts.
+    """
+
+    def __init__(self, payloadfile: mtio.MTIOBase, index_dir=None):
+        self.payloadfile = payloadfile
+        self.index_dir = index_dir
+        # dropped when payload.bin has to be inflated
+        self.fetch_engine = None
+
+    def open(self):
+        self.base_off = self.locate_payload()
+        self.parse_metadata()
+
+    # return the offset of payload.bin in a zip, a deflated or nested one replaces self.payloadfile
+    def locate_payload(self):
+        file = self.payloadfile
+        try:
+            index = get_zip_index(file)
+        except ValueError:
+            # not a zip
+            return 0
+
+        for _ in range(MAX_ZIP_NESTING):
+            if 'payload.bin' in index.entries:
+                entry = index.get('payload.bin')
+                if entry.compression_method == ZIP_STORED and file is self.payloadfile:
+                    return index.data_offset(entry)
+                self.payloadfile = open_zip_entry(file, index, 'payload.bin', self.index_dir)
+                if self.fetch_engine is not None:
+                    print('payload.bin is not stored in the zip, fetching without the fetch engine')
+                    self.fetch_engine = None
+                return 0
+            nested = [name for name in index.entries if name.endswith('.zip')]
+            if len(nested) != 1:
+                break
+            file = open_zip_entry(file, index, nested[0], self.index_dir)
+            index = get_zip_index(file)
+        return 0
+
+    def parse_metadata(self):
+        head_len = 4 + 8 + 8 + 4
+        fp = self.base_off
+        buffer = self.payloadfile.read(fp, head_len)
+        fp += head_len
+        assert len(buffer) == head_len
+        magic = buffer[:4]
+        assert magic == b"CrAU"
+
+        file_format_version = u64(buffer[4:12])
+        assert file_format_version == 2
+
+        manifest_size = u64(buffer[12:20])
+
+        metadata_signature_size = 0
+
+        if file_format_version > 1:
+            metadata_signature_size = u32(buffer[20:24])
+
+        manifest = self.payloadfile.read(fp, manifest_size)
+        fp += manifest_size
+        self.metadata_signature = self.payloadfile.read(fp, metadata_signature_size)
+        fp += metadata_signature_size
+        self.data_offset = fp - self.base_off
+        self.dam = um.DeltaArchiveManifest()
+        self.dam.ParseFromString(manifest)
+        self.manifest_hash = hashlib.sha256(manifest).hexdigest()
+        self.block_size = self.dam.block_size
+
+    def partition(self, name: str):
+        for partition in self.dam.partitions:
+            if partition.partition_name == name:
+                return partition
+        return None
@@ -0,0 +1,189 @@
+import signal
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from threading import Lock
+
+from . import mtio
+from .ops import apply_op, verify_data_hash
+from .update_metadata_pb2 import InstallOperation
+
+# output and source files kept open by each worker process
+WORKER_OPEN_FILES = 8
+
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # before python 3.13 it is registered again, which is harmless as
+        # workers share the resource tracker of the parent that unlinks it
+        return shared_memory.SharedMemory(name)
+
+
+# state of a worker process
+_block_size = None
+_diff = False
+_chunk_size = None
+_check_hash = True
+_files = OrderedDict()
+
+
+def _init_worker(block_size: int, diff: bool, chunk_size: int, check_hash: bool):
+    global _block_size, _diff, _chunk_size, _check_hash
+    # ctrl-c is handled by the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _block_size = block_size
+    _diff = diff
+    _chunk_size = chunk_size
+    _check_hash = check_hash
+
+
+def _open_file(path: str, mode: str) -> mtio.MTIOBase:
+    key = (path, mode)
+    f = _files.get(key)
+    if f is not None:
+        _files.move_to_end(key)
+        return f
+    f = mtio.MTFile(path, mode)
+    _files[key] = f
+    while len(_files) > WORKER_OPEN_FILES:
+        _, old = _files.popitem(last=False)
+        old.close()
+    return f
+
+
+def _apply_in_worker(op_data: bytes, shm_name, length: int, out_path: str, old_path):
+    op = InstallOperation()
+    op.ParseFromString(op_data)
+    out_file = _open_file(out_path, 'r+')
+    old_file = _open_file(old_path, 'r') if old_path is not None else None
+    if shm_name is None:
+        apply_op(op, b'', out_file, old_file, _block_size, _diff, _chunk_size, _check_hash)
+        return
+
+    shm = _attach_shared_memory(shm_name)
+    try:
+        with shm.buf[:length] as data:
+            apply_op(op, data, out_file, old_file, _block_size, _diff, _chunk_size, _check_hash)
+    finally:
+        shm.close()
+
+
+class SharedBufferPool:
+    """
+    Shared memory blocks for op data, reused like mtio.BufferPool.
+    Sizes are rounded up to a power of two of at least `min_size`, and at most
+    `max_bytes` of free blocks are kept.
+    """
+
+    def __init__(self, max_bytes: int, min_size: int = 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.min_size = min_size
+        self.lock = Lock()
+        # size -> free blocks
+        self.free = {}
+        self.free_bytes = 0
+        # name -> (block, size) of blocks handed out
+        self.used = {}
+
+    def acquire(self, size: int) -> shared_memory.SharedMemory:
+        bucket = max(self.min_size, 1 << (size - 1).bit_length())
+        with self.lock:
+            free = self.free.get(bucket)
+            if free:
+                shm = free.pop()
+                self.free_bytes -= bucket
+                self.used[shm.name] = (shm, bucket)
+                return shm
+        shm = shared_memory.SharedMemory(create=True, size=bucket)
+        with self.lock:
+            self.used[shm.name] = (shm, bucket)
+        return shm
+
+    def release(self, shm: shared_memory.SharedMemory):
+        with self.lock:
+            _, bucket = self.used.pop(shm.name)
+            if self.free_bytes + bucket <= self.max_bytes:
+                self.free.setdefault(bucket, []).append(shm)
+                self.free_bytes += bucket
+                return
+        shm.close()
+        shm.unlink()
+
+    def close(self):
+        with self.lock:
+            blocks = [shm for free in self.free.values() for shm in free]
+            blocks.extend(shm for shm, _ in self.used.values())
+            self.free.clear()
+            self.used.clear()
+            self.free_bytes = 0
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
+class ProcessOpEngine:
+    """
+    Apply ops in `workers` processes, for codecs and glue code which hold the GIL.
+    The calling threads read op data into shared memory, and the worker writes the
+    result directly to the output file, which it opens by path. With `hash_executor`, op
+    data hashes are checked there while the worker applies the op.
+    """
+
+    def __init__(self, workers: int, block_size: int, diff: bool, max_shared_bytes: int, chunk_size: int,
+                 hash_executor=None):
+        # workers forked before the tracker runs would start their own, and unlink
+        # blocks they attached to when they exit
+        resource_tracker.ensure_running()
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(block_size, bool(diff), chunk_size, hash_executor is None),
+        )
+        self.buffers = SharedBufferPool(max_shared_bytes)
+        self.hash_executor = hash_executor
+
+    def apply(self, op: InstallOperation, payloadfile: mtio.MTIOBase, off: int, length: int,
+              out_file: mtio.MTIOBase, old_file: mtio.MTIOBase):
+        old_path = old_file.path if old_file is not None else None
+        if length == 0:
+            self.executor.submit(_apply_in_worker, op.SerializeToString(), None, 0,
+                                 out_file.path, old_path).result()
+            return
+
+        shm = self.buffers.acquire(length)
+        try:
+            with shm.buf[:length] as buf:
+                n = payloadfile.readinto(off, length, buf)
+            self._apply_shared(op, shm, n, out_file.path, old_path)
+        finally:
+            self.buffers.release(shm)
+
+    # op data already in memory, e.g. fetched by the fetch engine
+    def apply_data(self, op: InstallOperation, data, out_file: mtio.MTIOBase, old_file: mtio.MTIOBase):
+        old_path = old_file.path if old_file is not None else None
+        shm = self.buffers.acquire(len(data))
+        try:
+            with shm.buf[:len(data)] as buf:
+                buf[:] = data
+            self._apply_shared(op, shm, len(data), out_file.path, old_path)
+        finally:
+            self.buffers.release(shm)
+
+    def _apply_shared(self, op: InstallOperation, shm, length: int, out_path: str, old_path):
+        with shm.buf[:length] as data:
+            check = None
+            if self.hash_executor is not None and op.data_sha256_hash:
+                check = self.hash_executor.submit(verify_data_hash, op, data)
+            try:
+                self.executor.submit(_apply_in_worker, op.SerializeToString(), shm.name, length,
+                                     out_path, old_path).result()
+            finally:
+                # data is in use until the hash is done
+                if check is not None:
+                    check.result()
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.buffers.close()
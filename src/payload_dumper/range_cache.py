@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import time
+from bisect import bisect_right, insort
+from threading import Lock
+
+from . import mtio
+
+# save the extent index after this many newly cached bytes
+INDEX_SAVE_INTERVAL = 64 * 1024 * 1024
+
+
+def _load_index(path: str):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_index(path: str, index):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, path)
+
+
+class RangeCache:
+    """
+    On-disk cache of byte ranges fetched from remote files.
+    Each remote is stored in a sparse data file with an extent index next to it,
+    and the least recently used extents of all remotes are evicted once the
+    total cached size exceeds `max_size`.
+    """
+
+    def __init__(self, path: str, max_size: int):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def open(self, url: str, etag, last_modified, size: int) -> 'CachedRemote':
+        key = hashlib.sha256(f'{url}\n{etag}\n{last_modified}\n{size}'.encode('utf-8')).hexdigest()
+        return CachedRemote(self, key, size)
+
+    def data_path(self, key: str) -> str:
+        return os.path.join(self.path, key + '.data')
+
+    def index_path(self, key: str) -> str:
+        return os.path.join(self.path, key + '.json')
+
+    def other_entries(self, key: str):
+        entries = {}
+        for name in os.listdir(self.path):
+            if not name.endswith('.json') or name == key + '.json':
+                continue
+            index = _load_index(os.path.join(self.path, name))
+            if index is not None:
+                entries[name[:-len('.json')]] = index
+        return entries
+
+
+class CachedRemote:
+    def __init__(self, cache: RangeCache, key: str, size: int):
+        self.cache = cache
+        self.key = key
+        self.size = size
+        self.lock = Lock()
+        self.dirty = 0
+        # sorted [start, end, last_used]
+        self.extents = []
+
+        data_path = cache.data_path(key)
+        index = _load_index(cache.index_path(key))
+        if index is not None and index.get('size') == size and os.path.exists(data_path):
+            self.extents = [list(e) for e in index['extents']]
+        else:
+            open(data_path, 'wb').close()
+        self.file = mtio.MTFile(data_path, 'r+')
+        self.file.set_sparse(True)
+        if self.file.get_size() != size:
+            self.file.set_size(size)
+
+        self.others = cache.other_entries(key)
+        self.others_size = sum(e[1] - e[0] for index in self.others.values() for e in index['extents'])
+        # the cap may have been lowered since the last run
+        with self.lock:
+            self._evict()
+
+    def cached_size(self) -> int:
+        return sum(e[1] - e[0] for e in self.extents)
+
+    # copy the cached parts of [off, end) into buf, return the missing [start, end) ranges
+    def lookup(self, off: int, end: int, buf):
+        missing = []
+        with self.lock:
+            now = time.time()
+            i = max(bisect_right(self.extents, [off, float('inf')]) - 1, 0)
+            pos = off
+            while pos < end:
+                if i < len(self.extents) and self.extents[i][1] <= pos:
+                    i += 1
+                elif i < len(self.extents) and self.extents[i][0] <= pos:
+                    e = self.extents[i]
+                    e_end = min(end, e[1])
+                    self.file.readinto(pos, e_end - pos, buf[pos - off:e_end - off])
+                    e[2] = now
+                    pos = e_end
+                    i += 1
+                else:
+                    gap_end = end if i >= len(self.extents) else min(end, self.extents[i][0])
+                    missing.append((pos, gap_end))
+                    pos = gap_end
+        return missing
+
+    def store(self, off: int, data):
+        end = off + len(data)
+        with self.lock:
+            self.file.write(off, data)
+            merged = [off, end, time.time()]
+            extents = []
+            for e in self.extents:
+                if e[1] < off or e[0] > end:
+                    extents.append(e)
+                else:
+                    merged[0] = min(merged[0], e[0])
+                    merged[1] = max(merged[1], e[1])
+            insort(extents, merged)
+            self.extents = extents
+            self.dirty += len(data)
+            self._evict()
+            if self.dirty >= INDEX_SAVE_INTERVAL:
+                self._save()
+
+    # trim the least recently used extents of every cached remote, lock held
+    def _evict(self):
+        excess = self.cached_size() + self.others_size - self.cache.max_size
+        if excess <= 0:
+            return
+
+        candidates = [(e[2], self.key, e) for e in self.extents]
+        for key, index in self.others.items():
+            candidates.extend((e[2], key, e) for e in index['extents'])
+        candidates.sort(key=lambda c: c[0])
+
+        touched = set()
+        for _, key, e in candidates:
+            if excess <= 0:
+                break
+            n = min(excess, e[1] - e[0])
+            e[1] -= n
+            excess -= n
+            touched.add(key)
+            if key == self.key:
+                self.file.punch_hole(e[1], n)
+            else:
+                self.others_size -= n
+                f = mtio.MTFile(self.cache.data_path(key), 'r+')
+                try:
+                    f.punch_hole(e[1], n)
+                finally:
+                    f.close()
+
+        self.extents = [e for e in self.extents if e[1] > e[0]]
+        for key in touched:
+            if key == self.key:
+                continue
+            index = self.others[key]
+            index['extents'] = [e for e in index['extents'] if e[1] > e[0]]
+            if len(index['extents']) == 0:
+                del self.others[key]
+                os.remove(self.cache.index_path(key))
+                os.remove(self.cache.data_path(key))
+            else:
+                _save_index(self.cache.index_path(key), index)
+
+    def _save(self):
+        # the data must reach the disk before the index claims it
+        self.file.sync()
+        _save_index(self.cache.index_path(self.key), {'size': self.size, 'extents': self.extents})
+        self.dirty = 0
+
+    def close(self):
+        with self.lock:
+            if self.file.closed():
+                return
+            self._save()
+            self.file.close()
@@ -0,0 +1,104 @@
+from contextlib import contextmanager
+from threading import Condition
+
+from .mtio import COPY_BUFFER_SIZE
+from .update_metadata_pb2 import InstallOperation
+
+# ops whose output is decompressed in memory before it is written
+DECOMPRESSED_TYPES = (
+    InstallOperation.REPLACE_XZ,
+    InstallOperation.REPLACE_BZ,
+    InstallOperation.ZSTD,
+)
+
+
+class ByteBudget:
+    """
+    Bytes held by admitted work, shared by threads. acquire blocks until the bytes fit
+    in `limit`; a request larger than the limit is admitted once nothing else is held.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.cond = Condition()
+
+    def _fits(self, n: int) -> bool:
+        return n == 0 or self.used == 0 or self.used + n <= self.limit
+
+    def acquire(self, n: int):
+        with self.cond:
+            # wake up now and then so ctrl-c is handled on windows too
+            while not self._fits(n):
+                self.cond.wait(0.5)
+            self.used += n
+
+    def release(self, n: int):
+        with self.cond:
+            self.used -= n
+            self.cond.notify_all()
+
+    @contextmanager
+    def held(self, n: int):
+        self.acquire(n)
+        try:
+            yield
+        finally:
+            self.release(n)
+
+
+# estimate of the memory used to apply op with length bytes of data
+def op_memory(op: InstallOperation, length: int, block_size: int, chunk_size: int, streamed: bool) -> int:
+    if streamed:
+        # a chunk of data and a chunk of output
+        return 2 * chunk_size
+    out_size = sum(e.num_blocks for e in op.dst_extents) * block_size
+    if op.type == InstallOperation.REPLACE:
+        return length
+    if op.type in DECOMPRESSED_TYPES:
+        return length + out_size
+    if op.type in (InstallOperation.ZERO, InstallOperation.DISCARD):
+        # zeros are punched or written from a shared buffer
+        return 0
+    if op.type == InstallOperation.SOURCE_COPY:
+        # copied by the kernel, or through a small buffer
+        return COPY_BUFFER_SIZE
+    # diffs hold the source and the patch, the output is patched a chunk at a time
+    # from a chunk of the source and of the patch streams
+    src_size = sum(e.num_blocks for e in op.src_extents) * block_size
+    return length + src_size + 3 * min(out_size, chunk_size)
+
+
+# relative cost of producing a byte of output, reading a byte of op data costs 1
+OP_COST_FACTORS = {
+    InstallOperation.REPLACE: 0.05,
+    InstallOperation.ZERO: 0.01,
+    InstallOperation.DISCARD: 0.01,
+    InstallOperation.SOURCE_COPY: 0.05,
+    InstallOperation.ZSTD: 0.3,
+    InstallOperation.REPLACE_XZ: 2,
+    InstallOperation.REPLACE_BZ: 4,
+    InstallOperation.SOURCE_BSDIFF: 4,
+    InstallOperation.BROTLI_BSDIFF: 4,
+}
+
+# ops costing more than this fraction of the work of a worker start first
+STRAGGLER_SHARE = 0.25
+
+
+def op_cost(op: InstallOperation, length: int, block_size: int) -> float:
+    out_size = sum(e.num_blocks for e in op.dst_extents) * block_size
+    return length + out_size * OP_COST_FACTORS.get(op.type, 1)
+
+
+def schedule_ops(items, workers: int):
+    """
+    Order (cost, offset, item) tuples for `workers` workers: ops which would make
+    the others wait if started late go first, longest first, then the rest by
+    payload offset so reads stay sequential. Returns the items.
+    """
+    items = list(items)
+    limit = sum(cost for cost, _, _ in items) / max(workers, 1) * STRAGGLER_SHARE
+    stragglers = sorted((i for i in items if i[0] > limit), key=lambda i: -i[0])
+    rest = sorted((i for i in items if i[0] <= limit), key=lambda i: i[1])
+    return [item for _, _, item in stragglers + rest]
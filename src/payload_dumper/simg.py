@@ -0,0 +1,149 @@
+import os
+import struct
+
+from .stream import OrderedStream, StreamImage
+
+SPARSE_HEADER_MAGIC = 0xED26FF3A
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+
+# magic, major and minor version, file and chunk header sizes, block size,
+# total blocks, total chunks, image checksum
+FILE_HEADER = struct.Struct("<IHHHHIIII")
+# type, reserved, blocks, bytes with the header
+CHUNK_HEADER = struct.Struct("<HHII")
+
+# RAW chunks are cut at this many bytes, the data of a chunk is written at once
+RAW_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class SparseWriter:
+    """
+    Write an image given in order, block by block, as an Android sparse image at
+    `path`. Blocks repeating a 4 byte value become FILL chunks, other blocks RAW chunks,
+    and the gaps between writes DONT_CARE chunks. The header, which counts the chunks,
+    is written last.
+    """
+
+    def __init__(self, path: str, size: int, block_size: int):
+        self.path = path
+        self.size = size
+        self.block_size = block_size
+        self.total_blocks = -(-size // block_size)
+        self.chunks = 0
+        # blocks in the chunks written so far
+        self.blocks = 0
+        # start of a block, at the end of an image whose size isn't a multiple of blocks
+        self.partial = bytearray()
+        # RAW chunk being gathered
+        self.raw = bytearray()
+        # value and blocks of the FILL chunk being gathered
+        self.fill = None
+        self.fill_blocks = 0
+        self.f = open(path, "wb")
+        self.f.write(bytes(FILE_HEADER.size))
+
+    def _chunk(self, chunk_type: int, blocks: int, data=b""):
+        self.f.write(CHUNK_HEADER.pack(chunk_type, 0, blocks, CHUNK_HEADER.size + len(data)))
+        self.f.write(data)
+        self.chunks += 1
+        self.blocks += blocks
+
+    def _flush(self):
+        if len(self.raw) > 0:
+            self._chunk(CHUNK_TYPE_RAW, len(self.raw) // self.block_size, self.raw)
+            self.raw = bytearray()
+        if self.fill is not None:
+            self._chunk(CHUNK_TYPE_FILL, self.fill_blocks, self.fill)
+            self.fill = None
+            self.fill_blocks = 0
+
+    def _add_blocks(self, mem: memoryview):
+        bs = self.block_size
+        for i in range(0, len(mem), bs):
+            # bytes compare faster than memoryviews
+            block = mem[i:i + bs].tobytes()
+            value = block[:4]
+            if block == value * (bs // 4):
+                if len(self.raw) > 0 or (self.fill is not None and self.fill != value):
+                    self._flush()
+                self.fill = value
+                self.fill_blocks += 1
+            else:
+                if self.fill is not None:
+                    self._flush()
+                self.raw += block
+                if len(self.raw) >= RAW_CHUNK_SIZE:
+                    self._flush()
+
+    def _pending_blocks(self) -> int:
+        return len(self.raw) // self.block_size + self.fill_blocks
+
+    def write(self, off: int, data):
+        # written ranges are whole blocks, except at the end of the image
+        gap = off // self.block_size - self.blocks - self._pending_blocks()
+        if gap > 0:
+            self._flush()
+            self._chunk(CHUNK_TYPE_DONT_CARE, gap)
+        mem = memoryview(data)
+        if len(self.partial) > 0:
+            n = min(len(mem), self.block_size - len(self.partial))
+            self.partial += mem[:n]
+            mem = mem[n:]
+            if len(self.partial) == self.block_size:
+                self._add_blocks(memoryview(self.partial))
+                self.partial = bytearray()
+        n = len(mem) // self.block_size * self.block_size
+        self._add_blocks(mem[:n])
+        self.partial += mem[n:]
+        if off + len(data) >= self.size:
+            self.close()
+
+    def close(self):
+        if self.f.closed:
+            return
+        if len(self.partial) > 0:
+            # the last block is padded with zeros
+            self.partial += bytes(self.block_size - len(self.partial))
+            self._add_blocks(memoryview(self.partial))
+        self._flush()
+        if self.blocks < self.total_blocks:
+            self._chunk(CHUNK_TYPE_DONT_CARE, self.total_blocks - self.blocks)
+        self.f.seek(0)
+        self.f.write(FILE_HEADER.pack(
+            SPARSE_HEADER_MAGIC, 1, 0, FILE_HEADER.size, CHUNK_HEADER.size, self.block_size,
+            self.total_blocks, self.chunks, 0,
+        ))
+        self.f.close()
+
+
+class SparseImageStream(OrderedStream):
+    """
+    Images written as Android sparse images, `<name>` in `out_dir`, while they are
+    extracted. Only the ranges written by ops are laid out, the rest of each image is
+    DONT_CARE.
+    """
+
+    def __init__(self, out_dir: str, block_size: int, window: int):
+        super().__init__(None, window)
+        self.out_dir = out_dir
+        self.block_size = block_size
+        self.writers = []
+
+    def add_image(self, name: str, size: int, data, hash: bool) -> StreamImage:
+        writer = SparseWriter(os.path.join(self.out_dir, name), size, self.block_size)
+        self.writers.append(writer)
+        image = StreamImage(self, size, hash, writer)
+        for off, n in data:
+            image.add_range(off, n)
+        return image
+
+    def finish_layout(self):
+        pass
+
+    def close(self):
+        super().close()
+        # images ending with a gap, or without data
+        for writer in self.writers:
+            writer.close()
@@ -0,0 +1,207 @@
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+
+from . import mtio
+from .ops import ZERO_TYPES, apply_op, extent_pairs
+from .payload import Payload
+from .update_metadata_pb2 import InstallOperation
+
+# run kinds of a SourceImage
+_ZERO = 0
+_COPY = 1
+_RAW = 2
+_DECODED = 3
+
+
+class DecodedCache:
+    """
+    LRU cache of the output of decoded source ops, up to `max_bytes`. An op decoded
+    by one thread is waited for by the others.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, decode):
+        with self.lock:
+            future = self.entries.get(key)
+            owner = future is None
+            if owner:
+                future = self.entries[key] = Future()
+            else:
+                self.entries.move_to_end(key)
+        if not owner:
+            return future.result()
+
+        try:
+            data = decode()
+        except BaseException as e:
+            with self.lock:
+                if self.entries.get(key) is future:
+                    del self.entries[key]
+            future.set_exception(e)
+            raise
+        future.set_result(data)
+        with self.lock:
+            # unless it was evicted while decoding
+            if self.entries.get(key) is future:
+                self.size += len(data)
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, old = self.entries.popitem(last=False)
+                if old.done() and old.exception() is None:
+                    self.size -= len(old.result())
+        return data
+
+
+class _OpOutput(mtio.MTIOBase):
+    # the dst extents of an op, packed in a buffer
+    def __init__(self, extents, block_size: int):
+        self.extents = []
+        pos = 0
+        for e in extents:
+            self.extents.append((e.start_block * block_size, e.num_blocks * block_size, pos))
+            pos += e.num_blocks * block_size
+        self.buffer = bytearray(pos)
+
+    def write(self, off: int, content) -> int:
+        mem = memoryview(content)
+        done = 0
+        for start, size, pos in self.extents:
+            if start <= off + done < start + size:
+                n = min(len(mem) - done, start + size - off - done)
+                at = pos + off + done - start
+                self.buffer[at:at + n] = mem[done:done + n]
+                done += n
+                if done == len(mem):
+                    break
+        if done != len(mem):
+            raise ValueError(f'write at {off} outside of the op extents')
+        return done
+
+    def punch_hole(self, off: int, size: int) -> bool:
+        return False
+
+
+class SourceImage(mtio.MTIOBase):
+    """
+    Read-only image of a partition of a payload, decoded on demand: a read only touches
+    the ops writing the blocks it covers. REPLACE data is read from the payload as is,
+    SOURCE_COPY blocks from `old`, and the output of other ops is decoded into `cache`.
+    An incremental payload reads its own source from `old`, another SourceImage for a
+    chain of payloads, so no intermediate image is written.
+    """
+
+    def __init__(self, payload: Payload, partition, old: mtio.MTIOBase, cache: DecodedCache):
+        self.payload = payload
+        self.partition = partition
+        self.old = old
+        self.cache = cache
+        self.block_size = bs = payload.block_size
+        self.path = None
+
+        # (start, end, kind, arg) byte ranges of the image
+        runs = []
+        for index, op in enumerate(partition.operations):
+            if op.type in ZERO_TYPES:
+                for e in op.dst_extents:
+                    runs.append((e.start_block * bs, (e.start_block + e.num_blocks) * bs, _ZERO, None))
+            elif op.type == InstallOperation.SOURCE_COPY:
+                for src, dst, n in extent_pairs(op.src_extents, op.dst_extents):
+                    runs.append((dst * bs, (dst + n) * bs, _COPY, src * bs))
+            else:
+                kind = _RAW if op.type == InstallOperation.REPLACE else _DECODED
+                pos = 0
+                for e in op.dst_extents:
+                    runs.append((e.start_block * bs, (e.start_block + e.num_blocks) * bs, kind, (index, pos)))
+                    pos += e.num_blocks * bs
+        runs.sort(key=lambda r: r[0])
+        self.runs = runs
+        self.starts = [r[0] for r in runs]
+        self.size = partition.new_partition_info.size or max((r[1] for r in runs), default=0)
+
+    def _decode(self, index: int) -> bytes:
+        op = self.partition.operations[index]
+        data = b''
+        if op.data_length > 0:
+            data = self.payload.payloadfile.read(
+                self.payload.base_off + self.payload.data_offset + op.data_offset, op.data_length
+            )
+        out = _OpOutput(op.dst_extents, self.block_size)
+        apply_op(op, data, out, self.old, self.block_size, True)
+        return out.buffer
+
+    def readinto(self, off: int, size: int, ba) -> int:
+        size = max(min(size, self.size - off), 0)
+        mem = memoryview(ba)[:size]
+        pos = 0
+        while pos < size:
+            at = off + pos
+            i = bisect_right(self.starts, at) - 1
+            if i < 0 or self.runs[i][1] <= at:
+                # no op writes here, the image has zeros
+                end = self.starts[i + 1] if i + 1 < len(self.starts) else off + size
+                n = min(size - pos, end - at)
+                mem[pos:pos + n] = bytes(n)
+                pos += n
+                continue
+
+            start, end, kind, arg = self.runs[i]
+            n = min(size - pos, end - at)
+            if kind == _ZERO:
+                mem[pos:pos + n] = bytes(n)
+            elif kind == _COPY:
+                got = self.old.readinto(arg + at - start, n, mem[pos:pos + n])
+                if got != n:
+                    raise ValueError(f'source image ends at {arg + at - start + got}')
+            elif kind == _RAW:
+                index, op_pos = arg
+                op = self.partition.operations[index]
+                data_off = self.payload.base_off + self.payload.data_offset + op.data_offset
+                # the data of a REPLACE op may end before its extents
+                length = max(min(n, op.data_length - op_pos - (at - start)), 0)
+                got = self.payload.payloadfile.readinto(data_off + op_pos + at - start, length, mem[pos:pos + length])
+                if got != length:
+                    raise ValueError(f'unexpected end of source payload at {data_off + op_pos + at - start + got}')
+                mem[pos + got:pos + n] = bytes(n - got)
+            else:
+                index, op_pos = arg
+                data = self.cache.get((id(self), index), lambda: self._decode(index))
+                mem[pos:pos + n] = data[op_pos + at - start:op_pos + at - start + n]
+            pos += n
+        return pos
+
+    def read(self, off: int, size: int) -> bytes:
+        buf = bytearray(max(min(size, self.size - off), 0))
+        n = self.readinto(off, len(buf), buf)
+        return bytes(buf[:n])
+
+    def get_size(self) -> int:
+        return self.size
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return False
+
+    def close(self):
+        pass
+
+    def closed(self) -> bool:
+        return False
+
+
+# the image of a partition after applying payloads in order, None if one lacks it
+def source_image(payloads, partition_name: str, cache: DecodedCache):
+    image = None
+    for payload in payloads:
+        partition = payload.partition(partition_name)
+        if partition is None:
+            return None
+        image = SourceImage(payload, partition, image, cache)
+    return image
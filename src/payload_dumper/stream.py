@@ -0,0 +1,313 @@
+import hashlib
+import heapq
+import json
+import tarfile
+import time
+from bisect import bisect_right
+from threading import Condition
+
+from . import mtio
+
+# zeros passed on for ranges nothing was written to
+_ZEROS = bytes(1024 * 1024)
+
+
+class OrderedStream:
+    """
+    A stream laid out ahead of time as literal bytes and ranges of images, written at
+    stream offsets in any order and passed on to `out` in order. Writes ahead of the
+    stream are kept until it reaches them; `admit` keeps them within `window` bytes.
+    Without `out`, the images are only given their data in order. `_after_emit` runs
+    once the lock is released, for work which must not hold up the stream.
+    """
+
+    def __init__(self, out, window: int):
+        self.out = out
+        self.window = window
+        self.size = 0
+        self.head = 0
+        # off -> data written ahead of head
+        self.pending = {}
+        # heap of (start, end) ranges complete, what was not written in them is zeros
+        self.complete = []
+        # (start, end, image, image offset) ranges of images, by start
+        self.ranges = []
+        self.starts = []
+        self.cond = Condition()
+
+    def add_literal(self, data: bytes):
+        if len(data) > 0:
+            self.pending[self.size] = data
+            self.size += len(data)
+
+    # lay out size bytes of image at image_off, zeros is True for a hole of the image
+    def add_range(self, image, image_off: int, size: int, zeros: bool = False) -> int:
+        start = self.size
+        self.ranges.append((start, start + size, image, image_off))
+        self.starts.append(start)
+        if zeros:
+            heapq.heappush(self.complete, (start, start + size))
+        self.size += size
+        return start
+
+    # wait until a write at [start, end) fits in the window, or is the next to be passed on
+    def admit(self, start: int, end: int):
+        with self.cond:
+            # literals before the first write go out here
+            self._advance()
+            # wake up now and then so ctrl-c is handled on windows too
+            while end > self.head + self.window and start > self.head:
+                self.cond.wait(0.5)
+        self._after_emit()
+
+    def write(self, off: int, data):
+        with self.cond:
+            if off == self.head:
+                self._emit(data)
+            else:
+                self.pending[off] = bytes(data)
+            self._advance()
+        self._after_emit()
+
+    # what was not written in [off, off + size) is zeros
+    def done(self, off: int, size: int):
+        with self.cond:
+            heapq.heappush(self.complete, (off, off + size))
+            self._advance()
+        self._after_emit()
+
+    def _after_emit(self):
+        pass
+
+    def _emit(self, data):
+        off = self.head
+        if self.out is not None:
+            self.out.write(data)
+        self.head += len(data)
+        i = bisect_right(self.starts, off) - 1
+        while 0 <= i < len(self.ranges) and self.ranges[i][0] < self.head:
+            start, end, image, image_off = self.ranges[i]
+            lo = max(start, off)
+            hi = min(end, self.head)
+            if lo < hi:
+                image.passed(image_off + lo - start, memoryview(data)[lo - off:hi - off])
+            i += 1
+
+    def _advance(self):
+        while True:
+            data = self.pending.pop(self.head, None)
+            if data is not None:
+                self._emit(data)
+                continue
+            while len(self.complete) > 0 and self.complete[0][1] <= self.head:
+                heapq.heappop(self.complete)
+            if len(self.complete) == 0 or self.complete[0][0] > self.head:
+                break
+            end = self.complete[0][1]
+            end = min((off for off in self.pending if self.head < off < end), default=end)
+            while self.head < end:
+                self._emit(memoryview(_ZEROS)[:min(len(_ZEROS), end - self.head)])
+        self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self._advance()
+            if self.head != self.size:
+                raise ValueError(f'stream stopped at {self.head} of {self.size} bytes')
+        self._after_emit()
+        if self.out is not None:
+            self.out.flush()
+
+
+class StreamImage(mtio.MTIOBase):
+    """
+    Write-only image laid out in an OrderedStream, as ranges of data; the rest of the
+    image is zeros. It is hashed while it is passed on when `hash` is set, and its data
+    is given to `sink` in order, with its offset, if set.
+    """
+
+    def __init__(self, stream: OrderedStream, size: int, hash: bool, sink=None):
+        self.stream = stream
+        self.size = size
+        self.sink = sink
+        self.path = None
+        # (image offset, size, stream offset) of the ranges in the stream
+        self.ranges = []
+        self.starts = []
+        self.sha = hashlib.sha256() if hash else None
+        self.pos = 0
+
+    def add_range(self, off: int, size: int, zeros: bool = False):
+        self.ranges.append((off, size, self.stream.add_range(self, off, size, zeros)))
+        self.starts.append(off)
+
+    # the stream offsets of (off, size) of the image, in pieces
+    def _map(self, off: int, size: int):
+        while size > 0:
+            i = bisect_right(self.starts, off) - 1
+            if i < 0 or off >= self.ranges[i][0] + self.ranges[i][1]:
+                raise ValueError(f'write at {off} outside of the image data')
+            start, n, stream_off = self.ranges[i]
+            n = min(size, start + n - off)
+            yield stream_off + off - start, n
+            off += n
+            size -= n
+
+    # [start, end) in the stream of the extents
+    def stream_range(self, extents, block_size: int):
+        start = end = None
+        for e in extents:
+            off = e.start_block * block_size
+            for off, n in self._map(off, min(e.num_blocks * block_size, self.size - off)):
+                start = off if start is None else min(start, off)
+                end = off + n if end is None else max(end, off + n)
+        return start, end
+
+    def write(self, off: int, content) -> int:
+        mem = memoryview(content)
+        pos = 0
+        for stream_off, n in self._map(off, len(mem)):
+            self.stream.write(stream_off, mem[pos:pos + n])
+            pos += n
+        return pos
+
+    # the range is written, what was not is zeros
+    def done(self, off: int, size: int):
+        size = min(size, self.size - off)
+        for stream_off, n in self._map(off, size):
+            self.stream.done(stream_off, n)
+
+    # data of the image at off went out, in order
+    def passed(self, off: int, data):
+        if self.sink is not None:
+            self.sink.write(off, data)
+        if self.sha is None:
+            return
+        self._hash_zeros(off)
+        self.sha.update(data)
+        self.pos = off + len(data)
+
+    def _hash_zeros(self, end: int):
+        while self.pos < end:
+            n = min(len(_ZEROS), end - self.pos)
+            self.sha.update(memoryview(_ZEROS)[:n])
+            self.pos += n
+
+    # the hash of the image, once the stream passed it
+    def digest(self) -> bytes:
+        self._hash_zeros(self.size)
+        return self.sha.digest()
+
+    def get_size(self) -> int:
+        return self.size
+
+    def readable(self) -> bool:
+        return False
+
+    def writable(self) -> bool:
+        return True
+
+    def close(self):
+        pass
+
+    def closed(self) -> bool:
+        return False
+
+
+# lay out an image with its holes as zeros
+def add_whole_image(image: StreamImage, data):
+    pos = 0
+    for off, n in data:
+        if off > pos:
+            image.add_range(pos, off - pos, zeros=True)
+        image.add_range(off, n)
+        pos = off + n
+    if pos < image.size:
+        image.add_range(pos, image.size - pos, zeros=True)
+
+
+class TarStream(OrderedStream):
+    """
+    Images as members of a tar archive. Images with holes are GNU sparse members,
+    only their data is in the archive.
+    """
+
+    def add_image(self, name: str, size: int, data, hash: bool) -> StreamImage:
+        image = StreamImage(self, size, hash)
+        data = list(data)
+        info = tarfile.TarInfo(name)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        data_size = sum(n for _, n in data)
+        sparse_map = b''
+        if data_size < size:
+            # GNU sparse format 1.0: the map of the data ranges leads the member data
+            info.name = "GNUSparseFile.0/" + name
+            info.pax_headers = {
+                "GNU.sparse.major": "1",
+                "GNU.sparse.minor": "0",
+                "GNU.sparse.name": name,
+                "GNU.sparse.realsize": str(size),
+            }
+            entries = data
+            if len(data) == 0 or data[-1][0] + data[-1][1] < size:
+                # the image ends with a hole
+                entries = data + [(size, 0)]
+            sparse_map = "".join([f"{len(entries)}\n"] + [f"{off}\n{n}\n" for off, n in entries]).encode()
+            sparse_map += bytes(-len(sparse_map) % tarfile.BLOCKSIZE)
+        info.size = len(sparse_map) + data_size
+        self.add_literal(info.tobuf(tarfile.PAX_FORMAT) + sparse_map)
+        for off, n in data:
+            image.add_range(off, n)
+        self.add_literal(bytes(-info.size % tarfile.BLOCKSIZE))
+        return image
+
+    def finish_layout(self):
+        # two zero blocks end the archive, padded to a full record
+        end = self.size + 2 * tarfile.BLOCKSIZE
+        self.add_literal(bytes(end - self.size + -end % tarfile.RECORDSIZE))
+
+
+class RawStream(OrderedStream):
+    """
+    Images one after another, `index` has where each one is.
+    """
+
+    def __init__(self, out, window: int):
+        super().__init__(out, window)
+        self.index = []
+
+    def add_image(self, name: str, size: int, data, hash: bool) -> StreamImage:
+        image = StreamImage(self, size, hash)
+        self.index.append({"name": name, "offset": self.size, "size": size})
+        add_whole_image(image, data)
+        return image
+
+    def finish_layout(self):
+        pass
+
+    def write_index(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.index, f, indent=4)
+
+
+STREAM_FORMATS = {
+    "tar": TarStream,
+    "raw": RawStream,
+}
+
+
+# merged (off, size) ranges of [0, size) covered by extents
+def data_ranges(extents, block_size: int, size: int):
+    ranges = []
+    for start, num in sorted((e.start_block, e.num_blocks) for e in extents):
+        off = start * block_size
+        end = min((start + num) * block_size, size)
+        if off >= end:
+            continue
+        if len(ranges) > 0 and off <= ranges[-1][0] + ranges[-1][1]:
+            last_off, last_size = ranges[-1]
+            ranges[-1] = (last_off, max(last_size, end - last_off))
+        else:
+            ranges.append((off, end - off))
+    return ranges
@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+from threading import Lock
+
+from . import mtio
+
+# bytes read at once when hashing a range back from the image
+READ_BACK_SIZE = 1024 * 1024
+
+
+class ImageVerifier:
+    """
+    Hash an image in order while it is being written, to compare it with the expected
+    hash without reading it again afterwards. Writes at the hashed position are hashed
+    right away and later ones are kept until the hash reaches them, up to `max_buffered`
+    bytes. Past that, and for ranges written without passing through `written` (worker
+    processes, holes), only the range is remembered and it is read back when reached,
+    usually from the page cache.
+    """
+
+    def __init__(self, file: mtio.MTIOBase, size: int, expected: bytes, max_buffered: int):
+        self.file = file
+        self.size = size
+        self.expected = expected
+        self.max_buffered = max_buffered
+        self.sha = hashlib.sha256()
+        self.pos = 0
+        # off -> (size, data or None to read it back)
+        self.pending = {}
+        self.buffered = 0
+        self.lock = Lock()
+
+    def written(self, off: int, data):
+        with self.lock:
+            if off == self.pos:
+                self.sha.update(data)
+                self.pos += len(data)
+            elif self.buffered + len(data) <= self.max_buffered:
+                self.pending[off] = (len(data), bytes(data))
+                self.buffered += len(data)
+            else:
+                self.pending[off] = (len(data), None)
+            self._advance()
+
+    # the range is in the image but its data was not seen
+    def done(self, off: int, size: int):
+        with self.lock:
+            if size > 0:
+                self.pending[off] = (size, None)
+            self._advance()
+
+    def _advance(self):
+        while self.pos in self.pending:
+            size, data = self.pending.pop(self.pos)
+            if data is None:
+                self._read_back(self.pos + size)
+            else:
+                self.sha.update(data)
+                self.buffered -= size
+                self.pos += size
+
+    def _read_back(self, end: int):
+        while self.pos < end:
+            data = self.file.read(self.pos, min(READ_BACK_SIZE, end - self.pos))
+            if len(data) == 0:
+                raise ValueError(f'image ends at {self.pos}, expected {end} bytes')
+            self.sha.update(data)
+            self.pos += len(data)
+
+    # call once every op is done, ranges no op wrote are read back
+    def finish(self) -> bool:
+        with self.lock:
+            self._advance()
+            while self.pos < self.size:
+                end = min((off for off in self.pending if off > self.pos), default=self.size)
+                self._read_back(end)
+                self._advance()
+            self.pending.clear()
+            return self.sha.digest() == self.expected
+
+
+class VerifyingMTIO(mtio.MTIOBase):
+    """
+    Pass the writes to an image on to its ImageVerifier.
+    """
+
+    def __init__(self, inner: mtio.MTIOBase, verifier: ImageVerifier):
+        self.inner = inner
+        self.verifier = verifier
+        self.path = getattr(inner, 'path', None)
+
+    def read(self, off: int, size: int) -> bytes:
+        return self.inner.read(off, size)
+
+    def readinto(self, off: int, size: int, ba) -> int:
+        return self.inner.readinto(off, size, ba)
+
+    def write(self, off: int, content: bytes) -> int:
+        n = self.inner.write(off, content)
+        self.verifier.written(off, content)
+        return n
+
+    def copy_range(self, src: mtio.MTIOBase, src_off: int, off: int, size: int) -> int:
+        n = self.inner.copy_range(src, src_off, off, size)
+        self.verifier.done(off, size)
+        return n
+
+    def punch_hole(self, off: int, size: int) -> bool:
+        if not self.inner.punch_hole(off, size):
+            return False
+        self.verifier.done(off, size)
+        return True
+
+    def get_size(self) -> int:
+        return self.inner.get_size()
+
+    def set_size(self, size: int):
+        self.inner.set_size(size)
+
+    def readable(self) -> bool:
+        return self.inner.readable()
+
+    def writable(self) -> bool:
+        return self.inner.writable()
+
+    def sync(self):
+        self.inner.sync()
+
+    def close(self):
+        self.inner.close()
+
+    def closed(self) -> bool:
+        return self.inner.closed()
+
+
+# (off, size) of the ranges of [0, size) outside of extents
+def uncovered_ranges(extents, block_size: int, size: int):
+    pos = 0
+    for start, num in sorted((e.start_block, e.num_blocks) for e in extents):
+        if start * block_size > pos:
+            yield pos, min(start * block_size, size) - pos
+        pos = max(pos, (start + num) * block_size)
+        if pos >= size:
+            return
+    if pos < size:
+        yield pos, size - pos
+
+
+def file_sha256(path: str) -> bytes:
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(READ_BACK_SIZE)
+            if len(data) == 0:
+                return sha.digest()
+            sha.update(data)
+
+
+def sidecar_path(path: str) -> str:
+    head, tail = os.path.split(path)
+    return os.path.join(head, '.%s.meta' % tail)
+
+
+# remember the hash of an image, valid as long as its size and mtime are unchanged
+def write_sidecar(path: str, sha256: bytes):
+    st = os.stat(path)
+    with open(sidecar_path(path), 'w') as f:
+        json.dump({"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": sha256.hex()}, f)
+
+
+def remove_sidecar(path: str):
+    try:
+        os.remove(sidecar_path(path))
+    except FileNotFoundError:
+        pass
+
+
+# the hash of an image from its sidecar, None if the image changed since
+def read_sidecar(path: str):
+    try:
+        st = os.stat(path)
+        with open(sidecar_path(path), 'r') as f:
+            meta = json.load(f)
+        if meta["size"] != st.st_size or meta["mtime_ns"] != st.st_mtime_ns:
+            return None
+        return bytes.fromhex(meta["sha256"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def image_matches(path: str, size: int, expected: bytes) -> bool:
+    """
+    Whether the image at path has the expected size and hash. The hash comes from the
+    sidecar when the image is unchanged since it was written, otherwise it is computed
+    and the sidecar is updated.
+    """
+    try:
+        if os.path.getsize(path) != size:
+            return False
+    except OSError:
+        return False
+    sha256 = read_sidecar(path)
+    if sha256 is None:
+        sha256 = file_sha256(path)
+        write_sidecar(path, sha256)
+    return sha256 == expected
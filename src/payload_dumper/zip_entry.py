@@ -0,0 +1,452 @@
+import ctypes
+import ctypes.util
+import hashlib
+import os
+import struct
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+
+from . import mtio
+from .ziputil import ZIP_STORED, ZipIndex
+
+ZIP_DEFLATED = 8
+
+# deflate window, the most a stream can refer back
+WINSIZE = 32768
+# compressed bytes read at once while building an index
+INDEX_READ_SIZE = 4 * 1024 * 1024
+
+INDEX_MAGIC = b'PDZIDX1\0'
+index_header_struct = '<8sQQIQI'
+index_point_struct = '<QQBI'
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_NEED_DICT = 2
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+
+
+class _ZStream(ctypes.Structure):
+    _fields_ = [
+        ('next_in', ctypes.c_void_p),
+        ('avail_in', ctypes.c_uint),
+        ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p),
+        ('avail_out', ctypes.c_uint),
+        ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p),
+        ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p),
+        ('zfree', ctypes.c_void_p),
+        ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int),
+        ('adler', ctypes.c_ulong),
+        ('reserved', ctypes.c_ulong),
+    ]
+
+
+def _load_libz():
+    name = ctypes.util.find_library('z') or ctypes.util.find_library('zlib')
+    if name is None:
+        return None
+    try:
+        libz = ctypes.CDLL(name)
+        p = ctypes.POINTER(_ZStream)
+        libz.zlibVersion.restype = ctypes.c_char_p
+        libz.inflateInit2_.argtypes = [p, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+        libz.inflate.argtypes = [p, ctypes.c_int]
+        libz.inflateEnd.argtypes = [p]
+        libz.inflatePrime.argtypes = [p, ctypes.c_int, ctypes.c_int]
+        libz.inflateSetDictionary.argtypes = [p, ctypes.c_void_p, ctypes.c_uint]
+    except (OSError, AttributeError):
+        return None
+    return libz
+
+
+# inflatePrime() and Z_BLOCK are needed to resume at any deflate block,
+# without them checkpoints are copies of zlib decompress objects kept in memory
+_libz = _load_libz()
+
+
+def _inflate_init(strm: _ZStream):
+    ret = _libz.inflateInit2_(ctypes.byref(strm), -15, _libz.zlibVersion(), ctypes.sizeof(strm))
+    if ret != Z_OK:
+        raise MemoryError(f'inflateInit2 failed: {ret}')
+
+
+def _check_inflate(strm: _ZStream, ret: int):
+    if ret == Z_NEED_DICT or ret < 0:
+        raise ValueError(f'inflate failed: {ret} {strm.msg}')
+
+
+class _Point:
+    def __init__(self, out_off: int, in_off: int, bits: int, state):
+        self.out_off = out_off
+        self.in_off = in_off
+        # unused bits of the byte before in_off
+        self.bits = bits
+        # the last WINSIZE bytes of output with libz, a zlib decompress object otherwise
+        self.state = state
+
+
+class DeflateIndex:
+    """
+    Checkpoints of a raw deflate stream every `span` bytes of output, so that any
+    range can be inflated from the nearest checkpoint instead of from the start
+    (like zlib's zran example). With libz the index can be saved and loaded.
+    """
+
+    def __init__(self, points, size: int, span: int):
+        self.points = points
+        self.size = size
+        self.span = span
+
+    @property
+    def persistable(self) -> bool:
+        return _libz is not None
+
+    @classmethod
+    def build(cls, file: mtio.MTIOBase, off: int, compressed_size: int, span: int) -> 'DeflateIndex':
+        if _libz is None:
+            return cls._build_zlib(file, off, compressed_size, span)
+
+        strm = _ZStream()
+        _inflate_init(strm)
+        window = (ctypes.c_char * WINSIZE)()
+        # the start of the stream needs no dictionary
+        points = [_Point(0, 0, 0, bytes(WINSIZE))]
+        totin = totout = last = 0
+        pos = 0
+        ret = Z_OK
+        try:
+            while ret != Z_STREAM_END:
+                if pos >= compressed_size:
+                    raise ValueError('truncated deflate stream')
+                chunk = bytearray(min(INDEX_READ_SIZE, compressed_size - pos))
+                n = file.readinto(off + pos, len(chunk), chunk)
+                if n != len(chunk):
+                    raise ValueError('truncated deflate stream')
+                pos += n
+                cbuf = (ctypes.c_char * n).from_buffer(chunk)
+                strm.next_in = ctypes.addressof(cbuf)
+                strm.avail_in = n
+                while True:
+                    if strm.avail_out == 0:
+                        strm.next_out = ctypes.addressof(window)
+                        strm.avail_out = WINSIZE
+                    totin += strm.avail_in
+                    totout += strm.avail_out
+                    # stop at the end of every deflate block
+                    ret = _libz.inflate(ctypes.byref(strm), Z_BLOCK)
+                    totin -= strm.avail_in
+                    totout -= strm.avail_out
+                    _check_inflate(strm, ret)
+                    if ret == Z_STREAM_END:
+                        break
+                    # at a block boundary, but not after the last block
+                    if strm.data_type & 128 and not strm.data_type & 64 and totout - last > span:
+                        left = strm.avail_out
+                        snapshot = window.raw[WINSIZE - left:] + window.raw[:WINSIZE - left]
+                        points.append(_Point(totout, totin, strm.data_type & 7, snapshot))
+                        last = totout
+                    # inflate may hold more output than the window had room for,
+                    # and it stops after the last block before reporting the end
+                    last_block_done = strm.data_type & 128 and strm.data_type & 64
+                    if strm.avail_in == 0 and strm.avail_out > 0 and not last_block_done:
+                        break
+                del cbuf
+        finally:
+            _libz.inflateEnd(ctypes.byref(strm))
+        return cls(points, totout, span)
+
+    @classmethod
+    def _build_zlib(cls, file: mtio.MTIOBase, off: int, compressed_size: int, span: int) -> 'DeflateIndex':
+        d = zlib.decompressobj(-15)
+        points = [_Point(0, 0, 0, d.copy())]
+        totout = last = 0
+        pos = 0
+        while not d.eof:
+            if pos >= compressed_size:
+                raise ValueError('truncated deflate stream')
+            chunk = file.read(off + pos, min(INDEX_READ_SIZE // 16, compressed_size - pos))
+            if len(chunk) == 0:
+                raise ValueError('truncated deflate stream')
+            pos += len(chunk)
+            totout += len(d.decompress(chunk))
+            if not d.eof and totout - last > span:
+                points.append(_Point(totout, pos - len(d.unconsumed_tail), 0, d.copy()))
+                last = totout
+        return cls(points, totout, span)
+
+    # inflate the output of points[i] up to the next point
+    def inflate_span(self, file: mtio.MTIOBase, off: int, compressed_size: int, i: int) -> bytearray:
+        point = self.points[i]
+        if i + 1 < len(self.points):
+            out_end = self.points[i + 1].out_off
+            in_end = self.points[i + 1].in_off + 1
+        else:
+            out_end = self.size
+            in_end = compressed_size
+        in_start = point.in_off - (1 if point.bits else 0)
+        comp = file.read(off + in_start, min(in_end, compressed_size) - in_start)
+        out = bytearray(out_end - point.out_off)
+
+        if _libz is None:
+            d = point.state.copy()
+            data = d.decompress(comp, len(out))
+            out[:len(data)] = data
+            n = len(data)
+        else:
+            comp = bytearray(comp)
+            strm = _ZStream()
+            _inflate_init(strm)
+            try:
+                skip = 0
+                if point.bits:
+                    _libz.inflatePrime(ctypes.byref(strm), point.bits, comp[0] >> (8 - point.bits))
+                    skip = 1
+                window = ctypes.create_string_buffer(point.state, WINSIZE)
+                _check_inflate(strm, _libz.inflateSetDictionary(ctypes.byref(strm), window, WINSIZE))
+                cbuf = (ctypes.c_char * len(comp)).from_buffer(comp)
+                obuf = (ctypes.c_char * len(out)).from_buffer(out)
+                strm.next_in = ctypes.addressof(cbuf) + skip
+                strm.avail_in = len(comp) - skip
+                strm.next_out = ctypes.addressof(obuf)
+                strm.avail_out = len(out)
+                while strm.avail_out > 0:
+                    ret = _libz.inflate(ctypes.byref(strm), Z_NO_FLUSH)
+                    _check_inflate(strm, ret)
+                    if ret == Z_STREAM_END or strm.avail_in == 0:
+                        break
+                n = len(out) - strm.avail_out
+                del cbuf, obuf
+            finally:
+                _libz.inflateEnd(ctypes.byref(strm))
+
+        if n != len(out):
+            raise ValueError(f'short inflate at {point.out_off}: {n} of {len(out)}')
+        return out
+
+    def save(self, path: str, compressed_size: int, crc32: int):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(struct.pack(index_header_struct, INDEX_MAGIC, compressed_size, self.size,
+                                crc32, self.span, len(self.points)))
+            for point in self.points:
+                window = zlib.compress(point.state)
+                f.write(struct.pack(index_point_struct, point.out_off, point.in_off, point.bits, len(window)))
+                f.write(window)
+        os.replace(tmp, path)
+
+    # return None if the index is missing or does not match
+    @classmethod
+    def load(cls, path: str, compressed_size: int, crc32: int, span: int):
+        if _libz is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(struct.calcsize(index_header_struct))
+                magic, comp_size, size, crc, index_span, count = struct.unpack(index_header_struct, header)
+                if (magic, comp_size, crc, index_span) != (INDEX_MAGIC, compressed_size, crc32, span):
+                    return None
+                points = []
+                for _ in range(count):
+                    out_off, in_off, bits, window_size = struct.unpack(
+                        index_point_struct, f.read(struct.calcsize(index_point_struct)))
+                    window = zlib.decompress(f.read(window_size))
+                    points.append(_Point(out_off, in_off, bits, window))
+        except (OSError, struct.error, zlib.error):
+            return None
+        return cls(points, size, span)
+
+
+class SliceMTIO(mtio.MTIOBase):
+    """
+    A read-only view of `size` bytes of another MTIOBase starting at `off`.
+    """
+
+    def __init__(self, inner: mtio.MTIOBase, off: int, size: int):
+        self.inner = inner
+        self.off = off
+        self.size = size
+
+    def readinto(self, off: int, size: int, ba) -> int:
+        size = max(min(size, self.size - off), 0)
+        return self.inner.readinto(self.off + off, size, ba)
+
+    def read(self, off: int, size: int) -> bytes:
+        size = max(min(size, self.size - off), 0)
+        return self.inner.read(self.off + off, size)
+
+    def plan_reads(self, ranges):
+        self.inner.plan_reads((self.off + off, sz) for off, sz in ranges)
+
+    def unplan_reads(self, ranges):
+        self.inner.unplan_reads((self.off + off, sz) for off, sz in ranges)
+
+    def get_size(self) -> int:
+        return self.size
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return False
+
+    def close(self):
+        self.inner.close()
+
+    def closed(self) -> bool:
+        return self.inner.closed()
+
+
+class DeflatedEntryMTIO(mtio.MTIOBase):
+    """
+    Random access to a deflated zip entry of another MTIOBase.
+    The whole entry is inflated once to build a DeflateIndex (loaded from `index_dir`
+    instead when a previous run saved it), then reads inflate only the spans they touch.
+    The last `cached_spans` inflated spans are kept, as op reads are mostly sequential.
+    """
+
+    def __init__(self, inner: mtio.MTIOBase, off: int, compressed_size: int, size: int,
+                 crc32: int = 0, index_dir: str = None, span: int = 4 * 1024 * 1024,
+                 cached_spans: int = 8):
+        self.inner = inner
+        self.off = off
+        self.compressed_size = compressed_size
+        self.size = size
+        self.cached_spans = cached_spans
+        self.lock = Lock()
+        # span index -> Future of its data
+        self.spans = OrderedDict()
+        self.is_closed = False
+
+        index = None
+        path = None
+        if index_dir is not None:
+            os.makedirs(index_dir, exist_ok=True)
+            key = hashlib.sha256(f'{compressed_size}\n{size}\n{crc32}'.encode('utf-8')).hexdigest()
+            path = os.path.join(index_dir, key + '.zidx')
+            index = DeflateIndex.load(path, compressed_size, crc32, span)
+        if index is None:
+            print(f'building deflate index of {size} bytes, this reads the whole entry once')
+            index = DeflateIndex.build(inner, off, compressed_size, span)
+            if index.size != size:
+                raise ValueError(f'inflated size {index.size} does not match the entry size {size}')
+            if path is not None and index.persistable:
+                index.save(path, compressed_size, crc32)
+        self.index = index
+        self.starts = [p.out_off for p in index.points]
+
+    def _span_index(self, off: int) -> int:
+        lo, hi = 0, len(self.starts)
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self.starts[mid] <= off:
+                lo = mid
+            else:
+                hi = mid
+        return lo
+
+    def _span(self, i: int):
+        owner = False
+        with self.lock:
+            future = self.spans.get(i)
+            if future is None:
+                future = Future()
+                self.spans[i] = future
+                owner = True
+                while len(self.spans) > self.cached_spans:
+                    self.spans.popitem(last=False)
+            else:
+                self.spans.move_to_end(i)
+
+        if owner:
+            try:
+                future.set_result(self.index.inflate_span(self.inner, self.off, self.compressed_size, i))
+            except BaseException as e:
+                with self.lock:
+                    if self.spans.get(i) is future:
+                        del self.spans[i]
+                future.set_exception(e)
+                raise
+        return future.result()
+
+    def readinto(self, off: int, size: int, ba) -> int:
+        if self.is_closed:
+            raise ValueError('closed!')
+
+        end = min(off + size, self.size)
+        mem = memoryview(ba)
+        pos = off
+        while pos < end:
+            i = self._span_index(pos)
+            data = self._span(i)
+            start = self.starts[i]
+            n = min(end, start + len(data)) - pos
+            mem[pos - off:pos - off + n] = memoryview(data)[pos - start:pos - start + n]
+            pos += n
+        return max(end - off, 0)
+
+    def read(self, off: int, size: int) -> bytes:
+        ba = bytearray(max(min(size, self.size - off), 0))
+        self.readinto(off, len(ba), ba)
+        return ba
+
+    # compressed input of the spans these reads touch
+    def _span_inputs(self, ranges):
+        spans = set()
+        for off, sz in ranges:
+            if sz == 0:
+                continue
+            first = self._span_index(off)
+            last = self._span_index(min(off + sz, self.size) - 1)
+            spans.update(range(first, last + 1))
+        points = self.index.points
+        planned = []
+        for i in sorted(spans):
+            in_start = points[i].in_off - (1 if points[i].bits else 0)
+            in_end = points[i + 1].in_off + 1 if i + 1 < len(points) else self.compressed_size
+            planned.append((self.off + in_start, min(in_end, self.compressed_size) - in_start))
+        return planned
+
+    def plan_reads(self, ranges):
+        self.inner.plan_reads(self._span_inputs(ranges))
+
+    # spans served from the cache leave their planned input unread
+    def unplan_reads(self, ranges):
+        self.inner.unplan_reads(self._span_inputs(ranges))
+
+    def get_size(self) -> int:
+        return self.size
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return False
+
+    def close(self):
+        if self.is_closed:
+            return
+        self.is_closed = True
+        self.spans.clear()
+        self.inner.close()
+
+    def closed(self) -> bool:
+        return self.is_closed
+
+
+# return a 0-based MTIOBase of the entry, stored or deflated
+def open_zip_entry(file: mtio.MTIOBase, index: ZipIndex, name: str, index_dir: str = None) -> mtio.MTIOBase:
+    entry = index.get(name)
+    off = index.data_offset(entry)
+    if entry.compression_method == ZIP_STORED:
+        return SliceMTIO(file, off, entry.uncompressed_size)
+    if entry.compression_method == ZIP_DEFLATED:
+        return DeflatedEntryMTIO(file, off, entry.compressed_size, entry.uncompressed_size,
+                                 entry.crc32, index_dir)
+    raise ValueError(f'unsupported compression method {entry.compression_method} of {name}')
@@ -1,4 +1,6 @@
 import struct
+from threading import Lock
+
 from . import mtio
 
 zip_eocd_struct = b"<4s4H2LH"
@@ -24,137 +26,171 @@ zip_fh_size = struct.calcsize(zip_fh_struct)
 ZIP_MAX_COMMENT = (1 << 16) - 1
 ZIP_STORED = 0
 
-def get_zip_stored_entry_offset(file: mtio.MTIOBase, name: str):
-    sz = file.get_size()
+ZIP_FLAG_UTF8 = 0x800
+
+
+class ZipEntry:
+    def __init__(self, name: str, compression_method: int, crc32: int, compressed_size: int,
+                 uncompressed_size: int, lfh_offset: int):
+        self.name = name
+        self.compression_method = compression_method
+        self.crc32 = crc32
+        self.compressed_size = compressed_size
+        self.uncompressed_size = uncompressed_size
+        self.lfh_offset = lfh_offset
+        # offset of the entry data, known once the local file header has been read
+        self.data_offset = None
 
+
+def _find_eocd(file: mtio.MTIOBase, sz: int):
     if sz < zip_eocd_size:
         raise ValueError('not enough length to contain EOCD!')
 
-    eocd_off = None
     data = file.read(sz - zip_eocd_size, zip_eocd_size)
     if (len(data) == zip_eocd_size and
         data[0:4] == zip_eocd_magic and
         data[-2:] == b"\000\000"):
-        eocd_off = sz - zip_eocd_size
-    else:
-        try_sz = ZIP_MAX_COMMENT + zip_eocd_size
-        start = sz - try_sz
-        if start < 0:
-            start = 0
-            try_sz = sz
-        data = file.read(start, try_sz)
-        assert len(data) == try_sz
-        for length in range(1, try_sz - zip_eocd_size + 1):
-            l, = struct.unpack('<H', data[-length-2:-length])
-            if (l == length and
-                data[-length-zip_eocd_size:-length-zip_eocd_size+4] == zip_eocd_magic):
-                data = data[-length-zip_eocd_size:-length]
-                eocd_off = sz - length - zip_eocd_size
-                break
-
-    if eocd_off is None:
-        raise ValueError('not a zip!')
-
-    endrec = struct.unpack(zip_eocd_struct, data)
-    cd_num = endrec[4]
-    cd_sz = endrec[5]
-    cd_off = endrec[6]
-
-    if not (cd_num == 0xffff or cd_sz == 0xffffffff or cd_off == 0xffffffff):
-        #print(f'{cd_num=} {cd_sz=} {cd_off=}')
-        is_zip64 = False
-        pass
-    else:
-        #print('zip64')
-        eocd64_locator_off = eocd_off - zip64_eocd_locator_size
-        if eocd64_locator_off < 0:
-            raise ValueError(f'unexpected eocd64_locator_off {eocd_off} - {zip64_eocd_locator_size}')
-        data2 = file.read(eocd64_locator_off, zip64_eocd_locator_size)
-        if data2[0:4] != zip64_eocd_locator_magic:
-            raise ValueError(f'unexpected EOCD64Locator magic {data2[0:4]}, expected {zip64_eocd_locator_magic}')
-        eocd64_locator = struct.unpack(zip64_eocd_locator_struct, data2)
-        eocd64_off = eocd64_locator[2]
-        data2 = file.read(eocd64_off, zip64_eocd_size)
-        if data2[0:4] != zip64_eocd_magic:
-            raise ValueError(f'unexpected EOCD64Locator magic {data2[0:4]}, expected {zip64_eocd_magic}')
-        eocd64 = struct.unpack(zip64_eocd_struct, data2)
-        cd_num = eocd64[7]
-        cd_sz = eocd64[8]
-        cd_off = eocd64[9]
-        #print(f'{cd_num=} {cd_sz=} {cd_off=}')
-        is_zip64 = True
-
-    data = file.read(cd_off, cd_sz)
-    i = 0
-    p = 0
-
-    name_utf8 = name.encode('utf-8')
-    lfh_offset = None
-    entry_size = None
-
-    while i < cd_num and p < cd_sz:
-        cd = data[p:p+zip_cdfh_size]
-        if cd[0:4] != zip_cdfh_magic:
-            raise ValueError(f'invalid cd magic at {i=} {p=} {cd[0:4]}, expected {zip_cdfh_magic}')
-        cd = struct.unpack(zip_cdfh_struct, cd)
-        #print(cd)
-        file_name_length = cd[10]
-        extra_field_length = cd[11]
-        file_comment_length = cd[12]
-        cd_ent_sz = zip_cdfh_size + file_name_length + extra_field_length + file_comment_length
-        #print(data[p+sizeCentralDir:p+sizeCentralDir+file_name_length])
-        file_name = data[p+zip_cdfh_size:p+zip_cdfh_size+file_name_length]
-        #print(file_name)
-        if file_name == name_utf8:
+        return sz - zip_eocd_size, data
+
+    try_sz = ZIP_MAX_COMMENT + zip_eocd_size
+    start = sz - try_sz
+    if start < 0:
+        start = 0
+        try_sz = sz
+    data = file.read(start, try_sz)
+    assert len(data) == try_sz
+    for length in range(1, try_sz - zip_eocd_size + 1):
+        l, = struct.unpack('<H', data[-length-2:-length])
+        if (l == length and
+            data[-length-zip_eocd_size:-length-zip_eocd_size+4] == zip_eocd_magic):
+            return sz - length - zip_eocd_size, data[-length-zip_eocd_size:-length]
+
+    raise ValueError('not a zip!')
+
+
+def _parse_zip64_extra(extra, uncompressed_size: int, compressed_size: int, lfh_off: int):
+    ep = 0
+    while len(extra) - ep >= 4:
+        header_id, field_size = struct.unpack('<HH', extra[ep:ep+4])
+        if field_size + ep + 4 > len(extra):
+            raise ValueError(f'invalid extra field size {field_size} at {ep=}')
+        # ZIP64 ext
+        if header_id == 1:
+            ext_data = extra[ep+4:ep+4+field_size]
+            if uncompressed_size == 0xffffffff:
+                uncompressed_size, = struct.unpack('<Q', ext_data[:8])
+                ext_data = ext_data[8:]
+            if compressed_size == 0xffffffff:
+                compressed_size, = struct.unpack('<Q', ext_data[:8])
+                ext_data = ext_data[8:]
+            if lfh_off == 0xffffffff:
+                lfh_off, = struct.unpack('<Q', ext_data[:8])
+        ep += field_size + 4
+    return uncompressed_size, compressed_size, lfh_off
+
+
+class ZipIndex:
+    """
+    Entries of a zip file, parsed once from its central directory (zip64 included).
+    """
+
+    def __init__(self, file: mtio.MTIOBase):
+        self.file = file
+        self.lock = Lock()
+        self.entries = {}
+
+        eocd_off, data = _find_eocd(file, file.get_size())
+        endrec = struct.unpack(zip_eocd_struct, data)
+        cd_num = endrec[4]
+        cd_sz = endrec[5]
+        cd_off = endrec[6]
+
+        if cd_num == 0xffff or cd_sz == 0xffffffff or cd_off == 0xffffffff:
+            eocd64_locator_off = eocd_off - zip64_eocd_locator_size
+            if eocd64_locator_off < 0:
+                raise ValueError(f'unexpected eocd64_locator_off {eocd_off} - {zip64_eocd_locator_size}')
+            data = file.read(eocd64_locator_off, zip64_eocd_locator_size)
+            if data[0:4] != zip64_eocd_locator_magic:
+                raise ValueError(f'unexpected EOCD64Locator magic {data[0:4]}, expected {zip64_eocd_locator_magic}')
+            eocd64_locator = struct.unpack(zip64_eocd_locator_struct, data)
+            eocd64_off = eocd64_locator[2]
+            data = file.read(eocd64_off, zip64_eocd_size)
+            if data[0:4] != zip64_eocd_magic:
+                raise ValueError(f'unexpected EOCD64 magic {data[0:4]}, expected {zip64_eocd_magic}')
+            eocd64 = struct.unpack(zip64_eocd_struct, data)
+            cd_num = eocd64[7]
+            cd_sz = eocd64[8]
+            cd_off = eocd64[9]
+
+        data = file.read(cd_off, cd_sz)
+        i = 0
+        p = 0
+        while i < cd_num and p < cd_sz:
+            cd = data[p:p+zip_cdfh_size]
+            if cd[0:4] != zip_cdfh_magic:
+                raise ValueError(f'invalid cd magic at {i=} {p=} {cd[0:4]}, expected {zip_cdfh_magic}')
+            cd = struct.unpack(zip_cdfh_struct, cd)
+            flags = cd[3]
             compression_method = cd[4]
-            file_compressed_size = cd[8]
-            file_uncompressed_size = cd[9]
-            file_lfh_off = cd[16]
-            disk_number = cd[13]
-            if is_zip64:
-                ep = p + zip_cdfh_size + file_name_length
-                ee = ep + extra_field_length
-                while ee - ep >= 4:
-                    header_id, field_size = struct.unpack('<HH', data[ep:ep+4])
-                    if field_size + ep > ee:
-                        raise ValueError(f'invalid extra field size {field_size} at {ep=} {ee=}')
-                    # ZIP64 ext
-                    if header_id == 1:
-                        ext_data = data[ep+4:ep+4+field_size]
-                        if file_uncompressed_size == 0xffffffff:
-                            file_uncompressed_size, = struct.unpack('<Q', ext_data[:8])
-                            ext_data = ext_data[8:]
-                        if file_compressed_size == 0xffffffff:
-                            file_compressed_size, = struct.unpack('<Q', ext_data[:8])
-                            ext_data = ext_data[8:]
-                        if file_lfh_off == 0xffffffff:
-                            file_lfh_off, = struct.unpack('<Q', ext_data[:8])
-                            ext_data = ext_data[8:]
-                        if disk_number == 0xffff:
-                            disk_number, = struct.unpack('<I', ext_data[:4])
-                            ext_data = ext_data[4:]
-                        if len(ext_data) != 0:
-                            print('unconsumed ZIP64 ext?')
-                    ep += field_size + 4
-            #print(f'{i=} {p=} {file_name=} {compression_method=} {file_uncompressed_size=} {file_lfh_off=} {file_uncompressed_size=} {disk_number=}')
-            if compression_method != ZIP_STORED:
-                raise ValueError(f'target not stored: {compression_method=}')
-            lfh_offset = file_lfh_off
-            entry_size = file_uncompressed_size
-            break
-        p += cd_ent_sz
-        i += 1
-
-    if lfh_offset is None:
-        raise ValueError(f'target not found: {name}')
-
-    data = file.read(lfh_offset, zip_fh_size)
-    if data[0:4] != zip_fh_magic:
-        raise ValueError(f'unexpected file header magic at {lfh_offset}: {data[0:4]}, expected {zip_fh_magic}')
-
-    file_header = struct.unpack(zip_fh_struct, data)
-    file_name_length = file_header[9]
-    extra_field_length = file_header[10]
-    real_off = lfh_offset + zip_fh_size + file_name_length + extra_field_length
-
-    return real_off, entry_size
+            crc32 = cd[7]
+            compressed_size = cd[8]
+            uncompressed_size = cd[9]
+            file_name_length = cd[10]
+            extra_field_length = cd[11]
+            file_comment_length = cd[12]
+            lfh_off = cd[16]
+            name_off = p + zip_cdfh_size
+            extra_off = name_off + file_name_length
+            file_name = bytes(data[name_off:extra_off])
+            if 0xffffffff in (compressed_size, uncompressed_size, lfh_off):
+                uncompressed_size, compressed_size, lfh_off = _parse_zip64_extra(
+                    data[extra_off:extra_off+extra_field_length], uncompressed_size, compressed_size, lfh_off)
+            name = file_name.decode('utf-8' if flags & ZIP_FLAG_UTF8 else 'cp437')
+            self.entries[name] = ZipEntry(name, compression_method, crc32, compressed_size, uncompressed_size, lfh_off)
+            p = extra_off + extra_field_length + file_comment_length
+            i += 1
+
+    def get(self, name: str) -> ZipEntry:
+        entry = self.entries.get(name)
+        if entry is None:
+            raise ValueError(f'target not found: {name}')
+        return entry
+
+    def data_offset(self, entry: ZipEntry) -> int:
+        with self.lock:
+            if entry.data_offset is not None:
+                return entry.data_offset
+
+        data = self.file.read(entry.lfh_offset, zip_fh_size)
+        if data[0:4] != zip_fh_magic:
+            raise ValueError(f'unexpected file header magic at {entry.lfh_offset}: {data[0:4]}, expected {zip_fh_magic}')
+
+        file_header = struct.unpack(zip_fh_struct, data)
+        file_name_length = file_header[9]
+        extra_field_length = file_header[10]
+        with self.lock:
+            entry.data_offset = entry.lfh_offset + zip_fh_size + file_name_length + extra_field_length
+            return entry.data_offset
+
+    # return the offset and size of a stored (uncompressed) entry
+    def stored_entry_offset(self, name: str):
+        entry = self.get(name)
+        if entry.compression_method != ZIP_STORED:
+            raise ValueError(f'target not stored: compression_method={entry.compression_method}')
+        return self.data_offset(entry), entry.uncompressed_size
+
+
+_zip_index_lock = Lock()
+
+
+# the index is kept on the file, it lives as long as the file
+def get_zip_index(file: mtio.MTIOBase) -> ZipIndex:
+    with _zip_index_lock:
+        index = getattr(file, "zip_index", None)
+        if index is None:
+            index = file.zip_index = ZipIndex(file)
+    return index
+
+
+def get_zip_stored_entry_offset(file: mtio.MTIOBase, name: str):
+    return get_zip_index(file).stored_entry_offset(name)
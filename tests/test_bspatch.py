@@ -0,0 +1,84 @@
+import bz2
+import random
+
+import brotli
+import bsdiff4
+import pytest
+from bsdiff4.core import decode_int64, encode_int64
+
+from payload_dumper.bspatch import apply_patch, patch_size
+
+
+# the patch with its streams compressed with algs, 0 none, 1 bzip2, 2 brotli
+def bsdf2(patch: bytes, algs) -> bytes:
+    len_control = decode_int64(patch[8:16])
+    len_diff = decode_int64(patch[16:24])
+    streams = [
+        bz2.decompress(patch[32:32 + len_control]),
+        bz2.decompress(patch[32 + len_control:32 + len_control + len_diff]),
+        bz2.decompress(patch[32 + len_control + len_diff:]),
+    ]
+    compressed = [s if a == 0 else bz2.compress(s) if a == 1 else brotli.compress(s) for s, a in zip(streams, algs)]
+    return (b"BSDF2" + bytes(algs) + encode_int64(len(compressed[0])) + encode_int64(len(compressed[1]))
+            + patch[24:32] + b"".join(compressed))
+
+
+def edit(rng: random.Random, src: bytes) -> bytes:
+    # moved and changed parts of src, with new data
+    n = len(src)
+    new = bytearray(src[rng.randint(0, n):] + src[:rng.randint(0, n)])
+    for _ in range(rng.randint(0, 10)):
+        if len(new) > 0:
+            i = rng.randrange(len(new))
+            new[i:i + rng.randint(1, 300)] = rng.randbytes(rng.randint(0, 300))
+    return bytes(new)
+
+
+def patch(data, src, chunk_size):
+    out = []
+    apply_patch(data, bytearray(src), out.append, chunk_size)
+    assert all(len(o) <= chunk_size for o in out)
+    return b"".join(out)
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096, 1 << 20])
+def test_matches_bsdiff4(seed, chunk_size):
+    rng = random.Random(seed)
+    src = rng.randbytes(rng.randint(0, 30000))
+    new = edit(rng, src)
+    data = bsdiff4.diff(src, new)
+    assert patch_size(data) == len(new)
+    assert patch(data, src, chunk_size) == new
+
+
+@pytest.mark.parametrize("algs", [(0, 0, 0), (2, 2, 2), (1, 2, 0), (2, 0, 1)])
+@pytest.mark.parametrize("chunk_size", [3, 1000, 1 << 20])
+def test_bsdf2(algs, chunk_size):
+    rng = random.Random(sum(algs) * 7 + chunk_size)
+    src = bytes(rng.choices(b"abcd", k=50000))
+    new = edit(rng, src)
+    assert patch(bsdf2(bsdiff4.diff(src, new), algs), src, chunk_size) == new
+
+
+def test_empty_output():
+    assert patch(bsdiff4.diff(b"abc", b""), b"abc", 16) == b""
+
+
+def test_bad_magic():
+    with pytest.raises(ValueError):
+        patch(b"NOTAPTCH" + bytes(24), b"", 16)
+
+
+def test_unknown_algorithm():
+    data = bsdf2(bsdiff4.diff(b"abc" * 100, b"abd" * 100), (2, 2, 2))
+    data = data[:5] + bytes([3]) + data[6:]
+    with pytest.raises(ValueError):
+        patch(data, b"abc" * 100, 16)
+
+
+def test_truncated_patch():
+    src = random.Random(1).randbytes(5000)
+    data = bsdiff4.diff(src, edit(random.Random(2), src))
+    with pytest.raises(ValueError):
+        patch(data[:-20], src, 64)
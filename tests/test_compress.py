@@ -0,0 +1,76 @@
+import lzma
+import random
+import struct
+import threading
+
+import pytest
+from zstd import ZSTD_uncompress
+
+from payload_dumper.compress import ZSTD_SEEKABLE_MAGIC, ZSTD_SKIPPABLE_MAGIC, CompressedStream
+
+FRAME_SIZE = 4096
+
+
+# the frames of a seekable zstd file, by its seek table
+def read_zst(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    count, flags, magic = struct.unpack("<IBI", data[-9:])
+    assert magic == ZSTD_SEEKABLE_MAGIC and flags == 0
+    table_size = count * 8 + 9
+    skippable_magic, size = struct.unpack("<II", data[-table_size - 8:-table_size])
+    assert skippable_magic == ZSTD_SKIPPABLE_MAGIC and size == table_size
+    out = bytearray()
+    pos = 0
+    for i in range(count):
+        compressed, uncompressed = struct.unpack("<II", data[-table_size + i * 8:-table_size + i * 8 + 8])
+        frame = ZSTD_uncompress(data[pos:pos + compressed])
+        assert len(frame) == uncompressed
+        out += frame
+        pos += compressed
+    assert pos == len(data) - table_size - 8
+    return bytes(out)
+
+
+def read_xz(path):
+    with open(path, "rb") as f:
+        return lzma.decompress(f.read(), format=lzma.FORMAT_XZ)
+
+
+READERS = {"zst": read_zst, "xz": read_xz}
+
+
+@pytest.mark.parametrize("ext", ["zst", "xz"])
+def test_compressed_images(tmp_path, ext):
+    stream = CompressedStream(str(tmp_path), ext, 1, 2, 64 * 1024, frame_size=FRAME_SIZE)
+    rng = random.Random(1)
+    size = 40 * FRAME_SIZE + 123
+    data = bytearray(rng.randbytes(size))
+    data[5 * FRAME_SIZE:20 * FRAME_SIZE] = bytes(15 * FRAME_SIZE)
+    image = stream.add_image("a.img", size, [(0, size)], False)
+    stream.add_image("zeros.img", 3 * FRAME_SIZE + 1, [], False)
+    stream.add_image("empty.img", 0, [], False)
+    stream.finish_layout()
+
+    # threads write in order of their own pieces, as ops are submitted in stream order
+    pieces = list(range(0, size, 777))
+    rng.shuffle(pieces)
+
+    def work(part):
+        for off in sorted(part):
+            n = min(777, size - off)
+            start = image.ranges[0][2] + off
+            stream.admit(start, start + n)
+            image.write(off, data[off:off + n])
+
+    threads = [threading.Thread(target=work, args=(pieces[i::4],)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stream.close()
+
+    read = READERS[ext]
+    assert read(tmp_path / f"a.img.{ext}") == data
+    assert read(tmp_path / f"zeros.img.{ext}") == bytes(3 * FRAME_SIZE + 1)
+    assert read(tmp_path / f"empty.img.{ext}") == b""
@@ -0,0 +1,134 @@
+import hashlib
+import lzma
+import os
+import random
+import struct
+import subprocess
+import sys
+from pathlib import Path
+
+import bsdiff4
+import pytest
+
+from payload_dumper import update_metadata_pb2 as um
+from payload_dumper.journal import JOURNAL_NAME
+from payload_dumper.verify import sidecar_path
+
+BS = 4096
+BLOCKS = 64
+SRC = str(Path(__file__).resolve().parent.parent / "src")
+
+
+# write a payload.bin of one partition, ops are (type, dst extents, data, src extents)
+def write_payload(path, image: bytes, ops):
+    manifest = um.DeltaArchiveManifest()
+    manifest.block_size = BS
+    partition = manifest.partitions.add()
+    partition.partition_name = "system"
+    partition.new_partition_info.size = len(image)
+    partition.new_partition_info.hash = hashlib.sha256(image).digest()
+    blob = bytearray()
+    for op_type, dst, data, src in ops:
+        op = partition.operations.add()
+        op.type = op_type
+        for start, num in dst:
+            op.dst_extents.add(start_block=start, num_blocks=num)
+        for start, num in src:
+            op.src_extents.add(start_block=start, num_blocks=num)
+        if data is not None:
+            op.data_offset = len(blob)
+            op.data_length = len(data)
+            op.data_sha256_hash = hashlib.sha256(data).digest()
+            blob += data
+    meta = manifest.SerializeToString()
+    with open(path, "wb") as f:
+        f.write(b"CrAU" + struct.pack(">QQI", 2, len(meta), 0) + meta + blob)
+
+
+@pytest.fixture
+def payloads(tmp_path):
+    rng = random.Random(1)
+    old = bytearray(rng.randbytes(BLOCKS * BS))
+    old[40 * BS:50 * BS] = bytes(10 * BS)
+    write_payload(tmp_path / "full.bin", bytes(old), [
+        (um.InstallOperation.REPLACE_XZ, [(0, 40)], lzma.compress(bytes(old[:40 * BS])), []),
+        (um.InstallOperation.ZERO, [(40, 10)], None, []),
+        (um.InstallOperation.REPLACE, [(50, 14)], bytes(old[50 * BS:]), []),
+    ])
+
+    new = bytearray(old)
+    new[0:10 * BS] = old[30 * BS:40 * BS]
+    patched = bytearray(old[10 * BS:20 * BS])
+    patched[100:200] = bytes(range(100))
+    new[10 * BS:20 * BS] = patched
+    new[60 * BS:] = rng.randbytes(4 * BS)
+    write_payload(tmp_path / "inc.bin", bytes(new), [
+        (um.InstallOperation.SOURCE_COPY, [(0, 10)], None, [(30, 10)]),
+        (um.InstallOperation.SOURCE_BSDIFF, [(10, 10)], bsdiff4.diff(bytes(old[10 * BS:20 * BS]), bytes(patched)),
+         [(10, 10)]),
+        (um.InstallOperation.SOURCE_COPY, [(20, 40)], None, [(20, 40)]),
+        (um.InstallOperation.REPLACE, [(60, 4)], bytes(new[60 * BS:]), []),
+    ])
+
+    (tmp_path / "old").mkdir()
+    (tmp_path / "old" / "system.img").write_bytes(old)
+    (tmp_path / "bad").mkdir()
+    (tmp_path / "bad" / "system.img").write_bytes(rng.randbytes(BLOCKS * BS))
+    return tmp_path, bytes(old), bytes(new)
+
+
+def dump(tmp_path, payload, *args):
+    env = dict(os.environ, PYTHONPATH=SRC)
+    return subprocess.run(
+        [sys.executable, "-m", "payload_dumper", "--out", str(tmp_path / "out"), *args, str(tmp_path / payload)],
+        env=env, capture_output=True, text=True, timeout=120,
+    )
+
+
+def image(tmp_path):
+    return (tmp_path / "out" / "system.img").read_bytes()
+
+
+def test_full(payloads):
+    tmp_path, old, _ = payloads
+    r = dump(tmp_path, "full.bin", "--verify")
+    assert r.returncode == 0, r.stdout + r.stderr
+    assert "system: hash ok" in r.stdout
+    assert image(tmp_path) == old
+
+
+def test_incremental(payloads):
+    tmp_path, _, new = payloads
+    r = dump(tmp_path, "inc.bin", "--diff", "--old", str(tmp_path / "old"))
+    assert r.returncode == 0, r.stdout + r.stderr
+    assert image(tmp_path) == new
+
+
+def test_skip_existing_with_wrong_old(payloads):
+    tmp_path, _, new = payloads
+    path = str(tmp_path / "out" / "system.img")
+    r = dump(tmp_path, "inc.bin", "--diff", "--old", str(tmp_path / "bad"), "--skip-existing")
+    assert r.returncode == 1
+    assert "system: hash mismatch" in r.stdout
+    assert not os.path.exists(sidecar_path(path))
+
+    r = dump(tmp_path, "inc.bin", "--diff", "--old", str(tmp_path / "old"), "--skip-existing")
+    assert r.returncode == 0, r.stdout + r.stderr
+    assert "up to date" not in r.stdout
+    assert image(tmp_path) == new
+    assert os.path.exists(sidecar_path(path))
+
+    r = dump(tmp_path, "inc.bin", "--diff", "--old", str(tmp_path / "old"), "--skip-existing")
+    assert "system: up to date, skipped" in r.stdout
+
+
+def test_resume_after_image_truncated(payloads):
+    tmp_path, old, _ = payloads
+    r = dump(tmp_path, "full.bin", "--resume")
+    assert r.returncode == 0, r.stdout + r.stderr
+    assert os.path.exists(tmp_path / "out" / JOURNAL_NAME)
+    os.truncate(tmp_path / "out" / "system.img", 0)
+    r = dump(tmp_path, "full.bin", "--resume", "--verify")
+    assert r.returncode == 0, r.stdout + r.stderr
+    assert "system: hash ok" in r.stdout
+    assert image(tmp_path) == old
@@ -0,0 +1,177 @@
+import threading
+
+import pytest
+
+from payload_dumper.http_file import ReadPlanner, _parse_content_range, _parse_multipart_byteranges
+
+DATA = bytes(range(256)) * 64
+
+
+def multipart(ranges, data=DATA, boundary=b"XYZ"):
+    body = b""
+    for start, end in ranges:
+        body += b"--" + boundary + b"\r\n"
+        body += b"Content-Type: application/octet-stream\r\n"
+        body += b"Content-Range: bytes %d-%d/%d\r\n\r\n" % (start, end - 1, len(data))
+        body += data[start:end] + b"\r\n"
+    return body + b"--" + boundary + b"--\r\n"
+
+
+def test_parse_content_range():
+    assert _parse_content_range("bytes 10-19/100") == (10, 20)
+    assert _parse_content_range(" bytes 0-0/*") == (0, 1)
+    with pytest.raises(ValueError):
+        _parse_content_range("items 0-1/2")
+
+
+def test_parse_multipart_byteranges():
+    ranges = [(0, 10), (100, 300), (4000, 4001)]
+    parts = _parse_multipart_byteranges(multipart(ranges), b"XYZ")
+    assert [(start, end) for start, end, _ in parts] == ranges
+    for start, end, data in parts:
+        assert bytes(data) == DATA[start:end]
+
+
+def test_parse_multipart_byteranges_data_with_delimiter():
+    # the part data is taken by its Content-Range, not up to the next delimiter
+    data = b"--XYZ\r\n" * 10
+    parts = _parse_multipart_byteranges(multipart([(0, 20), (30, 60)], data), b"XYZ")
+    assert [bytes(d) for _, _, d in parts] == [data[0:20], data[30:60]]
+
+
+def test_parse_multipart_byteranges_errors():
+    truncated = multipart([(0, 10)])
+    with pytest.raises(ValueError):
+        _parse_multipart_byteranges(truncated[:20], b"XYZ")
+    no_range = b"--XYZ\r\nContent-Type: text/plain\r\n\r\nabc\r\n--XYZ--\r\n"
+    with pytest.raises(ValueError):
+        _parse_multipart_byteranges(no_range, b"XYZ")
+
+
+class Fetcher:
+    def __init__(self):
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def __call__(self, runs):
+        with self.lock:
+            self.requests.append(list(runs))
+        return [DATA[start:end] for start, end in runs]
+
+
+def read(planner, off, size):
+    buf = bytearray(size)
+    n = planner.readinto(off, size, buf)
+    if n is None:
+        return None
+    assert n == size
+    return bytes(buf)
+
+
+def test_planner_coalesces_close_reads():
+    fetch = Fetcher()
+    planner = ReadPlanner(fetch, max_gap=16, max_request_size=1 << 20, max_ranges=1)
+    spans = [(0, 100), (110, 50), (170, 30), (1000, 10)]
+    planner.plan(spans)
+    for off, size in reversed(spans):
+        assert read(planner, off, size) == DATA[off:off + size]
+    # the gap before 1000 is too large, it is a request of its own
+    assert sorted(fetch.requests) == [[(0, 200)], [(1000, 1010)]]
+    assert planner.spans == {}
+
+
+def test_planner_limits_ranges_and_request_size():
+    fetch = Fetcher()
+    planner = ReadPlanner(fetch, max_gap=0, max_request_size=300, max_ranges=2)
+    spans = [(0, 100), (200, 100), (400, 100), (600, 100), (800, 250)]
+    planner.plan(spans)
+    for off, size in spans:
+        assert read(planner, off, size) == DATA[off:off + size]
+    assert fetch.requests == [[(0, 100), (200, 300)], [(400, 500), (600, 700)], [(800, 1050)]]
+
+
+def test_planner_skips_unplanned_and_oversized():
+    fetch = Fetcher()
+    planner = ReadPlanner(fetch, max_gap=0, max_request_size=100, max_ranges=4)
+    planner.plan([(0, 10), (50, 200), (300, 0)])
+    assert read(planner, 20, 10) is None
+    assert read(planner, 50, 200) is None
+    assert read(planner, 300, 0) is None
+    assert read(planner, 0, 10) == DATA[:10]
+    assert fetch.requests == [[(0, 10)]]
+
+
+def test_planner_same_span_twice():
+    fetch = Fetcher()
+    planner = ReadPlanner(fetch, max_gap=0, max_request_size=1 << 20, max_ranges=4)
+    planner.plan([(0, 10), (0, 10)])
+    assert read(planner, 0, 10) == DATA[:10]
+    assert read(planner, 0, 10) == DATA[:10]
+    assert read(planner, 0, 10) is None
+
+
+def test_planner_group_fetched_once_by_concurrent_readers():
+    fetch = Fetcher()
+    planner = ReadPlanner(fetch, max_gap=64, max_request_size=1 << 20, max_ranges=1)
+    spans = [(i * 100, 90) for i in range(40)]
+    planner.plan(spans)
+    results = {}
+
+    def reader(part):
+        for off, size in part:
+            results[off] = read(planner, off, size)
+
+    threads = [threading.Thread(target=reader, args=(spans[i::4],)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(fetch.requests) == 1
+    assert all(results[off] == DATA[off:off + size] for off, size in spans)
+
+
+def test_planner_fetch_error_reaches_every_reader():
+    def fail(runs):
+        raise OSError("boom")
+
+    planner = ReadPlanner(fail, max_gap=64, max_request_size=1 << 20, max_ranges=1)
+    planner.plan([(0, 10), (20, 10)])
+    with pytest.raises(OSError):
+        read(planner, 0, 10)
+    with pytest.raises(OSError):
+        read(planner, 20, 10)
+
+
+def group_of(planner, off, size):
+    return planner.spans[(off, size)][0]
+
+
+def test_planner_buffers_dropped_when_served():
+    planner = ReadPlanner(Fetcher(), max_gap=64, max_request_size=1 << 20, max_ranges=1)
+    planner.plan([(0, 10), (20, 10)])
+    group = group_of(planner, 20, 10)
+    read(planner, 0, 10)
+    assert group.data is not None
+    read(planner, 20, 10)
+    assert group.data is None
+
+
+def test_planner_unplan_releases_group():
+    planner = ReadPlanner(Fetcher(), max_gap=64, max_request_size=1 << 20, max_ranges=1)
+    planner.plan([(0, 10), (20, 10), (40, 10)])
+    group = group_of(planner, 20, 10)
+    read(planner, 0, 10)
+    # spans already read, or never planned, are ignored; (40, 10) still holds the group
+    planner.unplan([(0, 10), (20, 10), (1000, 5)])
+    assert group.data is not None
+    planner.unplan([(40, 10)])
+    assert group.data is None
+    assert planner.spans == {}
+    assert read(planner, 40, 10) is None
+
+
+def test_planner_clear():
+    planner = ReadPlanner(Fetcher(), max_gap=64, max_request_size=1 << 20, max_ranges=1)
+    planner.plan([(0, 10), (20, 10)])
+    planner.clear()
+    assert read(planner, 0, 10) is None
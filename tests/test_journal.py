@@ -0,0 +1,127 @@
+import os
+
+import pytest
+
+from payload_dumper.journal import JOURNAL_NAME, Journal, reset_journal
+
+
+class Image:
+    def __init__(self):
+        self.synced = 0
+
+    def sync(self):
+        self.synced += 1
+
+
+@pytest.fixture
+def out(tmp_path):
+    for name in ("system", "boot"):
+        (tmp_path / f"{name}.img").write_bytes(bytes(4096))
+    return tmp_path
+
+
+def image_path(out, name):
+    return str(out / f"{name}.img")
+
+
+def start(out, name, manifest="m1", **kwargs):
+    journal = Journal(str(out), manifest, **kwargs)
+    journal.reset(name)
+    journal.opened(name, image_path(out, name))
+    return journal
+
+
+def test_replay(out):
+    journal = start(out, "system")
+    journal.opened("boot", image_path(out, "boot"))
+    image = Image()
+    for i in (0, 1, 5):
+        journal.record("system", i, image)
+    journal.record("boot", 2, image)
+    journal.close()
+    assert image.synced == 1
+
+    journal = Journal(str(out), "m1")
+    assert journal.finished_ops("system", image_path(out, "system")) == {0, 1, 5}
+    assert journal.finished_ops("boot", image_path(out, "boot")) == {2}
+    assert journal.finished_ops("vendor", image_path(out, "vendor")) == set()
+    journal.close()
+
+
+def test_records_are_batched(out):
+    journal = start(out, "system", batch=3, interval=3600)
+    image = Image()
+    journal.record("system", 0, image)
+    journal.record("system", 1, image)
+    assert Journal(str(out), "m1").finished_ops("system", image_path(out, "system")) == set()
+    journal.record("system", 2, image)
+    assert image.synced == 1
+    assert Journal(str(out), "m1").finished_ops("system", image_path(out, "system")) == {0, 1, 2}
+    journal.close()
+
+
+def test_other_manifest_starts_over(out):
+    journal = start(out, "system")
+    journal.record("system", 0, Image())
+    journal.close()
+    journal = Journal(str(out), "m2")
+    assert journal.finished_ops("system", image_path(out, "system")) == set()
+    journal.close()
+    with open(out / JOURNAL_NAME) as f:
+        assert f.read().endswith(" m2\n")
+
+
+def test_partial_record_dropped(out):
+    journal = start(out, "system")
+    journal.record("system", 7, Image())
+    journal.close()
+    with open(out / JOURNAL_NAME, "a") as f:
+        f.write("system 1")
+    journal = Journal(str(out), "m1")
+    assert journal.finished_ops("system", image_path(out, "system")) == {7}
+    journal.record("system", 8, Image())
+    journal.close()
+    assert Journal(str(out), "m1").finished_ops("system", image_path(out, "system")) == {7, 8}
+
+
+def test_reset_is_durable(out):
+    journal = start(out, "system")
+    journal.record("system", 0, Image())
+    journal.flush()
+    journal.reset("system")
+    journal.opened("system", image_path(out, "system"))
+    journal.record("system", 3, Image())
+    journal.close()
+    assert Journal(str(out), "m1").finished_ops("system", image_path(out, "system")) == {3}
+
+
+def test_changed_image_not_trusted(out, capsys):
+    journal = start(out, "system")
+    journal.record("system", 0, Image())
+    journal.close()
+    os.truncate(image_path(out, "system"), 0)
+    journal = Journal(str(out), "m1")
+    assert journal.finished_ops("system", image_path(out, "system")) == set()
+    assert "image changed" in capsys.readouterr().out
+    os.remove(image_path(out, "system"))
+    assert journal.finished_ops("system", image_path(out, "system")) == set()
+    journal.close()
+
+
+def test_reset_journal_without_journal(out):
+    # a run without a journal writing an image over
+    reset_journal(str(out), "system")
+    assert not os.path.exists(out / JOURNAL_NAME)
+
+    journal = start(out, "system")
+    journal.opened("boot", image_path(out, "boot"))
+    journal.record("system", 0, Image())
+    journal.record("boot", 0, Image())
+    journal.close()
+    with open(out / JOURNAL_NAME, "a") as f:
+        f.write("boot 1")
+    reset_journal(str(out), "system")
+    journal = Journal(str(out), "m1")
+    assert journal.finished_ops("system", image_path(out, "system")) == set()
+    assert journal.finished_ops("boot", image_path(out, "boot")) == {0}
+    journal.close()
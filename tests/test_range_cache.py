@@ -0,0 +1,66 @@
+import time
+
+from payload_dumper.range_cache import RangeCache
+
+SIZE = 1 << 20
+URL = "https://example.com/ota.zip"
+
+
+def data(off, n):
+    return bytes((off + i) % 251 for i in range(n))
+
+
+def lookup(remote, off, end):
+    buf = bytearray(end - off)
+    missing = remote.lookup(off, end, memoryview(buf))
+    return buf, missing
+
+
+def test_lookup_returns_missing_ranges(tmp_path):
+    remote = RangeCache(str(tmp_path), SIZE).open(URL, '"etag"', None, SIZE)
+    remote.store(100, data(100, 100))
+    remote.store(300, data(300, 50))
+    # adjacent and overlapping stores merge
+    remote.store(150, data(150, 100))
+    assert [e[:2] for e in remote.extents] == [[100, 250], [300, 350]]
+    buf, missing = lookup(remote, 0, 400)
+    assert missing == [(0, 100), (250, 300), (350, 400)]
+    assert buf[100:250] == data(100, 150)
+    assert buf[300:350] == data(300, 50)
+    remote.close()
+
+
+def test_cache_kept_across_runs(tmp_path):
+    cache = RangeCache(str(tmp_path), SIZE)
+    remote = cache.open(URL, '"etag"', None, SIZE)
+    remote.store(1000, data(1000, 5000))
+    remote.close()
+
+    remote = cache.open(URL, '"etag"', None, SIZE)
+    buf, missing = lookup(remote, 1000, 6000)
+    assert missing == []
+    assert buf == data(1000, 5000)
+    remote.close()
+
+    # another version of the file is not served from it
+    remote = cache.open(URL, '"other"', None, SIZE)
+    assert lookup(remote, 1000, 6000)[1] == [(1000, 6000)]
+    remote.close()
+
+
+def test_least_recently_used_evicted(tmp_path):
+    remote = RangeCache(str(tmp_path), 3000).open(URL, None, None, SIZE)
+    remote.store(0, data(0, 1000))
+    time.sleep(0.01)
+    remote.store(10000, data(10000, 1000))
+    time.sleep(0.01)
+    lookup(remote, 0, 1000)
+    time.sleep(0.01)
+    remote.store(20000, data(20000, 1500))
+    # the extent at 10000 was used least recently, its end is trimmed
+    assert remote.cached_size() == 3000
+    assert [e[:2] for e in remote.extents] == [[0, 1000], [10000, 10500], [20000, 21500]]
+    buf, missing = lookup(remote, 10000, 11000)
+    assert missing == [(10500, 11000)]
+    assert buf[:500] == data(10000, 500)
+    remote.close()
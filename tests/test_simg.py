@@ -0,0 +1,75 @@
+import random
+
+from payload_dumper.simg import (
+    CHUNK_HEADER, CHUNK_TYPE_DONT_CARE, CHUNK_TYPE_FILL, CHUNK_TYPE_RAW, FILE_HEADER, SPARSE_HEADER_MAGIC,
+    SparseImageStream, SparseWriter,
+)
+
+BS = 4096
+
+
+# the image of a sparse file, DONT_CARE as zeros, and the blocks of each chunk type
+def unsparse(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, major, _, file_header, chunk_header, block_size, total_blocks, chunks, _ = \
+        FILE_HEADER.unpack_from(data)
+    assert (magic, major, file_header, chunk_header) == (SPARSE_HEADER_MAGIC, 1, FILE_HEADER.size, CHUNK_HEADER.size)
+    out = bytearray()
+    blocks = {}
+    pos = FILE_HEADER.size
+    for _ in range(chunks):
+        chunk_type, _, n, size = CHUNK_HEADER.unpack_from(data, pos)
+        body = data[pos + CHUNK_HEADER.size:pos + size]
+        pos += size
+        blocks[chunk_type] = blocks.get(chunk_type, 0) + n
+        if chunk_type == CHUNK_TYPE_RAW:
+            assert len(body) == n * block_size
+            out += body
+        elif chunk_type == CHUNK_TYPE_FILL:
+            assert len(body) == 4
+            out += body * (n * block_size // 4)
+        else:
+            assert chunk_type == CHUNK_TYPE_DONT_CARE and len(body) == 0
+            out += bytes(n * block_size)
+    assert pos == len(data)
+    assert len(out) == total_blocks * block_size
+    return bytes(out), blocks
+
+
+def test_sparse_writer(tmp_path):
+    rng = random.Random(1)
+    size = 20 * BS + 100
+    image = bytearray(size)
+    image[0:3 * BS] = rng.randbytes(3 * BS)
+    image[3 * BS:6 * BS] = b"\x01\x02\x03\x04" * (3 * BS // 4)
+    image[6 * BS:7 * BS] = bytes(BS)
+    image[10 * BS:12 * BS] = rng.randbytes(2 * BS)
+    image[20 * BS:] = rng.randbytes(100)
+    path = str(tmp_path / "a.img")
+    writer = SparseWriter(path, size, BS)
+    # in order, blocks 7 to 9 are a gap, pieces not aligned to blocks
+    for off, end in [(0, 5000), (5000, 7 * BS), (10 * BS, 11 * BS + 1), (11 * BS + 1, 12 * BS), (20 * BS, size)]:
+        writer.write(off, image[off:end])
+    data, blocks = unsparse(path)
+    # the last block is padded
+    assert data == image + bytes(BS - 100)
+    assert blocks == {CHUNK_TYPE_RAW: 6, CHUNK_TYPE_FILL: 4, CHUNK_TYPE_DONT_CARE: 11}
+
+
+def test_sparse_image_stream(tmp_path):
+    rng = random.Random(2)
+    stream = SparseImageStream(str(tmp_path), BS, 1 << 20)
+    size = 16 * BS
+    data = bytearray(size)
+    ranges = [(2 * BS, 4 * BS), (10 * BS, BS)]
+    for off, n in ranges:
+        data[off:off + n] = rng.randbytes(n)
+    image = stream.add_image("system.img", size, ranges, True)
+    stream.add_image("empty.img", 2 * BS, [], False)
+    stream.finish_layout()
+    for off, n in reversed(ranges):
+        image.write(off, data[off:off + n])
+    stream.close()
+    assert unsparse(tmp_path / "system.img")[0] == data
+    assert unsparse(tmp_path / "empty.img") == (bytes(2 * BS), {CHUNK_TYPE_DONT_CARE: 2})
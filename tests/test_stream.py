@@ -0,0 +1,137 @@
+import hashlib
+import io
+import random
+import tarfile
+
+import pytest
+
+from payload_dumper.stream import OrderedStream, RawStream, TarStream, data_ranges
+from payload_dumper.update_metadata_pb2 import Extent
+
+BS = 4096
+
+
+def extents(*blocks):
+    return [Extent(start_block=start, num_blocks=num) for start, num in blocks]
+
+
+def test_data_ranges():
+    assert data_ranges([], BS, 10 * BS) == []
+    # sorted, adjacent and overlapping extents merged
+    assert data_ranges(extents((5, 2), (0, 1), (1, 2), (6, 3)), BS, 100 * BS) == [(0, 3 * BS), (5 * BS, 4 * BS)]
+    # cut at the image size, past it dropped
+    assert data_ranges(extents((8, 4), (20, 1)), BS, 10 * BS - 100) == [(8 * BS, 2 * BS - 100)]
+
+
+def image_data(size, ranges, seed=1):
+    rng = random.Random(seed)
+    data = bytearray(size)
+    for off, n in ranges:
+        data[off:off + n] = rng.randbytes(n)
+    return bytes(data)
+
+
+# write the ranges of each image in pieces, in random order, and close the stream
+def fill(stream, images):
+    writes = []
+    for image, data, ranges in images:
+        for off, n in ranges:
+            for pos in range(off, off + n, 1000):
+                writes.append((image, pos, data[pos:min(pos + 1000, off + n)]))
+    random.Random(2).shuffle(writes)
+    for image, pos, piece in writes:
+        image.write(pos, piece)
+    stream.close()
+
+
+IMAGES = [
+    ("whole.img", 3 * BS, [(0, 3 * BS)]),
+    ("holes.img", 10 * BS, [(BS, 2 * BS), (6 * BS, BS)]),
+    ("hole_end.img", 5 * BS + 10, [(0, BS)]),
+    ("empty.img", 2 * BS, []),
+]
+
+
+def test_tar_stream():
+    out = io.BytesIO()
+    stream = TarStream(out, 1 << 30)
+    images = []
+    for i, (name, size, ranges) in enumerate(IMAGES):
+        data = image_data(size, ranges, i)
+        images.append((stream.add_image(name, size, ranges, True), data, ranges))
+    stream.finish_layout()
+    fill(stream, images)
+
+    assert len(out.getvalue()) % tarfile.RECORDSIZE == 0
+    with tarfile.open(fileobj=io.BytesIO(out.getvalue())) as tar:
+        members = tar.getmembers()
+        assert [m.name for m in members] == [name for name, _, _ in IMAGES]
+        for (name, size, ranges), (image, data, _) in zip(IMAGES, images):
+            member = tar.getmember(name)
+            assert member.size == size
+            if sum(n for _, n in ranges) < size:
+                assert member.issparse()
+            assert tar.extractfile(member).read() == data
+            assert image.digest() == hashlib.sha256(data).digest()
+
+
+def test_raw_stream():
+    out = io.BytesIO()
+    stream = RawStream(out, 1 << 30)
+    images = []
+    for i, (name, size, ranges) in enumerate(IMAGES):
+        data = image_data(size, ranges, i)
+        images.append((stream.add_image(name, size, ranges, False), data, ranges))
+    stream.finish_layout()
+    # the holes are zeros once the writes around them are done
+    fill(stream, images)
+    raw = out.getvalue()
+    index = stream.index
+    assert [e["name"] for e in index] == [name for name, _, _ in IMAGES]
+    for entry, (_, data, _) in zip(index, images):
+        assert raw[entry["offset"]:entry["offset"] + entry["size"]] == data
+    assert len(raw) == sum(size for _, size, _ in IMAGES)
+
+
+class Image:
+    def __init__(self):
+        self.received = []
+
+    def passed(self, off, data):
+        self.received.append((off, bytes(data)))
+
+
+def test_ordered_stream_passes_in_order():
+    out = io.BytesIO()
+    stream = OrderedStream(out, 1 << 20)
+    stream.add_literal(b"head")
+    image = Image()
+    stream.add_range(image, 0, 10)
+    stream.add_range(image, 10, 5, zeros=True)
+    stream.add_literal(b"tail")
+    stream.write(4 + 5, b"fghij")
+    assert out.getvalue() == b"head"
+    stream.write(4, b"abcde")
+    assert out.getvalue() == b"headabcdefghij" + bytes(5) + b"tail"
+    stream.close()
+    assert image.received[0][0] == 0
+    assert b"".join(d for _, d in image.received) == b"abcdefghij" + bytes(5)
+
+
+def test_ordered_stream_done_fills_zeros():
+    out = io.BytesIO()
+    stream = OrderedStream(out, 1 << 20)
+    image = Image()
+    stream.add_range(image, 0, 100)
+    stream.write(10, b"x" * 10)
+    stream.done(0, 100)
+    stream.close()
+    assert out.getvalue() == bytes(10) + b"x" * 10 + bytes(80)
+
+
+def test_ordered_stream_incomplete():
+    stream = OrderedStream(io.BytesIO(), 1 << 20)
+    stream.add_range(Image(), 0, 10)
+    stream.write(0, b"abc")
+    with pytest.raises(ValueError):
+        stream.close()
@@ -0,0 +1,120 @@
+import random
+import zipfile
+
+import pytest
+
+from payload_dumper import mtio, zip_entry
+from payload_dumper.zip_entry import DeflatedEntryMTIO, SliceMTIO, open_zip_entry
+from payload_dumper.ziputil import get_zip_index
+
+SPAN = 32 * 1024
+
+
+def sample(size: int, seed: int = 1) -> bytes:
+    rng = random.Random(seed)
+    words = [bytes(rng.choices(b"abcdefghij \n", k=rng.randint(1, 12))) for _ in range(500)]
+    data = bytearray()
+    while len(data) < size:
+        data += rng.choice(words)
+        if rng.random() < 0.01:
+            # incompressible runs make stored blocks in the deflate stream
+            data += rng.randbytes(rng.randint(1, 5000))
+    return bytes(data[:size])
+
+
+@pytest.fixture(params=["libz", "zlib"])
+def inflater(request, monkeypatch):
+    if request.param == "zlib":
+        monkeypatch.setattr(zip_entry, "_libz", None)
+    elif zip_entry._libz is None:
+        pytest.skip("libz not found")
+    return request.param
+
+
+@pytest.fixture
+def zip_path(tmp_path):
+    path = tmp_path / "ota.zip"
+    with zipfile.ZipFile(path, "w") as z:
+        z.writestr("deflated.bin", sample(700 * 1024), compress_type=zipfile.ZIP_DEFLATED)
+        z.writestr("stored.bin", sample(10000, 2), compress_type=zipfile.ZIP_STORED)
+    return str(path)
+
+
+def open_deflated(zip_path, index_dir=None):
+    file = mtio.MTFile(zip_path, "r")
+    index = get_zip_index(file)
+    entry = index.get("deflated.bin")
+    return DeflatedEntryMTIO(file, index.data_offset(entry), entry.compressed_size, entry.uncompressed_size,
+                             entry.crc32, index_dir, span=SPAN, cached_spans=2)
+
+
+def test_random_reads(zip_path, inflater):
+    data = sample(700 * 1024)
+    f = open_deflated(zip_path)
+    assert f.get_size() == len(data)
+    # the zlib fallback takes checkpoints only between its reads
+    assert len(f.index.points) > 1
+    rng = random.Random(3)
+    for _ in range(200):
+        off = rng.randrange(len(data))
+        size = rng.choice([1, 100, SPAN - 1, SPAN, 3 * SPAN + 5])
+        assert f.read(off, size) == data[off:off + size]
+    # reads past the end are cut short
+    assert f.read(len(data) - 10, 100) == data[-10:]
+    assert f.read(len(data), 10) == b""
+    f.close()
+
+
+def test_index_saved_and_loaded(zip_path, tmp_path, capsys):
+    if zip_entry._libz is None:
+        pytest.skip("the index is only saved with libz")
+    data = sample(700 * 1024)
+    index_dir = str(tmp_path / "index")
+    open_deflated(zip_path, index_dir).close()
+    assert "building deflate index" in capsys.readouterr().out
+    f = open_deflated(zip_path, index_dir)
+    assert "building deflate index" not in capsys.readouterr().out
+    assert f.read(123456, 100000) == data[123456:223456]
+    f.close()
+
+
+def test_open_zip_entry(zip_path):
+    file = mtio.MTFile(zip_path, "r")
+    index = get_zip_index(file)
+    stored = open_zip_entry(file, index, "stored.bin")
+    assert isinstance(stored, SliceMTIO)
+    assert stored.read(0, 20000) == sample(10000, 2)
+    deflated = open_zip_entry(file, index, "deflated.bin")
+    assert isinstance(deflated, DeflatedEntryMTIO)
+    assert deflated.read(5, 10) == sample(700 * 1024)[5:15]
+    file.close()
+
+
+class Recorder(mtio.MTIOBase):
+    def __init__(self):
+        self.planned = []
+        self.unplanned = []
+
+    def plan_reads(self, ranges):
+        self.planned += ranges
+
+    def unplan_reads(self, ranges):
+        self.unplanned += ranges
+
+
+def test_plan_reads_map_to_compressed_spans(zip_path):
+    if zip_entry._libz is None:
+        pytest.skip("the zlib fallback has too few checkpoints")
+    f = open_deflated(zip_path)
+    recorder = f.inner = Recorder()
+    f.off = 0
+    reads = [(0, 10), (f.starts[1] + 1, f.starts[3] - f.starts[1]), (5, 1), (100, 0)]
+    f.plan_reads(reads)
+    points = f.index.points
+    # spans 0 to 3 are touched, each planned once from the byte holding its first bits
+    assert recorder.planned == [
+        (p.in_off - (1 if p.bits else 0), nxt.in_off + 1 - (p.in_off - (1 if p.bits else 0)))
+        for p, nxt in zip(points[:4], points[1:5])
+    ]
+    f.unplan_reads(reads)
+    assert recorder.unplanned == recorder.planned